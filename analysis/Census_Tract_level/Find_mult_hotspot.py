@@ -1,6 +1,14 @@
 import os
+import sys
+
 import geopandas as gpd
-import pandas as pd
+import numpy as np
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(current_dir, "../.."))
+sys.path.append(project_root)
+
+from data_process.hotspot_reader import read_attributes
 
 # 设置文件夹路径
 themes_folder = r"D:\Code\Social_segregation\data\Getis_Ord_themes_Results"
@@ -13,60 +21,157 @@ theme_folders = [
 
 # 输出文件夹
 output_folder = r"D:\Code\Social_segregation\data\Common_Hotspots"
-os.makedirs(output_folder, exist_ok=True)
 
 # 置信度水平
 significance_levels = ['99%', '95%', '90%']
 
-# 遍历 themes 文件夹
-for filename in os.listdir(themes_folder):
-    if filename.endswith('.geojson'):
-        city_name = filename.split('_')[0]
-
-        # 读取 themes 的 GeoJSON
-        themes_gdf = gpd.read_file(os.path.join(themes_folder, filename))
-
-        # 读取 theme1-4 的 GeoJSON
-        theme_gdfs = []
-        for folder in theme_folders:
-            theme_file = next((f for f in os.listdir(folder) if f.startswith(city_name) and f.endswith('.geojson')), None)
-            if theme_file:
-                theme_gdf = gpd.read_file(os.path.join(folder, theme_file))
-                theme_gdfs.append(theme_gdf)
-            else:
-                print(f"Warning: No matching file found for {city_name} in {folder}")
-                break
+# 每个 uint8 的置位数，用于统计一个 tract 在几个主题上显著
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
 
-        # 如果没有找到所有theme的文件，跳过这个城市
-        if len(theme_gdfs) != 4:
-            continue
 
-        # 确保所有文件的 Census Tract 顺序一致
-        all_gdfs = [themes_gdf] + theme_gdfs
-        for gdf in all_gdfs:
-            gdf.sort_values(by="id", inplace=True)
-            gdf.reset_index(drop=True, inplace=True)
+def index_folder(folder):
+    """List a theme folder once and map city name -> GeoJSON file (first match, as before)."""
+    files = {}
+    for f in sorted(os.listdir(folder)):
+        if f.endswith('.geojson'):
+            files.setdefault(f.split('_')[0], os.path.join(folder, f))
+    return files
 
-        # 检查是否对齐
-        if not all(all_gdfs[0]["id"].equals(gdf["id"]) for gdf in all_gdfs[1:]):
-            print(f"Warning: {city_name} - GEOIDs do not match exactly. Check input data.")
-            continue
 
-        # 找出共同的热点
-        for level in significance_levels:
-            common_hotspots = themes_gdf[f'themes_hotspot_{level}'].astype(int)
-            for theme_gdf in theme_gdfs:
-                theme_name = theme_gdf.columns[theme_gdf.columns.str.contains('_hotspot_')][0].split('_')[0]
-                common_hotspots &= theme_gdf[f'{theme_name}_hotspot_{level}'].astype(int)
+def build_city_bits(theme_tables, theme_names, levels=significance_levels, kind='hotspot'):
+    """
+    Pack the significance flags of one city into a tract × level bitset.
+
+    Bit ``t`` of ``bits[i, l]`` is set when tract ``i`` is a ``kind`` of theme
+    ``theme_names[t]`` at ``levels[l]``.
+
+    Parameters
+    ----------
+    theme_tables : list of DataFrame
+        One table per theme, sorted by tract id and aligned.
+    theme_names : list[str]
+        Theme prefix of the flag columns ('themes', 'theme1', ...), at most 8.
+    levels : list[str]
+    kind : str
+        'hotspot' or 'coldspot'.
+
+    Returns
+    -------
+    uint8 array, shape (n_tracts, len(levels))
+    """
+    n = len(theme_tables[0])
+    bits = np.zeros((n, len(levels)), dtype=np.uint8)
+    for t, (table, theme) in enumerate(zip(theme_tables, theme_names)):
+        for l, level in enumerate(levels):
+            flags = table[f'{theme}_{kind}_{level}'].fillna(0).to_numpy().astype(bool)
+            bits[:, l] |= flags.astype(np.uint8) << t
+    return bits
+
+
+def theme_mask(theme_names, themes=None):
+    """Bit mask selecting the given themes (all themes if None)."""
+    if themes is None:
+        return (1 << len(theme_names)) - 1
+    return sum(1 << theme_names.index(theme) for theme in themes)
+
 
-            # 创建包含共同热点的GeoDataFrame
-            common_hotspots_gdf = themes_gdf[common_hotspots == 1].copy()
+def query_bits(bits, level_index, mask, min_count=None, max_count=None):
+    """
+    Tracts significant in a k-of-n combination of themes.
 
-            # 保存结果
-            output_filename = f"{city_name}_common_hotspots_{level}.geojson"
-            output_path = os.path.join(output_folder, output_filename)
-            common_hotspots_gdf.to_file(output_path, driver='GeoJSON')
+    Parameters
+    ----------
+    bits : uint8 array from build_city_bits
+    level_index : int
+        Column of the significance level.
+    mask : int
+        Themes taking part (theme_mask).
+    min_count, max_count : int, optional
+        Bounds on the number of selected themes in which the tract is
+        significant; by default all selected themes (the common hotspots).
+
+    Returns
+    -------
+    bool array, shape (n_tracts,)
+    """
+    count = POPCOUNT[bits[:, level_index] & mask]
+    if min_count is None and max_count is None:
+        min_count = POPCOUNT[mask]
+    selected = np.ones(len(bits), dtype=bool)
+    if min_count is not None:
+        selected &= count >= min_count
+    if max_count is not None:
+        selected &= count <= max_count
+    return selected
+
+
+def load_city(themes_file, theme_files):
+    """
+    Read one city: the themes GeoJSON with geometry, theme1-4 attributes only.
+
+    Returns
+    -------
+    (themes_gdf, theme_tables) sorted by id, or None if the tract ids do not match
+    """
+    themes_gdf = gpd.read_file(themes_file).sort_values(by="id").reset_index(drop=True)
+    theme_tables = [read_attributes(f).sort_values(by="id").reset_index(drop=True) for f in theme_files]
+    # 检查是否对齐
+    if not all(themes_gdf["id"].equals(table["id"]) for table in theme_tables):
+        return None
+    return themes_gdf, theme_tables
+
+
+def find_city_hotspots(city_name, themes_file, theme_files, output_folder, queries=None, levels=significance_levels):
+    """
+    Build the bitset of one city and write one GeoJSON per query and level.
+
+    Parameters
+    ----------
+    queries : dict, optional
+        name -> dict(themes=None, min_count=None, max_count=None) passed to
+        theme_mask/query_bits; default {'common_hotspots': {}} (all five themes).
+    """
+    loaded = load_city(themes_file, theme_files)
+    if loaded is None:
+        print(f"Warning: {city_name} - GEOIDs do not match exactly. Check input data.")
+        return
+    themes_gdf, theme_tables = loaded
+    theme_names = ['themes'] + [table.columns[table.columns.str.contains('_hotspot_')][0].split('_')[0]
+                                for table in theme_tables]
+    bits = build_city_bits([themes_gdf] + theme_tables, theme_names, levels)
+
+    for name, query in (queries or {'common_hotspots': {}}).items():
+        mask = theme_mask(theme_names, query.get('themes'))
+        for l, level in enumerate(levels):
+            selected = query_bits(bits, l, mask, query.get('min_count'), query.get('max_count'))
+            output_path = os.path.join(output_folder, f"{city_name}_{name}_{level}.geojson")
+            themes_gdf[selected].to_file(output_path, driver='GeoJSON')
+            print(f"Saved {name} for {city_name} at {level} confidence level")
+
+
+def find_all_hotspots(themes_folder, theme_folders, output_folder, queries=None):
+    """Run find_city_hotspots for every city, listing each folder only once."""
+    os.makedirs(output_folder, exist_ok=True)
+    theme_indexes = [index_folder(folder) for folder in theme_folders]
+    for city_name, themes_file in index_folder(themes_folder).items():
+        theme_files = []
+        for folder, index in zip(theme_folders, theme_indexes):
+            if city_name not in index:
+                print(f"Warning: No matching file found for {city_name} in {folder}")
+                break
+            theme_files.append(index[city_name])
+        # 如果没有找到所有theme的文件，跳过这个城市
+        if len(theme_files) != len(theme_folders):
+            continue
+        find_city_hotspots(city_name, themes_file, theme_files, output_folder, queries)
 
-            print(f"Saved common hotspots for {city_name} at {level} confidence level")
 
-print("处理完成。共同热点已保存到指定文件夹。")
+if __name__ == '__main__':
+    # 共同热点（全部五个维度），以及 theme1-4 中至少 3 个、恰好 1 个的热点
+    queries = {
+        'common_hotspots': {},
+        'hotspots_3of4': {'themes': ['theme1', 'theme2', 'theme3', 'theme4'], 'min_count': 3},
+        'hotspots_only1': {'themes': ['theme1', 'theme2', 'theme3', 'theme4'], 'min_count': 1, 'max_count': 1},
+    }
+    find_all_hotspots(themes_folder, theme_folders, output_folder, queries)
+    print("处理完成。共同热点已保存到指定文件夹。")
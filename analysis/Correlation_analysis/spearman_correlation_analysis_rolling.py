@@ -4,27 +4,25 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import sys
 from itertools import combinations
-from scipy import stats
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.abspath(os.path.join(current_dir, "../.."))
 sys.path.append(project_root)
 
 from data_process.data_reader import data_reader
+from data_process.data_struct import CityTable
+from analysis.Correlation_analysis.spearman_engine import (bootstrap_spearman, parallel_rolling_bootstrap,
+                                                           rolling_sensitivity)
 # -----------------------------
 # 1) 将 city_list 转为 DataFrame
 # -----------------------------
 def cities_to_df(city_list):
     """
-    Convert city_list to DataFrame with consistent column names.
+    Convert city_list (CityTable or list of city objects) to DataFrame with consistent column names.
     Assumes each city has attributes: theme1, theme2, theme3, theme4, themes.
     """
-    df = pd.DataFrame({
-        'SES':   [c.theme1 for c in city_list],
-        'HCD':   [c.theme2 for c in city_list],
-        'MSL':   [c.theme3 for c in city_list],
-        'HT':    [c.theme4 for c in city_list],   # 统一用 HT，避免 H&T/HT 混用
-        'Comp.': [c.themes for c in city_list]
-    })
+    # 直接取 CityTable 的主题矩阵，不再逐个城市重建列
+    df = pd.DataFrame(CityTable.coerce(city_list).theme_matrix(),
+                      columns=['SES', 'HCD', 'MSL', 'HT', 'Comp.'])   # 统一用 HT，避免 H&T/HT 混用
     return df
 
 
@@ -36,34 +34,26 @@ def spearman_with_bootstrap_ci(x, y, n_boot=2000, ci=95, random_state=42):
     Compute Spearman rho and bootstrap CI for rho.
     Bootstrap resamples paired (x,y) observations with replacement.
     """
-    x = np.asarray(x)
-    y = np.asarray(y)
-    n = len(x)
-    if n < 3:
-        return np.nan, (np.nan, np.nan)
-
-    rho, _ = stats.spearmanr(x, y)
-
-    rng = np.random.default_rng(random_state)
-    boot = np.empty(n_boot, dtype=float)
-
-    # paired bootstrap
-    for b in range(n_boot):
-        idx = rng.integers(0, n, size=n)
-        rb, _ = stats.spearmanr(x[idx], y[idx])
-        boot[b] = rb
-
-    alpha = (100 - ci) / 2
-    lo = np.nanpercentile(boot, alpha)
-    hi = np.nanpercentile(boot, 100 - alpha)
-    return rho, (lo, hi)
+    # 批量 bootstrap：所有重采样一次排名，与逐次调用 stats.spearmanr 的种子序列一致
+    rho, lo, hi = bootstrap_spearman(np.column_stack([x, y]), n_boot=n_boot, ci=ci, random_state=random_state)
+    return rho[0, 1], (lo[0, 1], hi[0, 1])
 
 
 # -------------------------------------------------------
 # 3) Rolling-window Spearman：相关性随隔离程度 S 变化
 # -------------------------------------------------------
-def rolling_spearman(df, sort_by='Comp.', variables=None, window=15, step=1,
-                     n_boot=2000, ci=95, random_state=42):
+def recommended_window(n):
+    """
+    Default rolling window for n cities: about sqrt(7.5 n), at least 8.
+
+    This gives 15 for the 30 study MSAs (the 12-15 used so far) and about 53
+    for all ~380 U.S. MSAs, so windows stay local as n grows.
+    """
+    return int(min(n, max(8, round(np.sqrt(7.5 * n)))))
+
+
+def rolling_spearman(df, sort_by='Comp.', variables=None, window=None, step=1,
+                     n_boot=2000, ci=95, random_state=42, n_jobs=None):
     """
     Rolling-window Spearman correlation curves with bootstrap CI.
 
@@ -77,14 +67,20 @@ def rolling_spearman(df, sort_by='Comp.', variables=None, window=15, step=1,
         Variables to analyze. If None, use ['SES','HCD','MSL','HT','Comp.'].
         Note: Usually you may NOT want to include sort_by itself in pairwise curves;
               you can exclude it when plotting if desired.
-    window : int
-        Window size, recommended 12-15 for n=30.
+    window : int, optional
+        Window size; recommended_window(n) if None (15 for n=30).
     step : int
         Step size for sliding.
     n_boot : int
         Bootstrap iterations per window.
     ci : int
         CI level (e.g., 95).
+    n_jobs : int, optional
+        If given, windows are distributed over n_jobs worker processes and each
+        (window, pair) task draws its bootstrap from a seed derived from
+        random_state, the window start and the pair, so results do not depend
+        on the number of workers (they differ from the serial mode, where every
+        task reuses random_state).
     """
     if variables is None:
         variables = ['SES', 'HCD', 'MSL', 'HT', 'Comp.']
@@ -93,6 +89,8 @@ def rolling_spearman(df, sort_by='Comp.', variables=None, window=15, step=1,
     df_sorted = df.sort_values(sort_by).reset_index(drop=True)
 
     n = len(df_sorted)
+    if window is None:
+        window = recommended_window(n)
     if window > n:
         raise ValueError(f"window={window} is larger than n={n}")
 
@@ -101,6 +99,22 @@ def rolling_spearman(df, sort_by='Comp.', variables=None, window=15, step=1,
     results = {pair: {'S_center': [], 'rho': [], 'ci_low': [], 'ci_high': [], 'n': []}
                for pair in pairs}
 
+    if n_jobs is not None:
+        pair_index = [(variables.index(a), variables.index(b)) for (a, b) in pairs]
+        starts, stats = parallel_rolling_bootstrap(df_sorted[variables].to_numpy(dtype=float), window, step,
+                                                   pairs=pair_index, n_boot=n_boot, ci=ci,
+                                                   random_state=random_state, n_jobs=n_jobs)
+        S_values = df_sorted[sort_by].to_numpy(dtype=float)
+        for w_idx, start in enumerate(starts):
+            S_center = float(np.mean(S_values[start:start + window]))
+            for p, pair in enumerate(pairs):
+                results[pair]['S_center'].append(S_center)
+                results[pair]['rho'].append(stats[w_idx, p, 0])
+                results[pair]['ci_low'].append(stats[w_idx, p, 1])
+                results[pair]['ci_high'].append(stats[w_idx, p, 2])
+                results[pair]['n'].append(window)
+        return results
+
     # Rolling
     for start in range(0, n - window + 1, step):
         end = start + window
@@ -109,20 +123,62 @@ def rolling_spearman(df, sort_by='Comp.', variables=None, window=15, step=1,
         # x-axis: center S in this window (用中位数更稳健)
         S_center = float(np.mean(w[sort_by].values))
 
+        # 窗口内所有变量对一次计算（bootstrap 索引在同样大小的窗口间共享）
+        rho, lo, hi = bootstrap_spearman(w[variables].to_numpy(dtype=float),
+                                         n_boot=n_boot, ci=ci, random_state=random_state)
         for (a, b) in pairs:
-            rho, (lo, hi) = spearman_with_bootstrap_ci(
-                w[a].values, w[b].values,
-                n_boot=n_boot, ci=ci, random_state=random_state
-            )
+            i, j = variables.index(a), variables.index(b)
             results[(a, b)]['S_center'].append(S_center)
-            results[(a, b)]['rho'].append(rho)
-            results[(a, b)]['ci_low'].append(lo)
-            results[(a, b)]['ci_high'].append(hi)
+            results[(a, b)]['rho'].append(rho[i, j])
+            results[(a, b)]['ci_low'].append(lo[i, j])
+            results[(a, b)]['ci_high'].append(hi[i, j])
             results[(a, b)]['n'].append(window)
 
     return results
 
 
+# -------------------------------------------------------
+# 3b) 敏感性分析：不同窗口大小、步长下的 rolling rho（增量计算，无 bootstrap）
+# -------------------------------------------------------
+def rolling_sensitivity_table(df, sort_by='Comp.', variables=None, windows=range(8, 21), steps=(1, 2)):
+    """
+    Rolling Spearman rho for a grid of window sizes and steps.
+
+    Windows are updated incrementally as one row enters and one leaves, so the
+    sweep also runs on tract-level tables with thousands of rows.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Must contain sort_by and all variables.
+    sort_by : str
+        Continuous segregation level variable, e.g., 'Comp.'.
+    variables : list[str]
+        Variables to analyze. If None, use ['SES','HCD','MSL','HT','Comp.'].
+    windows : iterable of int
+        Window sizes (sizes larger than the data are skipped).
+    steps : iterable of int
+        Step sizes.
+
+    Returns
+    -------
+    DataFrame with columns window, step, S_center, var_a, var_b, rho
+    """
+    if variables is None:
+        variables = ['SES', 'HCD', 'MSL', 'HT', 'Comp.']
+    df_sorted = df.sort_values(sort_by).reset_index(drop=True)
+    pairs = list(combinations(range(len(variables)), 2))
+
+    frames = []
+    for window, step, S_center, rho in rolling_sensitivity(
+            df_sorted[variables].to_numpy(dtype=float), df_sorted[sort_by].to_numpy(dtype=float),
+            windows=windows, steps=steps):
+        for i, j in pairs:
+            frames.append(pd.DataFrame({'window': window, 'step': step, 'S_center': S_center,
+                                        'var_a': variables[i], 'var_b': variables[j], 'rho': rho[:, i, j]}))
+    return pd.concat(frames, ignore_index=True)
+
+
 # -------------------------------------------------------
 # 4) 绘图：每对变量一张曲线（rho vs S_center + CI band）
 # -------------------------------------------------------
@@ -311,30 +367,37 @@ def plot_all_rolling_curves(roll_results, sort_by, window, step, ci, out_path, v
 # 5) 总入口：读数据 → rolling → 批量输出图片
 # -------------------------------------------------------
 def spearman_correlation_analysis_rolling(project_root,
-                                          window=15, step=1,
+                                          window=None, step=1,
                                           sort_by='Comp.',
                                           variables=None,
-                                          n_boot=2000, ci=95):
+                                          n_boot=2000, ci=95,
+                                          sensitivity_windows=None, sensitivity_steps=(1, 2),
+                                          n_jobs=None):
     """
     Rolling-window Spearman correlation analysis across continuous segregation level.
     Produces one curve per variable pair.
 
     Notes:
-    - For n=30, recommended window: 12-15
+    - window=None uses recommended_window(n): 15 for n=30, ~53 for all ~380 MSAs
     - Default variables include all dimensions: ['SES','HCD','MSL','HT','Comp.']
     - If you want to exclude Comp. from correlation pairs (since it's used for sorting),
       pass variables=['SES','HCD','MSL','HT'] explicitly.
+    - sensitivity_windows (e.g. range(8, 21)) additionally saves the rolling rho
+      for every window size and step in sensitivity_steps to a CSV.
+    - n_jobs runs the windows in parallel with per-task seeds (see rolling_spearman).
     """
     file_path = os.path.join(project_root, "data", "SSI_golbal_data.csv")
     city_list = data_reader(file_path, 4, classification_strategy='quartiles_4')  # init_classes=4 here only for reader; not used further
 
     df = cities_to_df(city_list)
+    if window is None:
+        window = recommended_window(len(df))
 
     if variables is None:
         # 默认包含所有变量，与 Spearman_correlation_and_heatmap.py 保持一致
         variables = ['SES', 'HCD', 'MSL', 'HT', 'Comp.']
 
-    results_dir = os.path.join(project_root, "results_Quartile", "correlation_analysis_rolling_15")
+    results_dir = os.path.join(project_root, "results_Quartile", f"correlation_analysis_rolling_{window}")
     os.makedirs(results_dir, exist_ok=True)
 
     # Rolling results
@@ -346,7 +409,8 @@ def spearman_correlation_analysis_rolling(project_root,
         step=step,
         n_boot=n_boot,
         ci=ci,
-        random_state=42
+        random_state=42,
+        n_jobs=n_jobs
     )
 
     # Save individual plots (optional, for detailed inspection)
@@ -362,16 +426,26 @@ def spearman_correlation_analysis_rolling(project_root,
     plot_all_rolling_curves(roll, sort_by, window, step, ci, combined_out_path, variables=variables)
     print(f"Combined visualization saved to: {combined_out_path}")
 
+    if sensitivity_windows is not None:
+        sensitivity = rolling_sensitivity_table(df, sort_by=sort_by, variables=variables,
+                                                windows=sensitivity_windows, steps=sensitivity_steps)
+        sensitivity_fname = f"rolling_sensitivity_by_{sort_by}".replace('.', '') + ".csv"
+        sensitivity_path = os.path.join(results_dir, sensitivity_fname)
+        sensitivity.to_csv(sensitivity_path, index=False)
+        print(f"Sensitivity analysis saved to: {sensitivity_path}")
+
     return roll, results_dir
 
 
-roll, out_dir = spearman_correlation_analysis_rolling(
-    project_root=r"D:\Code\Social_segregation",
-    window=15,     # n=30 时推荐 12-15
-    step=1,        # step=1 曲线更平滑；step=2 更"粗"
-    sort_by='Comp.',
-    variables=['SES','HCD','MSL','HT','Comp.'],  # 包含所有变量，与 Spearman_correlation_and_heatmap.py 保持一致
-    n_boot=2000,   # bootstrap 次数（可先 500 快速跑）
-    ci=95
-)
-print(out_dir)
\ No newline at end of file
+if __name__ == '__main__':
+    roll, out_dir = spearman_correlation_analysis_rolling(
+        project_root=r"D:\Code\Social_segregation",
+        window=15,     # n=30 时推荐 12-15
+        step=1,        # step=1 曲线更平滑；step=2 更"粗"
+        sort_by='Comp.',
+        variables=['SES','HCD','MSL','HT','Comp.'],  # 包含所有变量，与 Spearman_correlation_and_heatmap.py 保持一致
+        n_boot=2000,   # bootstrap 次数（可先 500 快速跑）
+        ci=95,
+        sensitivity_windows=range(8, 21)  # 窗口 8-20 的敏感性分析
+    )
+    print(out_dir)
\ No newline at end of file
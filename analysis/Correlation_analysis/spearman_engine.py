@@ -0,0 +1,482 @@
+# 向量化 Spearman 相关计算：批量 bootstrap、按列排名、基于排名的 Pearson 相关
+# 供 spearman_correlation_analysis_rolling.py 使用
+
+import numpy as np
+
+# 每个批次的 bootstrap 样本元素上限（batch × n × 变量数），控制内存
+BOOTSTRAP_BATCH_ELEMENTS = 20_000_000
+
+_bootstrap_index_cache = {}
+
+
+def rank_columns(X, axis=0):
+    """
+    Average ranks along an axis (ties get the mean rank, like scipy.stats.rankdata).
+
+    NaN values propagate: their ranks are NaN.
+
+    Parameters
+    ----------
+    X : array
+    axis : int
+        Axis along which the values are ranked.
+
+    Returns
+    -------
+    float array of the same shape, ranks starting at 1
+    """
+    X = np.moveaxis(np.asarray(X, dtype=float), axis, -1)
+    n = X.shape[-1]
+    order = np.argsort(X, axis=-1, kind='mergesort')
+    xs = np.take_along_axis(X, order, axis=-1)
+
+    # 平局组的首尾位置：组内平均秩 = (首 + 尾) / 2 + 1
+    pos = np.broadcast_to(np.arange(n), xs.shape)
+    starts = np.ones(xs.shape, dtype=bool)
+    starts[..., 1:] = xs[..., 1:] != xs[..., :-1]
+    ends = np.ones(xs.shape, dtype=bool)
+    ends[..., :-1] = starts[..., 1:]
+    first = np.maximum.accumulate(np.where(starts, pos, 0), axis=-1)
+    last = np.flip(np.minimum.accumulate(np.flip(np.where(ends, pos, n - 1), axis=-1), axis=-1), axis=-1)
+
+    ranks = np.empty(xs.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1.0, axis=-1)
+    ranks[np.isnan(X)] = np.nan
+    return np.moveaxis(ranks, -1, axis)
+
+
+def corr_on_ranks(R):
+    """
+    Pearson correlation matrix of already-ranked columns, i.e. Spearman's rho.
+
+    Parameters
+    ----------
+    R : array, shape (..., n, k)
+        Ranks of k variables over n observations; leading axes are batches.
+
+    Returns
+    -------
+    array, shape (..., k, k); NaN where a column is constant or has NaN
+    """
+    Rc = R - R.mean(axis=-2, keepdims=True)
+    cov = np.swapaxes(Rc, -1, -2) @ Rc
+    sd = np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rho = cov / (sd[..., :, None] * sd[..., None, :])
+    return np.clip(rho, -1.0, 1.0)
+
+
+def spearman_matrix(X):
+    """Spearman's rho between all columns of X, shape (n, k) -> (k, k)."""
+    return corr_on_ranks(rank_columns(X, axis=0))
+
+
+def bootstrap_indices(n, n_boot, random_state=42):
+    """
+    Paired-bootstrap row indices, shape (n_boot, n).
+
+    One ``integers(0, n, size=(n_boot, n))`` draw gives the same indices as
+    ``n_boot`` successive ``integers(0, n, size=n)`` draws from
+    ``default_rng(random_state)``, the sequence the per-pair loop used.  The
+    matrix only depends on (n, n_boot, random_state), so it is cached and
+    shared by every pair and window of the same size.
+    """
+    if random_state is None:
+        return np.random.default_rng().integers(0, n, size=(n_boot, n))
+    key = (n, n_boot, random_state)
+    if key not in _bootstrap_index_cache:
+        idx = np.random.default_rng(random_state).integers(0, n, size=(n_boot, n))
+        idx.flags.writeable = False
+        _bootstrap_index_cache[key] = idx
+    return _bootstrap_index_cache[key]
+
+
+def bootstrap_spearman(X, n_boot=2000, ci=95, random_state=42, indices=None, batch_size=None):
+    """
+    Spearman rho and paired-bootstrap percentile CI for all column pairs at once.
+
+    Every bootstrap sample is ranked per column and correlated with one batched
+    matrix product; the CI bounds are the same ``nanpercentile`` of the
+    bootstrap distribution as in ``spearman_with_bootstrap_ci``.
+
+    Parameters
+    ----------
+    X : array, shape (n, k)
+    n_boot : int
+        Bootstrap iterations.
+    ci : int
+        CI level (e.g., 95).
+    random_state : int, optional
+        Seed of the bootstrap indices (see bootstrap_indices).
+    indices : array, shape (n_boot, n), optional
+        Precomputed bootstrap indices, overriding n_boot/random_state.
+    batch_size : int, optional
+        Bootstrap samples per batch (default: bounded by BOOTSTRAP_BATCH_ELEMENTS).
+
+    Returns
+    -------
+    rho, ci_low, ci_high : arrays of shape (k, k), NaN if n < 3
+    """
+    X = np.asarray(X, dtype=float)
+    n, k = X.shape
+    if n < 3:
+        nan = np.full((k, k), np.nan)
+        return nan, nan.copy(), nan.copy()
+
+    rho = spearman_matrix(X)
+    if indices is None:
+        indices = bootstrap_indices(n, n_boot, random_state)
+    n_boot = len(indices)
+    if batch_size is None:
+        batch_size = max(1, BOOTSTRAP_BATCH_ELEMENTS // max(1, n * k))
+
+    boot = np.empty((n_boot, k, k))
+    for start in range(0, n_boot, batch_size):
+        idx = indices[start:start + batch_size]
+        # (b, n, k)：按行重采样后逐列排名
+        boot[start:start + len(idx)] = corr_on_ranks(rank_columns(X[idx], axis=1))
+
+    alpha = (100 - ci) / 2
+    with np.errstate(invalid='ignore'):
+        ci_low = np.nanpercentile(boot, alpha, axis=0)
+        ci_high = np.nanpercentile(boot, 100 - alpha, axis=0)
+    return rho, ci_low, ci_high
+
+
+class RollingSpearman:
+    """
+    Spearman's rho of a sliding window, updated one row at a time.
+
+    The window keeps the raw values, the average ranks of every row and the
+    rank sums and cross-products.  When a row leaves or enters, the ranks of
+    the other rows move by 0, ±0.5 (ties) or ±1, so ranks and cross-products
+    are updated in O(window × k) without re-sorting.  Ranks are half-integers,
+    so the running sums stay exact in float64.
+    """
+
+    def __init__(self, X):
+        X = np.asarray(X, dtype=float)
+        if not np.isfinite(X).all():
+            raise ValueError("RollingSpearman requires finite values")
+        self.values = X.copy()
+        self.ranks = rank_columns(X, axis=0)
+        self.rank_sum = self.ranks.sum(axis=0)
+        self.cross = self.ranks.T @ self.ranks
+        self.oldest = 0  # 环形缓冲区中最早进入窗口的行
+
+    def _shift(self, delta):
+        # (R + Δ)ᵀ(R + Δ) = RᵀR + RᵀΔ + ΔᵀR + ΔᵀΔ
+        RtD = self.ranks.T @ delta
+        self.cross += RtD + RtD.T + delta.T @ delta
+        self.rank_sum += delta.sum(axis=0)
+        self.ranks += delta
+
+    def slide(self, x):
+        """Drop the oldest row of the window and append row x, shape (k,)."""
+        x = np.asarray(x, dtype=float)
+        if not np.isfinite(x).all():
+            raise ValueError("RollingSpearman requires finite values")
+        p = self.oldest
+        r_old = self.ranks[p].copy()
+        v_old = self.values[p].copy()
+
+        # 移出第 p 行：较大值的秩 -1，与之相等的值 -0.5
+        # 移入新行：较大值的秩 +1，与之相等的值 +0.5；两者合并为一次更新
+        self.cross -= np.outer(r_old, r_old)
+        self.rank_sum -= r_old
+        self.ranks[p] = 0.0
+        self.values[p] = np.nan
+        less = (self.values < x).sum(axis=0)
+        equal = (self.values == x).sum(axis=0)
+        self._shift((self.values > x) + 0.5 * (self.values == x)
+                    - (self.values > v_old) - 0.5 * (self.values == v_old))
+        r_new = less + equal / 2.0 + 1.0
+        self.cross += np.outer(r_new, r_new)
+        self.rank_sum += r_new
+        self.ranks[p] = r_new
+        self.values[p] = x
+        self.oldest = (p + 1) % len(self.values)
+
+    def rho(self):
+        """Spearman's rho matrix of the current window, shape (k, k)."""
+        w = len(self.values)
+        cov = self.cross - np.outer(self.rank_sum, self.rank_sum) / w
+        sd = np.sqrt(np.clip(np.diag(cov), 0.0, None))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rho = cov / np.outer(sd, sd)
+        return np.clip(rho, -1.0, 1.0)
+
+
+def rolling_spearman_rho(X, window, step=1):
+    """
+    Spearman's rho matrices of all sliding windows of X, computed incrementally.
+
+    Parameters
+    ----------
+    X : array, shape (n, k)
+        Rows already sorted along the sliding axis.
+    window : int
+    step : int
+
+    Returns
+    -------
+    starts : int array, shape (m,)
+        First row of each window.
+    rho : array, shape (m, k, k)
+    """
+    X = np.asarray(X, dtype=float)
+    n = len(X)
+    if window > n:
+        raise ValueError(f"window={window} is larger than n={n}")
+    starts = np.arange(0, n - window + 1, step)
+    rho = np.empty((len(starts), X.shape[1], X.shape[1]))
+    if step >= window:
+        # 相邻窗口不重叠，增量更新没有收益
+        for i, start in enumerate(starts):
+            rho[i] = spearman_matrix(X[start:start + window])
+        return starts, rho
+
+    state = RollingSpearman(X[:window])
+    rho[0] = state.rho()
+    for i in range(1, len(starts)):
+        for row in range(starts[i - 1] + window, starts[i] + window):
+            state.slide(X[row])
+        rho[i] = state.rho()
+    return starts, rho
+
+
+def rolling_sensitivity(X, sort_values, windows=range(8, 21), steps=(1,)):
+    """
+    Rolling Spearman rho for a grid of window sizes and steps.
+
+    Parameters
+    ----------
+    X : array, shape (n, k)
+        Variables, rows sorted by sort_values.
+    sort_values : array, shape (n,)
+        Sorting variable; the mean over each window is its centre.
+    windows : iterable of int
+    steps : iterable of int
+
+    Returns
+    -------
+    list of (window, step, S_center array (m,), rho array (m, k, k))
+    """
+    X = np.asarray(X, dtype=float)
+    cumsum = np.concatenate([[0.0], np.cumsum(np.asarray(sort_values, dtype=float))])
+    results = []
+    for window in windows:
+        if window > len(X):
+            continue
+        for step in steps:
+            starts, rho = rolling_spearman_rho(X, window, step)
+            S_center = (cumsum[starts + window] - cumsum[starts]) / window
+            results.append((window, step, S_center, rho))
+    return results
+
+
+def task_seed(random_state, start, pair_index):
+    """Seed of one (window, pair) bootstrap task, independent of how tasks are scheduled."""
+    return np.random.SeedSequence([0 if random_state is None else random_state, start, pair_index])
+
+
+def window_pairs_bootstrap(X, pairs, start, n_boot=2000, ci=95, random_state=42):
+    """
+    Bootstrap Spearman of several variable pairs of one window, each with its own seed.
+
+    Parameters
+    ----------
+    X : array, shape (window, k)
+    pairs : list of (i, j) column indices
+    start : int
+        First row of the window, part of the task seed.
+    n_boot, ci, random_state
+        As in bootstrap_spearman; pair p draws its indices from
+        task_seed(random_state, start, p).
+
+    Returns
+    -------
+    array, shape (len(pairs), 3): rho, ci_low, ci_high per pair
+    """
+    X = np.asarray(X, dtype=float)
+    n = len(X)
+    out = np.empty((len(pairs), 3))
+    for p, (i, j) in enumerate(pairs):
+        indices = None
+        if n >= 3:
+            indices = np.random.default_rng(task_seed(random_state, start, p)).integers(0, n, size=(n_boot, n))
+        rho, lo, hi = bootstrap_spearman(X[:, [i, j]], ci=ci, indices=indices)
+        out[p] = rho[0, 1], lo[0, 1], hi[0, 1]
+    return out
+
+
+def parallel_rolling_bootstrap(X, window, step=1, pairs=None, n_boot=2000, ci=95, random_state=42, n_jobs=None):
+    """
+    Rolling bootstrap Spearman with windows fanned out over a process pool.
+
+    Every (window, pair) task seeds its bootstrap from random_state, the
+    window start and the pair index, so results do not depend on n_jobs.
+
+    Parameters
+    ----------
+    X : array, shape (n, k)
+        Rows already sorted along the sliding axis.
+    window, step : int
+    pairs : list of (i, j), optional
+        Column pairs (default: all i < j).
+    n_boot, ci, random_state
+        As in bootstrap_spearman.
+    n_jobs : int, optional
+        Worker processes; 1 runs serially, None uses all CPUs.
+
+    Returns
+    -------
+    starts : int array, shape (m,)
+    stats : array, shape (m, len(pairs), 3): rho, ci_low, ci_high
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from itertools import combinations
+
+    X = np.asarray(X, dtype=float)
+    n, k = X.shape
+    if window > n:
+        raise ValueError(f"window={window} is larger than n={n}")
+    if pairs is None:
+        pairs = list(combinations(range(k), 2))
+    starts = np.arange(0, n - window + 1, step)
+    args = [(X[start:start + window], pairs, int(start), n_boot, ci, random_state) for start in starts]
+    if n_jobs == 1:
+        stats = [window_pairs_bootstrap(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            stats = list(pool.map(window_pairs_bootstrap, *zip(*args)))
+    return starts, np.stack(stats) if stats else np.empty((0, len(pairs), 3))
+
+
+def spearman_pvalues(rho, n):
+    """Two-sided p-values of Spearman's rho from the t distribution, as stats.spearmanr."""
+    from scipy import stats
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = rho * np.sqrt((n - 2) / ((1.0 - rho) * (1.0 + rho)))
+    return 2 * stats.t.sf(np.abs(t), n - 2)
+
+
+def permutation_pvalues(R, rho, permutations=9999, seed=None, batch_size=None):
+    """
+    Two-sided permutation p-values of all pairwise Spearman correlations.
+
+    Each permutation shuffles the rows of the (centered) rank matrix; one
+    product ``Rᵀ R[π]`` gives the permuted rho of every pair (i, j) at once,
+    with column j shuffled against column i.
+
+    Parameters
+    ----------
+    R : array, shape (n, k)
+        Column ranks.
+    rho : array, shape (k, k)
+        Observed Spearman's rho.
+    permutations : int
+    seed : int or numpy SeedSequence, optional
+    batch_size : int, optional
+        Permutations per batch (default: bounded by BOOTSTRAP_BATCH_ELEMENTS).
+
+    Returns
+    -------
+    array, shape (k, k): (#{|rho_perm| >= |rho|} + 1) / (permutations + 1),
+    symmetric; the diagonal is not meaningful
+    """
+    n, k = R.shape
+    Rc = R - R.mean(axis=0)
+    sd = np.sqrt((Rc * Rc).sum(axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Rn = Rc / sd
+    if batch_size is None:
+        batch_size = max(1, BOOTSTRAP_BATCH_ELEMENTS // max(1, n * k))
+    # 浮点误差容限，避免观测值本身因舍入被判为更小
+    threshold = np.abs(rho) - 1e-12
+
+    rng = np.random.default_rng(seed)
+    larger = np.zeros((k, k))
+    for start in range(0, permutations, batch_size):
+        b = min(batch_size, permutations - start)
+        idx = rng.permuted(np.broadcast_to(np.arange(n), (b, n)), axis=1)
+        # (b, n, k) -> (n, b*k)：所有置换一次矩阵乘法
+        shuffled = Rn[idx].transpose(1, 0, 2).reshape(n, b * k)
+        rho_perm = (Rn.T @ shuffled).reshape(k, b, k)
+        larger += (np.abs(rho_perm) >= threshold[:, None, :]).sum(axis=1)
+    # (i, j) 与 (j, i) 使用上三角的同一结果，保持对称
+    larger = np.triu(larger, k=1) + np.triu(larger, k=1).T
+    return (larger + 1.0) / (permutations + 1.0)
+
+
+def bh_adjust(p):
+    """
+    Benjamini-Hochberg adjusted p-values (q-values); NaN entries are ignored.
+
+    Parameters
+    ----------
+    p : array of any shape
+
+    Returns
+    -------
+    array of the same shape
+    """
+    p = np.asarray(p, dtype=float)
+    q = np.full(p.shape, np.nan)
+    valid = ~np.isnan(p)
+    m = valid.sum()
+    if m == 0:
+        return q
+    order = np.argsort(p[valid])
+    ranked = p[valid][order] * m / np.arange(1, m + 1)
+    # 从大到小取累计最小值，保证单调
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    adjusted = np.empty(m)
+    adjusted[order] = np.minimum(ranked, 1.0)
+    q[valid] = adjusted
+    return q
+
+
+def correlation_matrix_test(X, permutations=0, seed=None, fdr=False):
+    """
+    Spearman's rho of all column pairs with asymptotic or permutation p-values.
+
+    Every column is ranked once and the rho matrix comes from one matrix
+    product, so tract-level tables with hundreds of thousands of rows are cheap.
+
+    Parameters
+    ----------
+    X : array, shape (n, k)
+    permutations : int
+        If > 0, p-values come from this many shared row permutations instead of
+        the t distribution.
+    seed : int, optional
+        Seed of the permutations.
+    fdr : bool
+        Benjamini-Hochberg adjust the p-values over the k(k-1)/2 distinct pairs.
+
+    Returns
+    -------
+    rho, p_values : arrays of shape (k, k); the diagonal has rho 1 and p 0
+    (NaN for constant columns)
+    """
+    X = np.asarray(X, dtype=float)
+    n, k = X.shape
+    R = rank_columns(X, axis=0)
+    rho = corr_on_ranks(R)
+    if permutations:
+        p_values = permutation_pvalues(R, rho, permutations=permutations, seed=seed)
+    else:
+        p_values = spearman_pvalues(rho, n)
+
+    if fdr:
+        # 只对上三角的不同变量对做校正，再对称回填
+        iu = np.triu_indices(k, k=1)
+        adjusted = np.zeros((k, k))
+        adjusted[iu] = bh_adjust(p_values[iu])
+        p_values = adjusted + adjusted.T
+    constant = np.isnan(np.diag(rho))
+    np.fill_diagonal(p_values, np.where(constant, np.nan, 0.0))
+    np.fill_diagonal(rho, np.where(constant, np.nan, 1.0))
+    return rho, p_values
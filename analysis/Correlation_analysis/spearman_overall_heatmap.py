@@ -14,24 +14,19 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
-from scipy import stats
 from data_process.data_reader import data_reader
+from analysis.Correlation_analysis.spearman_engine import correlation_matrix_test
 
 
-def calculate_correlations(data):
-    """Compute Spearman correlation matrix and p-values."""
-    variables = list(data.columns)
-    n = len(variables)
-    correlation_matrix = np.zeros((n, n))
-    p_values = np.zeros((n, n))
-
-    for i, var1 in enumerate(variables):
-        for j, var2 in enumerate(variables):
-            corr, p_value = stats.spearmanr(data[var1], data[var2])
-            correlation_matrix[i, j] = corr
-            p_values[i, j] = p_value
+def calculate_correlations(data, permutations=0, seed=None, fdr=False):
+    """
+    Compute Spearman correlation matrix and p-values.
 
-    return correlation_matrix, p_values
+    Columns are ranked once and rho comes from one matrix product. With
+    permutations > 0 the p-values come from a shared batch of row permutations;
+    fdr=True applies the Benjamini-Hochberg adjustment over the variable pairs.
+    """
+    return correlation_matrix_test(data.to_numpy(dtype=float), permutations=permutations, seed=seed, fdr=fdr)
 
 
 def create_correlation_heatmap(correlation_matrix, p_values, variables, save_path, dpi=300):
@@ -101,7 +96,7 @@ def create_correlation_heatmap(correlation_matrix, p_values, variables, save_pat
     plt.close()
 
 
-def run_overall_spearman_heatmap(project_root=None, save_dir=None, dpi=300):
+def run_overall_spearman_heatmap(project_root=None, save_dir=None, dpi=300, permutations=0, seed=None, fdr=False):
     """
     Run Spearman correlation analysis on all 30 cities and save one heatmap.
 
@@ -113,6 +108,12 @@ def run_overall_spearman_heatmap(project_root=None, save_dir=None, dpi=300):
         Directory to save the heatmap. If None, uses results_Quartile/spearman_overall.
     dpi : int
         Figure DPI for saved image (default 300).
+    permutations : int
+        Number of permutations for permutation p-values (0 uses the t distribution).
+    seed : int, optional
+        Seed of the permutations.
+    fdr : bool
+        Benjamini-Hochberg adjust the p-values before marking significance.
     """
     if project_root is None:
         project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
@@ -120,16 +121,10 @@ def run_overall_spearman_heatmap(project_root=None, save_dir=None, dpi=300):
     file_path = os.path.join(project_root, "data", "SSI_golbal_data.csv")
     city_list = data_reader(file_path, 4, classification_strategy='quartiles_4')
 
-    df = pd.DataFrame({
-        'SES': [c.theme1 for c in city_list],
-        'HCD': [c.theme2 for c in city_list],
-        'MSL': [c.theme3 for c in city_list],
-        'HT': [c.theme4 for c in city_list],
-        'Comp.': [c.themes for c in city_list],
-    })
+    df = pd.DataFrame(city_list.theme_matrix(), columns=['SES', 'HCD', 'MSL', 'HT', 'Comp.'])
 
     variables = ['SES', 'HCD', 'MSL', 'HT', 'Comp.']
-    corr_matrix, p_values = calculate_correlations(df)
+    corr_matrix, p_values = calculate_correlations(df[variables], permutations=permutations, seed=seed, fdr=fdr)
 
     if save_dir is None:
         save_dir = os.path.join(project_root, "results_Quartile", "spearman_overall")
@@ -0,0 +1,288 @@
+# Getis-Ord Gi* 热点分析（替代 ArcGIS Pro 的 Optimized Hot Spot Analysis）
+# 输出与 ArcGIS OHSA 结果同名同字段的 shapefile，可直接交给 OHSA_Filter_result.py 和 Over_lap_OHSA_result.py
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+from scipy import sparse, stats
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(current_dir, "../.."))
+sys.path.append(project_root)
+
+from data_process.spatial_weights import (WEIGHT_BUILDERS, build_distance_band, load_or_build_flow_weights,
+                                          load_or_build_weights, od_matrix_path, row_standardize)
+
+themes = ['theme1', 'theme2', 'theme3', 'theme4']
+
+# Gi_Bin 等级与对应的显著性水平（99%、95%、90% 置信度）
+GI_BIN_LEVELS = [(3, 0.01), (2, 0.05), (1, 0.10)]
+# 'B'：权重原样使用；'R'：加入自身权重后按行标准化
+GI_TRANSFORMS = ('B', 'R')
+# 自身权重取每行最大的邻居权重（随流量量级缩放）
+SELF_WEIGHT_ROW_MAX = 'max'
+
+
+def gi_star(Y, W, self_weight=1.0, transform='B'):
+    """
+    Getis-Ord Gi* z-scores for several variables with one sparse mat-mat product.
+
+    The focal feature is added to its own neighbourhood with ``self_weight``
+    (W* = W + self_weight * I); with ``transform='R'`` W* is row-standardized
+    afterwards.  Only W* is built as in ``esda.G_Local(star=self_weight,
+    transform=...)``: the z-scores always use the general-weights moments of
+    Ord & Getis (1995).  For binary W they equal esda's with
+    ``transform='B'``; for row-standardized W* they differ from esda's, whose
+    moments assume binary weights.
+
+    Like OHSA with null features, tracts with a non-finite value are left out
+    of a column: it is computed over its finite rows and the weights among
+    them, and the excluded tracts get NaN z and p (Gi_Bin 0 in gi_bin).
+
+    Parameters
+    ----------
+    Y : array, shape (n, k)
+    W : scipy.sparse matrix, shape (n, n)
+        Weights without self-neighbours (binary, or raw flows).
+    self_weight : float or 'max'
+        Weight of the focal feature before the transform; 'max' uses each
+        row's largest neighbour weight (1 for binary W, 0 for islands).
+    transform : str
+        'B' keeps the weights as given, 'R' row-standardizes W*.
+
+    Returns
+    -------
+    z : array, shape (n, k)
+    p : array, shape (n, k)
+        Two-tailed normal p-values.
+    n_neighbors : int array, shape (n, k)
+        Neighbours per feature, including the feature itself (0 if excluded).
+    """
+    if transform not in GI_TRANSFORMS:
+        raise ValueError(f"transform must be one of: {', '.join(GI_TRANSFORMS)}")
+    Y = np.asarray(Y, dtype=float)
+    n, k = Y.shape
+    W = W.tocsr()
+    z = np.full((n, k), np.nan)
+    n_neighbors = np.zeros((n, k), dtype=np.int32)
+    # 缺失模式相同的列共用一个子矩阵（通常所有列都完整，只算一次）
+    patterns, pattern_of_column = np.unique(np.isfinite(Y), axis=1, return_inverse=True)
+    pattern_of_column = np.ravel(pattern_of_column)
+    for j, finite in enumerate(patterns.T):
+        rows = np.flatnonzero(finite)
+        columns = np.flatnonzero(pattern_of_column == j)
+        if len(rows) < 2:
+            continue
+        W_rows = W if len(rows) == n else W[rows][:, rows]
+        z_rows, n_rows = _gi_star_finite(Y[np.ix_(rows, columns)], W_rows, self_weight, transform)
+        z[np.ix_(rows, columns)] = z_rows
+        n_neighbors[np.ix_(rows, columns)] = n_rows[:, None]
+    p = 2 * stats.norm.sf(np.abs(z))
+    return z, p, n_neighbors
+
+
+def _gi_star_finite(Y, W, self_weight, transform):
+    # 所有值均有限时的 Gi*：返回 z 与含自身的邻居数
+    n = Y.shape[0]
+    if isinstance(self_weight, str):
+        if self_weight != SELF_WEIGHT_ROW_MAX:
+            raise ValueError(f"self_weight must be a number or '{SELF_WEIGHT_ROW_MAX}'")
+        self_weight = W.max(axis=1).toarray().ravel()
+    else:
+        self_weight = np.full(n, float(self_weight))
+    W_star = (W + sparse.diags(self_weight)).tocsr()
+    W_star.eliminate_zeros()
+    if transform == 'R':
+        W_star = row_standardize(W_star)
+    w_sum = np.asarray(W_star.sum(axis=1)).ravel()
+    w_sq_sum = np.asarray(W_star.multiply(W_star).sum(axis=1)).ravel()
+
+    x_bar = Y.mean(axis=0)
+    s = np.sqrt((Y * Y).mean(axis=0) - x_bar ** 2)
+    numerator = W_star @ Y - np.outer(w_sum, x_bar)
+    denominator = np.outer(np.sqrt((n * w_sq_sum - w_sum ** 2) / (n - 1)), s)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return numerator / denominator, np.diff(W_star.indptr)
+
+
+def fdr_mask(p, alpha):
+    """
+    Benjamini-Hochberg false discovery rate correction.
+
+    Returns
+    -------
+    bool array, True where p stays significant at level alpha
+    """
+    p = np.asarray(p, dtype=float)
+    valid = ~np.isnan(p)
+    n = valid.sum()
+    mask = np.zeros(p.shape, dtype=bool)
+    if n == 0:
+        return mask
+    p_sorted = np.sort(p[valid])
+    below = p_sorted <= alpha * np.arange(1, n + 1) / n
+    if below.any():
+        p_crit = p_sorted[np.nonzero(below)[0][-1]]
+        mask[valid] = p[valid] <= p_crit
+    return mask
+
+
+def gi_bin(z, p, fdr=True):
+    """
+    Gi_Bin as in ArcGIS: ±3/±2/±1 for hot/cold spots at 99/95/90% confidence, 0 otherwise.
+
+    Parameters
+    ----------
+    z, p : arrays of the same shape (n,) or (n, k)
+    fdr : bool
+        Apply the FDR correction per column, as OHSA does.
+    """
+    z = np.asarray(z)
+    p = np.asarray(p)
+    p2 = p.reshape(len(p), -1)
+    bins = np.zeros(p2.shape, dtype=int)
+    for j in range(p2.shape[1]):
+        # 从 90% 到 99% 依次覆盖，保留最高置信等级
+        for level, alpha in reversed(GI_BIN_LEVELS):
+            significant = fdr_mask(p2[:, j], alpha) if fdr else p2[:, j] <= alpha
+            bins[significant, j] = level
+    return bins.reshape(p.shape) * np.sign(np.nan_to_num(z)).astype(int)
+
+
+def city_weights(gdf, city_name, weights='distance_band', threshold=None, weights_cache_dir=None, od_dir=None,
+                 flow_symmetric=True, flow_threshold=None):
+    """
+    Weights of a projected city GeoDataFrame, from the weights cache if given.
+
+    Distance-band weights depend on the projection, so they are cached under
+    ``<city>_EPSG5070``; a custom threshold gets its own cache entry.
+    ``weights='flow'`` gives the raw mobility weights from the city's OD
+    matrix in ``od_dir`` (see spatial_weights.build_flow_weights); gi_star
+    adds the self-weight and row-standardizes them (``transform='R'``).
+    """
+    if weights == 'flow':
+        if od_dir is None:
+            raise ValueError("od_dir is required for flow weights")
+        W, _ = load_or_build_flow_weights(gdf, od_matrix_path(od_dir, city_name), weights_cache_dir,
+                                          f'{city_name}_EPSG5070', symmetric=flow_symmetric, threshold=flow_threshold)
+        return W
+    if weights not in WEIGHT_BUILDERS:
+        raise ValueError(f"weights must be one of {sorted(WEIGHT_BUILDERS) + ['flow']}")
+    kind, builder = weights, None
+    if weights == 'distance_band' and threshold is not None:
+        kind = f'distance_band_{threshold:g}'
+        builder = lambda g: build_distance_band(g, threshold)
+    if weights_cache_dir is None:
+        return (builder or WEIGHT_BUILDERS[kind])(gdf)
+    W, _ = load_or_build_weights(gdf, weights_cache_dir, f'{city_name}_EPSG5070', kind=kind, builder=builder)
+    return W
+
+
+def process_city(input_geojson, output_folder, themes=themes, weights='distance_band', threshold=None,
+                 weights_cache_dir=None, fdr=True, od_dir=None, flow_symmetric=True, flow_threshold=None,
+                 flow_self_weight=SELF_WEIGHT_ROW_MAX):
+    """
+    Run Gi* for all themes of one city and write one OHSA-style shapefile per theme.
+
+    Output files are named ``<city>_census_tract_<theme>_OHSA_result.shp`` with
+    the fields SOURCE_ID, <theme>, GiZScore, GiPValue, NNeighbors and Gi_Bin.
+
+    Parameters
+    ----------
+    input_geojson : str
+        Census-tract GeoJSON (``<city>_census_tract.geojson``).
+    output_folder : str
+        Folder for the shapefiles.
+    themes : list[str]
+        Theme columns to analyze.
+    weights : str
+        'distance_band' (OHSA default), 'queen' or 'flow' (mobility weights).
+    threshold : float, optional
+        Distance band in meters (EPSG:5070); OHSA-style default if None.
+    weights_cache_dir : str, optional
+        Folder of the persistent spatial weights cache.
+    fdr : bool
+        Apply the FDR correction.
+    od_dir : str, optional
+        Folder of the ``<City>_od.npz`` OD matrices (flow weights only).
+    flow_symmetric, flow_threshold
+        Symmetrize / threshold the flow weights.
+    flow_self_weight : float or 'max'
+        Weight of the focal tract added before the flow weights are
+        row-standardized (esda ``star``).  The default 'max' gives every tract
+        the weight of its strongest flow neighbour, so it scales with the
+        trip counts; a number is a fixed weight in flow units (trips), which
+        next to rows of hundreds of trips leaves the focal tract almost out.
+
+    Returns
+    -------
+    list of output paths
+    """
+    base_name = Path(input_geojson).stem  # <city>_census_tract
+    gdf = gpd.read_file(input_geojson)
+    if gdf.crs is None:
+        gdf.set_crs(epsg=4326, inplace=True)
+    gdf = gdf.to_crs(epsg=5070)
+
+    W = city_weights(gdf, base_name, weights, threshold, weights_cache_dir, od_dir, flow_symmetric, flow_threshold)
+    present = [t for t in themes if t in gdf.columns]
+    if weights == 'flow':
+        z, p, n_neighbors = gi_star(gdf[present].to_numpy(dtype=float), W, flow_self_weight, transform='R')
+    else:
+        z, p, n_neighbors = gi_star(gdf[present].to_numpy(dtype=float), W)
+    bins = gi_bin(z, p, fdr=fdr)
+
+    source_id = gdf['id'].to_numpy() if 'id' in gdf.columns else np.arange(len(gdf))
+    os.makedirs(output_folder, exist_ok=True)
+    outputs = []
+    for j, theme in enumerate(present):
+        result = gpd.GeoDataFrame({
+            'SOURCE_ID': source_id,
+            theme: gdf[theme].to_numpy(),
+            'GiZScore': z[:, j],
+            'GiPValue': p[:, j],
+            'NNeighbors': n_neighbors[:, j],
+            'Gi_Bin': bins[:, j],
+        }, geometry=gdf.geometry.to_numpy(), crs=gdf.crs)
+        output_path = os.path.join(output_folder, f"{base_name}_{theme}_OHSA_result.shp")
+        result.to_file(output_path)
+        outputs.append(output_path)
+    return outputs
+
+
+def batch_process_directory(input_dir, output_dir, n_jobs=None, **kwargs):
+    """
+    Run process_city for every census-tract GeoJSON in a directory, in parallel over cities.
+
+    Parameters
+    ----------
+    input_dir : str
+        Directory of ``<city>_census_tract.geojson`` files.
+    output_dir : str
+        Directory for the OHSA-style shapefiles.
+    n_jobs : int, optional
+        Worker processes; 1 runs serially, None uses all CPUs.
+    **kwargs
+        Passed to process_city.
+    """
+    files = sorted(str(f) for f in Path(input_dir).glob('*.geojson'))
+    if n_jobs == 1:
+        results = [process_city(f, output_dir, **kwargs) for f in files]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(process_city, f, output_dir, **kwargs) for f in files]
+            results = [future.result() for future in futures]
+    for f, outputs in zip(files, results):
+        print(f"Processed {Path(f).name} -> {len(outputs)} theme shapefiles")
+
+
+if __name__ == "__main__":
+    # Example usage
+    input_directory = r"D:\Code\Social_segregation\data\Census_tract"
+    output_directory = r"D:\Code\Social_segregation\data\Census_tract_shp_EPSG5070_OHSA_result"
+    weights_cache_directory = r"D:\Code\Social_segregation\data\weights_cache"
+    batch_process_directory(input_directory, output_directory, weights_cache_dir=weights_cache_directory)
@@ -1,8 +1,19 @@
 import os
-import geopandas as gpd
+import sys
 import re
 from collections import defaultdict
 
+import pandas as pd
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(current_dir, "../.."))
+sys.path.append(project_root)
+
+from data_process.hotspot_reader import read_city_hotspots
+
+GI_BINS = [-3, -2, -1, 0, 1, 2, 3]
+
+
 def process_city_shapefiles(folder_path, output_folder):
     # 用于分组
     city_files = defaultdict(list)
@@ -14,29 +25,40 @@ def process_city_shapefiles(folder_path, output_folder):
             if m:
                 city = m.group(1)
                 city_files[city].append(f)
-    print("分组结果：", city_files)  # 调试用
     for city, files in city_files.items():
-        print(f"{city} 包含文件：{files}")  # 调试用
         if len(files) != 4:
             print(f"{city} 主题数量不足4个，实际为{len(files)}")
             continue
-        gdfs = [gpd.read_file(os.path.join(folder_path, shp)) for shp in files]
-        print("字段名：", gdfs[0].columns)  # 调试用
-        all_tracts = gdfs[0][['SOURCE_ID', 'geometry']].copy()
-        for val in [-3, -2, -1, 0, 1, 2, 3]:
-            all_tracts[str(val)] = 0
-        for gdf in gdfs:
-            for idx, row in gdf.iterrows():
-                fid = row['SOURCE_ID']
-                gi_bin = row['Gi_Bin']
-                all_tracts.loc[all_tracts['SOURCE_ID'] == fid, str(gi_bin)] += 1
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
-        out_path = os.path.join(output_folder, f"{city}_summary.shp")
-        all_tracts.to_file(out_path)
-        print(f"{city} 处理完成，输出：{out_path}")
+        summarize_city(city, [os.path.join(folder_path, shp) for shp in files], output_folder)
+
+
+def summarize_city(city, paths, output_folder):
+    """
+    Count, for every tract of one city, how many theme files put it in each Gi_Bin.
+
+    :param city: city name (output ``<city>_summary.shp``)
+    :param paths: OHSA result shapefiles of the four themes
+    :param output_folder: folder of the summary shapefile
+    :return: GeoDataFrame with SOURCE_ID, geometry and one count column per Gi_Bin
+    """
+    # 只读属性表；几何仅从第一个主题文件读取一次
+    gdfs, all_tracts = read_city_hotspots(paths, with_geometry=True)
+    # 四个主题一次拼接，按 SOURCE_ID × Gi_Bin 交叉计数，再按 SOURCE_ID 接回几何
+    bins = pd.concat([gdf[['SOURCE_ID', 'Gi_Bin']] for gdf in gdfs], ignore_index=True)
+    counts = pd.crosstab(bins['SOURCE_ID'], bins['Gi_Bin']).reindex(columns=GI_BINS, fill_value=0)
+    counts = counts.reindex(all_tracts['SOURCE_ID'], fill_value=0)
+    for val in GI_BINS:
+        all_tracts[str(val)] = counts[val].to_numpy()
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    out_path = os.path.join(output_folder, f"{city}_summary.shp")
+    all_tracts.to_file(out_path)
+    print(f"{city} 处理完成，输出：{out_path}")
+    return all_tracts
+
 
 # 用法
-input_folder = r"D:\Code\Social_segregation\data\Census_tract_shp_EPSG5070_OHSA_tertile_filter_result"
-output_folder = r"D:\Code\Social_segregation\data\Overlap_EPSG5070_OHSA_tertile_filter_result"
-process_city_shapefiles(input_folder, output_folder)
+if __name__ == '__main__':
+    input_folder = r"D:\Code\Social_segregation\data\Census_tract_shp_EPSG5070_OHSA_tertile_filter_result"
+    output_folder = r"D:\Code\Social_segregation\data\Overlap_EPSG5070_OHSA_tertile_filter_result"
+    process_city_shapefiles(input_folder, output_folder)
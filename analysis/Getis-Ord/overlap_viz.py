@@ -1,6 +1,8 @@
 import os
 import json
-import geopandas as gpd
+from collections import defaultdict
+
+import numpy as np
 
 # 设定文件夹路径（示例路径，需替换为实际路径）
 base_path = r"D:\Code\Social_segregation\data\Z_score_Corrected"  # 你的数据所在路径
@@ -12,72 +14,114 @@ folders = [
     #"Getis_Ord_themes_Results"
 ]
 
-# 存储每个城市的数据
-data_by_city = {}
-
-# 遍历所有主题文件夹
-for folder in folders:
-    folder_path = os.path.join(base_path, folder)
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".geojson"):
-            city_name = filename.replace("_census_tract_getis_ord_results.geojson", "")
-            file_path = os.path.join(folder_path, filename)
-
-            # 读取 GeoJSON 文件
-            with open(file_path, "r") as f:
-                geojson_data = json.load(f)
-
-            # 初始化城市数据
-            if city_name not in data_by_city:
-                data_by_city[city_name] = {}
-
-            # 遍历所有 Census Tract
-            for feature in geojson_data["features"]:
-                tract_id = feature["properties"].get("id")
-                if tract_id not in data_by_city[city_name]:
-                    data_by_city[city_name][tract_id] = {
-                        "Coldspot_90%": 0, "Coldspot_95%": 0, "Coldspot_99%": 0,
-                        "Hotspot_90%": 0, "Hotspot_95%": 0, "Hotspot_99%": 0,
-                        "geometry": feature["geometry"]
-                    }
-
-                # 计算冷点（coldspot）
-                for conf in ["90%", "95%", "99%"]:
-                    data_by_city[city_name][tract_id][f"Coldspot_{conf}"] += int(
-                        feature["properties"].get(f"{folder.split('_')[-2]}_coldspot_{conf}", False))
-
-                # 计算热点（hotspot）
-                for conf in ["90%", "95%", "99%"]:
-                    data_by_city[city_name][tract_id][f"Hotspot_{conf}"] += int(
-                        feature["properties"].get(f"{folder.split('_')[-2]}_hotspot_{conf}", False))
-
-# 生成新的 GeoJSON 文件
-output_folder = os.path.join(base_path, "Processed_Results")
-os.makedirs(output_folder, exist_ok=True)
-
-for city, tracts in data_by_city.items():
-    output_geojson = {
-        "type": "FeatureCollection",
-        "features": []
-    }
-
-    for tract_id, data in tracts.items():
-        feature = {
-            "type": "Feature",
-            "properties": {
-                "Coldspot_90%": data["Coldspot_90%"],
-                "Coldspot_95%": data["Coldspot_95%"],
-                "Coldspot_99%": data["Coldspot_99%"],
-                "Hotspot_90%": data["Hotspot_90%"],
-                "Hotspot_95%": data["Hotspot_95%"],
-                "Hotspot_99%": data["Hotspot_99%"]
-            },
-            "geometry": data["geometry"]
-        }
-        output_geojson["features"].append(feature)
-
-    # 保存文件
-    output_path = os.path.join(output_folder, f"{city}_processed.geojson")
+FILE_SUFFIX = "_census_tract_getis_ord_results.geojson"
+CONFIDENCES = ["90%", "95%", "99%"]
+# 输出字段及其在主题属性中的名称（<theme>_coldspot_90% 等）
+COUNT_FIELDS = [f"Coldspot_{conf}" for conf in CONFIDENCES] + [f"Hotspot_{conf}" for conf in CONFIDENCES]
+FLAG_KEYS = [f"coldspot_{conf}" for conf in CONFIDENCES] + [f"hotspot_{conf}" for conf in CONFIDENCES]
+
+
+def discover_city_files(base_path, folders):
+    """
+    Group the theme GeoJSON files by city, listing each theme folder once.
+
+    Returns
+    -------
+    dict city -> list of (theme, file path) in folder order
+    """
+    city_files = defaultdict(list)
+    for folder in folders:
+        theme = folder.split('_')[-2]
+        folder_path = os.path.join(base_path, folder)
+        for filename in os.listdir(folder_path):
+            if filename.endswith(".geojson"):
+                city_name = filename.replace(FILE_SUFFIX, "")
+                city_files[city_name].append((theme, os.path.join(folder_path, filename)))
+    return city_files
+
+
+def accumulate_city(theme_files):
+    """
+    Count hotspot/coldspot flags of one city over its theme files.
+
+    Only one theme's GeoJSON is held at a time.  Geometry is taken from the
+    first theme a tract appears in; the counters are a NumPy array indexed by
+    the tract's row.
+
+    Returns
+    -------
+    tract_ids : list
+    geometries : list of GeoJSON geometry dicts
+    counts : int array, shape (n_tracts, 6), columns as COUNT_FIELDS
+    """
+    tract_index = {}
+    tract_ids = []
+    geometries = []
+    rows_by_theme = []
+    flags_by_theme = []
+    for theme, file_path in theme_files:
+        with open(file_path, "r") as f:
+            features = json.load(f)["features"]
+
+        rows = np.empty(len(features), dtype=np.int64)
+        flags = np.zeros((len(features), len(FLAG_KEYS)), dtype=np.int64)
+        for i, feature in enumerate(features):
+            properties = feature["properties"]
+            tract_id = properties.get("id")
+            row = tract_index.get(tract_id)
+            if row is None:
+                row = tract_index[tract_id] = len(tract_ids)
+                tract_ids.append(tract_id)
+                geometries.append(feature["geometry"])
+            rows[i] = row
+            flags[i] = [int(properties.get(f"{theme}_{key}", False)) for key in FLAG_KEYS]
+        rows_by_theme.append(rows)
+        flags_by_theme.append(flags)
+        # 释放该主题的其余属性，只保留已记录的几何
+        del features
+
+    counts = np.zeros((len(tract_ids), len(COUNT_FIELDS)), dtype=np.int64)
+    for rows, flags in zip(rows_by_theme, flags_by_theme):
+        np.add.at(counts, rows, flags)
+    return tract_ids, geometries, counts
+
+
+def write_feature_collection(output_path, features):
+    """
+    Write a GeoJSON FeatureCollection feature by feature.
+
+    The output is the same text ``json.dump`` of the whole collection would produce.
+    """
     with open(output_path, "w") as f:
-        json.dump(output_geojson, f)
-    print(f"Processed file saved: {output_path}")
\ No newline at end of file
+        f.write('{"type": "FeatureCollection", "features": [')
+        for i, feature in enumerate(features):
+            if i:
+                f.write(', ')
+            json.dump(feature, f)
+        f.write(']}')
+
+
+def process_city(theme_files, output_path):
+    """Accumulate one city's theme files and write its processed GeoJSON."""
+    _, geometries, counts = accumulate_city(theme_files)
+    features = ({
+        "type": "Feature",
+        "properties": dict(zip(COUNT_FIELDS, map(int, row))),
+        "geometry": geometry
+    } for geometry, row in zip(geometries, counts))
+    write_feature_collection(output_path, features)
+
+
+def process_all_cities(base_path, folders, output_folder):
+    """Process the cities one at a time, so peak memory is one city's worth."""
+    os.makedirs(output_folder, exist_ok=True)
+    for city, theme_files in discover_city_files(base_path, folders).items():
+        output_path = os.path.join(output_folder, f"{city}_processed.geojson")
+        process_city(theme_files, output_path)
+        print(f"Processed file saved: {output_path}")
+
+
+if __name__ == "__main__":
+    # 生成新的 GeoJSON 文件
+    output_folder = os.path.join(base_path, "Processed_Results")
+    process_all_cities(base_path, folders, output_folder)
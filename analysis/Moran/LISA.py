@@ -0,0 +1,259 @@
+# 局部 Moran's I（LISA）：条件随机置换推断，输出 HH/LL/HL/LH 聚类编码
+# 替代在 ArcGIS 中手工制作的 cluster map，结果写回 census tract GeoJSON
+
+import os
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(current_dir, "../.."))
+sys.path.append(project_root)
+
+from analysis.Moran.Morans import PERMUTATION_BATCH_ELEMENTS, read_city_weights, variables
+
+# PySAL 象限编码（与 esda.Moran_Local 一致）：1 HH, 2 LH, 3 LL, 4 HL
+QUADRANT_LABELS = np.array(['', 'HH', 'LH', 'LL', 'HL'], dtype=object)
+NOT_SIGNIFICANT = 'NS'
+CLUSTER_LABELS = ['HH', 'LL', 'HL', 'LH']
+
+
+def local_moran(Y, W):
+    """
+    Local Moran's I of several variables with one sparse mat-mat product.
+
+    Values are standardized with the population standard deviation and
+    ``I_i = (n - 1) z_i (W z)_i / sum(z^2)``, as in ``esda.Moran_Local``.
+
+    Parameters
+    ----------
+    Y : array, shape (n, k)
+    W : scipy.sparse matrix, shape (n, n)
+        Spatial weights, already transformed (e.g. row-standardized).
+
+    Returns
+    -------
+    Is : array, shape (n, k)
+    q : int array, shape (n, k)
+        Quadrant of every tract: 1 HH, 2 LH, 3 LL, 4 HL.
+    Z : array, shape (n, k)
+        Standardized values.
+    """
+    Y = np.asarray(Y, dtype=float)
+    n = Y.shape[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Z = (Y - Y.mean(axis=0)) / Y.std(axis=0)
+        lag = W.tocsr() @ Z
+        Is = (n - 1) * Z * lag / (Z * Z).sum(axis=0)
+    high, high_lag = Z > 0, lag > 0
+    q = np.select([high & high_lag, ~high & high_lag, ~high & ~high_lag], [1, 2, 3], 4)
+    return Is, q, Z
+
+
+def permutation_table(n, max_card, permutations, rng):
+    """
+    Conditional randomization table shared by all tracts.
+
+    Row ``p`` holds ``max_card`` distinct draws from range(n - 1); a tract with
+    ``k`` neighbours uses the first ``k`` columns.  Draw ``t`` of tract ``i``
+    stands for tract ``t``, except ``t == i`` which stands for tract n - 1, so
+    every tract draws uniformly from the n - 1 other tracts.
+
+    :return: int array, shape (permutations, max_card)
+    """
+    table = np.empty((permutations, max_card), dtype=np.int64)
+    if max_card:
+        for p in range(permutations):
+            table[p] = rng.choice(n - 1, size=max_card, replace=False)
+    return table
+
+
+def local_moran_permutation(Z, W, Is, permutations=999, seed=None, batch_size=None):
+    """
+    Conditional permutation inference for local Moran's I, in vectorized batches.
+
+    For every tract the values of the other tracts are randomly reassigned to
+    its neighbours (conditional randomization with the tract's own value
+    fixed).  All tracts share one permutation table (see permutation_table),
+    so the values are gathered once and the simulated lags of a batch of
+    tracts are one dense product of their padded weights with the gathered
+    table; the few draws that hit the tract itself are corrected afterwards.
+    Tracts are batched by neighbour cardinality to keep the padding small.
+    ``p_sim`` follows ``esda.Moran_Local`` (folded one-sided pseudo p-value).
+
+    Parameters
+    ----------
+    Z : array, shape (n, k)
+        Standardized values from local_moran.
+    W : scipy.sparse matrix, shape (n, n)
+        Spatial weights, already transformed.
+    Is : array, shape (n, k)
+        Observed local I from local_moran.
+    permutations : int
+    seed : int or numpy SeedSequence, optional
+    batch_size : int, optional
+        Tracts per batch (default: bounded by PERMUTATION_BATCH_ELEMENTS).
+
+    Returns
+    -------
+    p_sim, z_sim : arrays of shape (n, k); NaN for tracts without neighbours
+    """
+    W = W.tocsr()
+    n, k = Z.shape
+    card = np.diff(W.indptr)
+    max_card = int(card.max()) if n else 0
+    rng = np.random.default_rng(seed)
+    table = permutation_table(n, max_card, permutations, rng)
+    scale = (n - 1) / (Z * Z).sum(axis=0)
+
+    # 所有 tract 共用的置换值：(max_card, permutations * k)
+    Z_table = Z[table].transpose(1, 0, 2).reshape(max_card, permutations * k)
+    # 抽到自身的位置 (p, j)：该值应换成 tract n-1 的值，只影响 tract t 自己
+    hit_p, hit_j = np.divmod(np.arange(table.size), max(max_card, 1))
+    hit_t = table.ravel()
+    hit = hit_j < card[hit_t]
+    hit_p, hit_j, hit_t = hit_p[hit], hit_j[hit], hit_t[hit]
+    hit_delta = W.data[W.indptr[hit_t] + hit_j][:, None] * (Z[n - 1] - Z[hit_t])
+    position = np.full(n, -1)
+
+    larger = np.zeros((n, k))
+    sim_mean = np.zeros((n, k))
+    sim_std = np.zeros((n, k))
+    # 按邻居数排序分批，批内补零最少
+    order = np.argsort(card, kind='stable')
+    b = batch_size or max(1, PERMUTATION_BATCH_ELEMENTS // (permutations * k))
+    for start in range(0, n, b):
+        rows = order[start:start + b]
+        kmax = int(card[rows].max())
+
+        # 每个 tract 的权重按 CSR 顺序补零到 kmax
+        cols = np.arange(kmax)
+        filled = cols < card[rows][:, None]
+        w_pad = np.zeros((len(rows), kmax))
+        w_pad[filled] = W.data[(W.indptr[rows][:, None] + cols)[filled]]
+        lag_sim = (w_pad @ Z_table[:kmax]).reshape(len(rows), permutations, k)
+
+        position[rows] = np.arange(len(rows))
+        in_batch = position[hit_t] >= 0
+        np.add.at(lag_sim, (position[hit_t[in_batch]], hit_p[in_batch]), hit_delta[in_batch])
+        position[rows] = -1
+
+        I_sim = Z[rows][:, None, :] * lag_sim * scale
+        larger[rows] = (I_sim >= Is[rows][:, None, :]).sum(axis=1)
+        sim_mean[rows] = I_sim.mean(axis=1)
+        sim_std[rows] = I_sim.std(axis=1)
+
+    low_extreme = (permutations - larger) < larger
+    larger[low_extreme] = permutations - larger[low_extreme]
+    p_sim = (larger + 1.0) / (permutations + 1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_sim = (Is - sim_mean) / sim_std
+    island = card == 0
+    p_sim[island] = np.nan
+    z_sim[island] = np.nan
+    return p_sim, z_sim
+
+
+def cluster_labels(q, p_sim=None, alpha=0.05):
+    """
+    HH/LH/LL/HL labels of quadrant codes; tracts with p_sim > alpha (or NaN) get 'NS'.
+
+    Without p_sim every tract gets the label of its quadrant.
+    """
+    labels = QUADRANT_LABELS[q]
+    if p_sim is not None:
+        labels = np.where(p_sim <= alpha, labels, NOT_SIGNIFICANT)
+    return labels
+
+
+def lisa_city(file_path, output_folder, variables=variables, weights_cache_dir=None, permutations=999, seed=None,
+              alpha=0.05, weights='queen', od_dir=None, flow_symmetric=True, flow_threshold=None):
+    """
+    LISA of all variables for one city GeoJSON, written to ``output_folder``.
+
+    For every variable the output GeoJSON gets the columns ``{var}_lisa_I``,
+    ``{var}_lisa_q`` (1 HH, 2 LH, 3 LL, 4 HL), ``{var}_lisa_p`` (conditional
+    permutation pseudo p-value), ``{var}_lisa_z`` and ``{var}_lisa`` (HH, LL,
+    HL, LH or NS at ``alpha``).  The random stream is derived from ``seed``
+    and the city name, as in Morans.analyze_city.
+
+    Returns
+    -------
+    dict with city_name and the number of tracts in every cluster per variable
+    """
+    city_name = os.path.basename(file_path).split('.')[0]
+    gdf, W = read_city_weights(file_path, weights_cache_dir, weights, od_dir, flow_symmetric, flow_threshold)
+
+    summary = {'city_name': city_name, 'n_tracts': len(gdf)}
+    present = [v for v in variables if v in gdf.columns]
+    if present:
+        Is, q, Z = local_moran(gdf[present].to_numpy(dtype=float), W)
+        if permutations:
+            city_seed = np.random.SeedSequence([seed or 0, zlib.crc32(city_name.encode())])
+            p_sim, z_sim = local_moran_permutation(Z, W, Is, permutations=permutations, seed=city_seed)
+        else:
+            p_sim = z_sim = np.full(Is.shape, np.nan)
+        for j, variable in enumerate(present):
+            labels = cluster_labels(q[:, j], p_sim[:, j] if permutations else None, alpha)
+            gdf[f'{variable}_lisa_I'] = Is[:, j]
+            gdf[f'{variable}_lisa_q'] = q[:, j]
+            gdf[f'{variable}_lisa_p'] = p_sim[:, j]
+            gdf[f'{variable}_lisa_z'] = z_sim[:, j]
+            gdf[f'{variable}_lisa'] = labels
+            for label in CLUSTER_LABELS:
+                summary[f'{variable}_{label}'] = int((labels == label).sum())
+
+    os.makedirs(output_folder, exist_ok=True)
+    # GeoJSON 统一写为 WGS84
+    gdf.to_crs(epsg=4326).to_file(os.path.join(output_folder, os.path.basename(file_path)), driver='GeoJSON')
+    return summary
+
+
+def run_lisa(folder_path, output_folder, summary_path=None, variables=variables, n_jobs=None, weights_cache_dir=None,
+             permutations=999, seed=None, alpha=0.05, weights='queen', od_dir=None, flow_symmetric=True,
+             flow_threshold=None):
+    """
+    LISA for every GeoJSON in a folder, in parallel over cities.
+
+    Parameters
+    ----------
+    folder_path : str
+        Folder of census-tract GeoJSON files.
+    output_folder : str
+        Folder of the GeoJSON files with the LISA columns.
+    summary_path : str, optional
+        CSV of the cluster counts per city and variable.
+    n_jobs : int, optional
+        Number of worker processes; 1 runs serially, None uses all CPUs.
+    permutations, seed, alpha
+        Conditional permutations, base seed and significance level.
+    weights, od_dir, flow_symmetric, flow_threshold, weights_cache_dir
+        Spatial weights, as in Morans.run_morans.
+    """
+    files = [os.path.join(folder_path, f) for f in sorted(os.listdir(folder_path)) if f.endswith('.geojson')]
+    run_city = partial(lisa_city, output_folder=output_folder, variables=variables,
+                       weights_cache_dir=weights_cache_dir, permutations=permutations, seed=seed, alpha=alpha,
+                       weights=weights, od_dir=od_dir, flow_symmetric=flow_symmetric, flow_threshold=flow_threshold)
+    if n_jobs == 1:
+        city_summaries = [run_city(f) for f in files]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            city_summaries = list(pool.map(run_city, files))
+
+    columns = ['city_name', 'n_tracts'] + [f'{var}_{label}' for var in variables for label in CLUSTER_LABELS]
+    df_summary = pd.DataFrame(city_summaries).reindex(columns=columns)
+    if summary_path is not None:
+        df_summary.to_csv(summary_path, index=False)
+    return df_summary
+
+
+if __name__ == '__main__':
+    folder_path = r"D:\Code\Social_segregation\data\Census_tract"
+    output_folder = r"D:\Code\Social_segregation\data\Census_tract_LISA"
+    summary_path = r"D:\Code\Social_segregation\data\lisa_cluster_summary.csv"
+    weights_cache_dir = r"D:\Code\Social_segregation\data\weights_cache"
+    run_lisa(folder_path, output_folder, summary_path, weights_cache_dir=weights_cache_dir, permutations=999, seed=42)
@@ -1,67 +1,277 @@
 import geopandas as gpd
 import numpy as np
 from libpysal.weights import Queen
-from esda.moran import Moran
+from scipy import stats
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import os
+import sys
+import zlib
 import pandas as pd
 
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(current_dir, "../.."))
+sys.path.append(project_root)
+
+from data_process.spatial_weights import load_or_build_flow_weights, load_or_build_weights, od_matrix_path, row_standardize
+
 # 定义要分析的变量列表
 variables = ['theme1', 'theme2', 'theme3', 'theme4', 'themes']
 
-# 创建一个空的字典来存储结果
-results = {}
-
-# 遍历文件夹中的所有GeoJSON文件
-folder_path = r"D:\Code\Social_segregation\data\Census_tract"  # 替换为你的文件夹路径
-for filename in os.listdir(folder_path):
-    if filename.endswith('.geojson'):
-        file_path = os.path.join(folder_path, filename)
-        city_name = filename.split('.')[0]  # 假设文件名是城市名
-
-        # 读取GeoJSON文件
-        gdf = gpd.read_file(file_path)
-        
-        # 确保数据已经投影到EPSG:5070
-        if gdf.crs is None:
-            # 如果数据没有坐标系统，假设输入是WGS84 (EPSG:4326)
-            gdf.set_crs(epsg=4326, inplace=True)
-        # 投影到EPSG:5070
-        gdf = gdf.to_crs(epsg=5070)
-
-        # 构造基于Queen邻接方式的权重矩阵
-        w = Queen.from_dataframe(gdf)
-        w.transform = 'r'  # 归一化权重
-
-        # 初始化这个城市的结果
-        city_results = {'city_name': city_name}
-
-        # 对每个变量计算Moran's I
-        for variable in variables:
-            if variable in gdf.columns:
-                moran = Moran(gdf[variable], w)
-                city_results[f'{variable}_moran'] = moran.I
-                city_results[f'{variable}_moran_p'] = moran.p_norm
-                city_results[f'{variable}_moran_z'] = moran.z_norm  # 添加 Z-score 计算
-            else:
-                city_results[f'{variable}_moran'] = np.nan
-                city_results[f'{variable}_moran_p'] = np.nan
-                city_results[f'{variable}_moran_z'] = np.nan  # 确保缺失值也有占位符
-        results[city_name] = city_results
-
-# 将结果转换为DataFrame
-df_results = pd.DataFrame.from_dict(results, orient='index')
-
-# 重新排列列的顺序
-columns_order = (
-    ['city_name'] +
-    [f'{var}_moran' for var in variables] +
-    [f'{var}_moran_p' for var in variables] +
-    [f'{var}_moran_z' for var in variables]  # 新增 Z-score 列
-)
-df_results = df_results[columns_order]
-
-# 将结果保存到CSV文件
-output_path = r"D:\Code\Social_segregation\data\morans_i_results_added_z.csv"
-df_results.to_csv(output_path, index=False)
-
-print(f"分析完成，结果已保存到 {output_path}")
+# 可选的权重：Queen 邻接，或基于 OD 流量的出行联系权重
+WEIGHT_KINDS = ('queen', 'flow')
+
+# 每个批次的置换矩阵元素上限（n × batch × 变量数），控制内存
+PERMUTATION_BATCH_ELEMENTS = 20_000_000
+
+
+def moran_statistics(Y, W):
+    """
+    Global Moran's I with normality inference for several variables at once.
+
+    All columns share one sparse weights matrix, so the spatial lags of every
+    variable come from a single sparse mat-mat product.  Results match
+    ``esda.moran.Moran`` (``I``, ``z_norm`` and two-tailed ``p_norm``).
+
+    Parameters
+    ----------
+    Y : array, shape (n, k)
+        One column per variable.
+    W : scipy.sparse matrix, shape (n, n)
+        Spatial weights, already transformed (e.g. row-standardized).
+
+    Returns
+    -------
+    I, z_norm, p_norm : arrays of shape (k,)
+    """
+    Y = np.asarray(Y, dtype=float)
+    W = W.tocsr()
+    n = Y.shape[0]
+    Z = Y - Y.mean(axis=0)
+    WZ = W @ Z
+
+    s0 = W.sum()
+    S = W + W.T
+    s1 = 0.5 * S.multiply(S).sum()
+    s2 = np.square(np.asarray(W.sum(axis=1)).ravel() + np.asarray(W.sum(axis=0)).ravel()).sum()
+
+    I = n / s0 * (Z * WZ).sum(axis=0) / (Z * Z).sum(axis=0)
+    EI = -1.0 / (n - 1)
+    VI_norm = (n * n * s1 - n * s2 + 3 * s0 * s0) / ((n - 1) * (n + 1) * s0 * s0) - EI ** 2
+    z_norm = (I - EI) / np.sqrt(VI_norm)
+    p_norm = 2 * stats.norm.sf(np.abs(z_norm))
+    return I, z_norm, p_norm
+
+
+def moran_permutation(Y, W, I, permutations=9999, seed=None, batch_size=None):
+    """
+    Permutation inference for global Moran's I, evaluated in batches.
+
+    Each batch draws a 2-D array of row permutations and evaluates all of them
+    for all variables with one sparse mat-mat product.  ``p_sim`` and ``z_sim``
+    follow ``esda.moran.Moran`` (folded one-sided pseudo p-value).
+
+    Parameters
+    ----------
+    Y : array, shape (n, k)
+    W : scipy.sparse matrix, shape (n, n)
+        Spatial weights, already transformed.
+    I : array, shape (k,)
+        Observed Moran's I from moran_statistics.
+    permutations : int
+        Number of random permutations.
+    seed : int or numpy SeedSequence, optional
+    batch_size : int, optional
+        Permutations per batch (default: bounded by PERMUTATION_BATCH_ELEMENTS).
+
+    Returns
+    -------
+    p_sim, z_sim : arrays of shape (k,)
+    """
+    Y = np.asarray(Y, dtype=float)
+    W = W.tocsr()
+    n, k = Y.shape
+    Z = Y - Y.mean(axis=0)
+    scale = n / W.sum() / (Z * Z).sum(axis=0)
+    if batch_size is None:
+        batch_size = max(1, PERMUTATION_BATCH_ELEMENTS // max(1, n * k))
+
+    rng = np.random.default_rng(seed)
+    sim = np.empty((permutations, k))
+    for start in range(0, permutations, batch_size):
+        b = min(batch_size, permutations - start)
+        idx = rng.permuted(np.broadcast_to(np.arange(n), (b, n)), axis=1)
+        # (b, n, k) -> (n, b*k)：所有置换、所有变量一次稀疏矩阵乘法
+        Zp = Z[idx].transpose(1, 0, 2).reshape(n, b * k)
+        WZp = W @ Zp
+        sim[start:start + b] = (Zp * WZp).sum(axis=0).reshape(b, k) * scale
+
+    larger = (sim >= I).sum(axis=0)
+    larger = np.minimum(larger, permutations - larger)
+    p_sim = (larger + 1.0) / (permutations + 1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_sim = (I - sim.mean(axis=0)) / sim.std(axis=0)
+    return p_sim, z_sim
+
+
+def read_city_weights(file_path, weights_cache_dir=None, weights='queen', od_dir=None, flow_symmetric=True,
+                      flow_threshold=None):
+    """
+    Read a census-tract GeoJSON, project it to EPSG:5070 and build row-standardized weights.
+
+    With ``weights_cache_dir`` the weights are taken from the spatial weights
+    cache (data_process/spatial_weights.py) when the tracts are unchanged.
+    ``weights='flow'`` uses mobility weights from the city's OD matrix
+    (``<od_dir>/<City>_od.npz``, see od_matrix.py), optionally symmetrized and
+    thresholded, instead of Queen contiguity.
+
+    Returns
+    -------
+    gdf : GeoDataFrame
+    W : scipy.sparse.csr_matrix
+    """
+    if weights not in WEIGHT_KINDS:
+        raise ValueError(f"weights must be one of: {', '.join(WEIGHT_KINDS)}")
+    # 读取GeoJSON文件
+    gdf = gpd.read_file(file_path)
+    city_name = os.path.basename(file_path).split('.')[0]
+    if weights == 'flow':
+        if od_dir is None:
+            raise ValueError("od_dir is required for flow weights")
+        W, _ = load_or_build_flow_weights(gdf, od_matrix_path(od_dir, city_name), weights_cache_dir, city_name,
+                                          symmetric=flow_symmetric, threshold=flow_threshold)
+    elif weights_cache_dir is not None:
+        # 邻接关系与投影无关，缓存以原始几何为键
+        W, _ = load_or_build_weights(gdf, weights_cache_dir, city_name, kind='queen', source=file_path)
+    else:
+        W = None
+
+    # 确保数据已经投影到EPSG:5070
+    if gdf.crs is None:
+        # 如果数据没有坐标系统，假设输入是WGS84 (EPSG:4326)
+        gdf.set_crs(epsg=4326, inplace=True)
+    # 投影到EPSG:5070
+    gdf = gdf.to_crs(epsg=5070)
+
+    if W is not None:
+        return gdf, row_standardize(W)
+
+    # 构造基于Queen邻接方式的权重矩阵
+    w = Queen.from_dataframe(gdf)
+    w.transform = 'r'  # 归一化权重
+    return gdf, w.sparse
+
+
+def analyze_city(file_path, variables=variables, weights_cache_dir=None, permutations=0, seed=None,
+                 weights='queen', od_dir=None, flow_symmetric=True, flow_threshold=None):
+    """
+    Moran's I of all variables for one city GeoJSON.
+
+    ``weights``, ``od_dir``, ``flow_symmetric`` and ``flow_threshold`` select
+    the spatial weights (see read_city_weights).
+
+    With ``permutations > 0`` the permutation p-value and z-score are added;
+    the random stream is derived from ``seed`` and the city name, so results
+    do not depend on how cities are distributed over workers.
+
+    Returns
+    -------
+    dict with city_name and {var}_moran, {var}_moran_p, {var}_moran_z
+    (and {var}_moran_p_sim, {var}_moran_z_sim with permutations)
+    """
+    city_name = os.path.basename(file_path).split('.')[0]  # 假设文件名是城市名
+    gdf, W = read_city_weights(file_path, weights_cache_dir, weights, od_dir, flow_symmetric, flow_threshold)
+
+    # 初始化这个城市的结果
+    city_results = {'city_name': city_name}
+    present = [v for v in variables if v in gdf.columns]
+    if present:
+        Y = gdf[present].to_numpy(dtype=float)
+        I, z_norm, p_norm = moran_statistics(Y, W)
+        if permutations:
+            city_seed = np.random.SeedSequence([seed or 0, zlib.crc32(city_name.encode())])
+            p_sim, z_sim = moran_permutation(Y, W, I, permutations=permutations, seed=city_seed)
+        else:
+            p_sim = z_sim = np.full(len(present), np.nan)
+        stats_by_var = dict(zip(present, zip(I, p_norm, z_norm, p_sim, z_sim)))
+    else:
+        stats_by_var = {}
+
+    for variable in variables:
+        # 缺失的变量用 NaN 占位
+        I, p, z, p_sim, z_sim = stats_by_var.get(variable, (np.nan,) * 5)
+        city_results[f'{variable}_moran'] = I
+        city_results[f'{variable}_moran_p'] = p
+        city_results[f'{variable}_moran_z'] = z
+        if permutations:
+            city_results[f'{variable}_moran_p_sim'] = p_sim
+            city_results[f'{variable}_moran_z_sim'] = z_sim
+    return city_results
+
+
+def moran_result_columns(variables=variables, permutations=0):
+    """Column order of the Moran results CSV."""
+    columns_order = (
+        ['city_name'] +
+        [f'{var}_moran' for var in variables] +
+        [f'{var}_moran_p' for var in variables] +
+        [f'{var}_moran_z' for var in variables]  # 新增 Z-score 列
+    )
+    if permutations:
+        columns_order += [f'{var}_moran_p_sim' for var in variables] + [f'{var}_moran_z_sim' for var in variables]
+    return columns_order
+
+
+def run_morans(folder_path, output_path, variables=variables, n_jobs=None, weights_cache_dir=None,
+               permutations=0, seed=None, weights='queen', od_dir=None, flow_symmetric=True, flow_threshold=None):
+    """
+    Moran's I for every GeoJSON in a folder, in parallel over cities.
+
+    Parameters
+    ----------
+    folder_path : str
+        Folder of census-tract GeoJSON files.
+    output_path : str
+        CSV file to write.
+    variables : list[str]
+        Columns to analyze.
+    n_jobs : int, optional
+        Number of worker processes; 1 runs serially, None uses all CPUs.
+    weights_cache_dir : str, optional
+        Folder of the persistent spatial weights cache.
+    permutations : int
+        Number of permutations for p_sim/z_sim (0 skips permutation inference).
+    seed : int, optional
+        Base seed of the permutations.
+    weights : str
+        'queen' (contiguity) or 'flow' (mobility weights from the OD matrices in od_dir).
+    od_dir : str, optional
+        Folder of the ``<City>_od.npz`` OD matrices (flow weights only).
+    flow_symmetric, flow_threshold
+        Symmetrize / threshold the flow weights (see spatial_weights.build_flow_weights).
+    """
+    files = [os.path.join(folder_path, f) for f in sorted(os.listdir(folder_path)) if f.endswith('.geojson')]
+    run_city = partial(analyze_city, variables=variables, weights_cache_dir=weights_cache_dir,
+                       permutations=permutations, seed=seed, weights=weights, od_dir=od_dir,
+                       flow_symmetric=flow_symmetric, flow_threshold=flow_threshold)
+    if n_jobs == 1:
+        city_results = [run_city(f) for f in files]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            city_results = list(pool.map(run_city, files))
+
+    # 将结果转换为DataFrame，并重新排列列的顺序
+    df_results = pd.DataFrame(city_results, index=[r['city_name'] for r in city_results])
+    df_results = df_results[moran_result_columns(variables, permutations)]
+
+    # 将结果保存到CSV文件
+    df_results.to_csv(output_path, index=False)
+    return df_results
+
+
+if __name__ == '__main__':
+    folder_path = r"D:\Code\Social_segregation\data\Census_tract"  # 替换为你的文件夹路径
+    output_path = r"D:\Code\Social_segregation\data\morans_i_results_added_z.csv"
+    weights_cache_dir = r"D:\Code\Social_segregation\data\weights_cache"
+    run_morans(folder_path, output_path, weights_cache_dir=weights_cache_dir, permutations=9999, seed=42)
+    print(f"分析完成，结果已保存到 {output_path}")
@@ -0,0 +1,248 @@
+"""
+Columnar cache of the Step1_TotalOD tables and the per-MSA SVI tract tables.
+
+A one-time conversion (like ``Data_converter.py``) turns each MSA into three
+files in a cache folder:
+
+- ``<City>_od.feather``: ``o``/``d`` as int32 positions in the tract table
+  (-1 for unparsable IDs) and ``total`` as float32 flows
+- ``<City>_tracts.feather``: TractID, SPL_THEME1..SPL_THEMES,
+  Rank_THEME1..Rank_THEMES and ``ssi_index``, the row of the tract in the SSI
+  tract table (-1 for tracts without SVI values)
+- ``<City>_manifest.json``: size, mtime and SHA-1 of the source OD/SVI files
+
+The Feather files are uncompressed Arrow IPC files, so they are memory-mapped
+and read batch by batch without copies.  A cache whose source files changed
+is rebuilt automatically.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from data_process import SSI_Calculation as ssi
+
+CACHE_VERSION = 1
+OD_SCHEMA = [('o', 'int32'), ('d', 'int32'), ('total', 'float32')]
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("pyarrow library is required for the columnar OD cache. Install it with: pip install pyarrow")
+    return pyarrow
+
+
+def file_checksum(path, block_size=1 << 20):
+    """SHA-1 of a file, read in blocks."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _source_state(path, checksum=None):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha1': checksum or file_checksum(path)}
+
+
+def cache_paths(cache_dir, city):
+    """Paths of the cached files of one MSA."""
+    return {'od': os.path.join(cache_dir, f'{city}_od.feather'),
+            'tracts': os.path.join(cache_dir, f'{city}_tracts.feather'),
+            'manifest': os.path.join(cache_dir, f'{city}_manifest.json')}
+
+
+def is_cache_fresh(cache_dir, city, od_file, svi_file):
+    """
+    Check the cache of one MSA against its source files.
+
+    Sources whose size and mtime are unchanged are trusted; otherwise their
+    checksum is recomputed, so a touched but identical file keeps the cache.
+
+    :return: True if the cache exists and matches the OD and SVI files
+    """
+    paths = cache_paths(cache_dir, city)
+    if not all(os.path.exists(p) for p in paths.values()):
+        return False
+    with open(paths['manifest'], 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != CACHE_VERSION:
+        return False
+
+    refreshed = False
+    for key, path in (('od', od_file), ('svi', svi_file)):
+        recorded = manifest['sources'][key]
+        stat = os.stat(path)
+        if stat.st_size == recorded['size'] and stat.st_mtime_ns == recorded['mtime_ns']:
+            continue
+        checksum = file_checksum(path)
+        if checksum != recorded['sha1']:
+            return False
+        manifest['sources'][key] = _source_state(path, checksum)
+        refreshed = True
+    if refreshed:
+        _write_manifest(paths['manifest'], manifest)
+    return True
+
+
+def _write_manifest(path, manifest):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def build_od_cache(od_file, svi_file, cache_dir, city, svi=None, chunksize=ssi.DEFAULT_CHUNKSIZE):
+    """
+    Convert one MSA's OD CSV and SVI subset into the columnar cache.
+
+    The OD file is streamed, so memory is bounded by the chunk size.
+
+    :param od_file: path to <City>2019.csv
+    :param svi_file: path to SVI2018_US.csv
+    :param cache_dir: cache folder
+    :param city: MSA name
+    :param svi: preloaded SVI table (optional)
+    :param chunksize: OD rows per chunk / Arrow record batch
+    :return: dict of cache paths
+    """
+    pa = _require_pyarrow()
+    os.makedirs(cache_dir, exist_ok=True)
+    paths = cache_paths(cache_dir, city)
+    if svi is None:
+        svi = ssi.load_svi(svi_file)
+
+    o_ids, d_ids = ssi.scan_od_tracts(od_file, chunksize)
+    tracts = pd.DataFrame({'TractID': pd.unique(np.concatenate([o_ids, d_ids]))})
+    tract_df = ssi.build_tract_table_from_ids(o_ids, d_ids, svi)
+    tracts = tracts.merge(tract_df, how='left', on='TractID')
+    tracts['ssi_index'] = ssi.tract_index(tract_df)(tracts['TractID'].to_numpy()).astype(np.int32)
+    pa.feather.write_feather(tracts, paths['tracts'] + '.tmp', compression='uncompressed')
+    os.replace(paths['tracts'] + '.tmp', paths['tracts'])
+
+    lookup = ssi.tract_index(tracts)
+    schema = pa.schema([(name, pa.from_numpy_dtype(np.dtype(dtype))) for name, dtype in OD_SCHEMA])
+    with pa.ipc.new_file(paths['od'] + '.tmp', schema) as writer:
+        for chunk in ssi.iter_od_chunks(od_file, chunksize):
+            writer.write_batch(pa.record_batch([
+                pa.array(lookup(chunk['O'].to_numpy()).astype(np.int32)),
+                pa.array(lookup(chunk['D'].to_numpy()).astype(np.int32)),
+                pa.array(chunk['Total'].to_numpy(dtype=np.float32)),
+            ], schema=schema))
+    os.replace(paths['od'] + '.tmp', paths['od'])
+
+    # manifest 最后写入，作为缓存完整的标记
+    _write_manifest(paths['manifest'], {'version': CACHE_VERSION, 'city': city,
+                                        'sources': {'od': _source_state(od_file), 'svi': _source_state(svi_file)}})
+    return paths
+
+
+def ensure_od_cache(cache_dir, city, od_file, svi_file, svi=None, chunksize=ssi.DEFAULT_CHUNKSIZE):
+    """
+    Build the cache of one MSA unless a fresh one already exists.
+
+    :return: True if the cache was (re)built
+    """
+    if is_cache_fresh(cache_dir, city, od_file, svi_file):
+        return False
+    print(f"Building columnar OD cache for {city}")
+    build_od_cache(od_file, svi_file, cache_dir, city, svi=svi, chunksize=chunksize)
+    return True
+
+
+def load_cached_tracts(cache_dir, city):
+    """
+    Load the cached tract table of one MSA.
+
+    :return: DataFrame TractID, SPL_THEME1..SPL_THEMES, Rank_THEME1..Rank_THEMES, ssi_index
+    """
+    pa = _require_pyarrow()
+    return pa.feather.read_table(cache_paths(cache_dir, city)['tracts'], memory_map=True).to_pandas()
+
+
+def iter_cached_od(cache_dir, city):
+    """
+    Iterate over the memory-mapped OD table of one MSA batch by batch.
+
+    :return: iterator of (o, d, total) NumPy views
+    """
+    pa = _require_pyarrow()
+    # 不显式关闭映射：返回的视图持有对映射区域的引用
+    reader = pa.ipc.open_file(pa.memory_map(cache_paths(cache_dir, city)['od'], 'r'))
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        yield tuple(batch.column(name).to_numpy(zero_copy_only=False) for name, _ in OD_SCHEMA)
+
+
+def load_cached_od(cache_dir, city):
+    """
+    Load the whole cached OD table of one MSA.
+
+    :return: (o int32, d int32, total float32) arrays
+    """
+    batches = list(iter_cached_od(cache_dir, city))
+    if not batches:
+        return tuple(np.empty(0, dtype=dtype) for _, dtype in OD_SCHEMA)
+    return tuple(np.concatenate([b[k] for b in batches]) for k in range(len(OD_SCHEMA)))
+
+
+def calculate_ssi_cached(cache_dir, city, odss_file=None, local_side='origin'):
+    """
+    Run the SSI computation of one MSA from its columnar cache.
+
+    :param cache_dir: cache folder
+    :param city: MSA name
+    :param odss_file: path to write the OD pair table to (optional)
+    :param local_side: side of the local SSI aggregation
+    :return: (global_df, local_df)
+    """
+    tracts = load_cached_tracts(cache_dir, city)
+    tract_id = tracts['TractID'].to_numpy()
+    ssi_index = tracts['ssi_index'].to_numpy()
+    tract_df = tracts[ssi_index >= 0].drop(columns='ssi_index').reset_index(drop=True)
+
+    def chunks():
+        for o, d, total in iter_cached_od(cache_dir, city):
+            # o/d 为 -1 的行取到的 TractID 无意义，会在 compute_odss 中因 ssi_index 为 -1 被剔除
+            o_idx = np.where(o >= 0, ssi_index[o], -1)
+            d_idx = np.where(d >= 0, ssi_index[d], -1)
+            od = pd.DataFrame({'O': tract_id[o], 'D': tract_id[d], 'Total': total.astype(float)})
+            yield od, o_idx, d_idx
+
+    return ssi.accumulate_ssi(chunks(), tract_df, city, odss_file=odss_file, local_side=local_side)
+
+
+def convert_all(pathroot, cache_dir, cities=None, chunksize=ssi.DEFAULT_CHUNKSIZE):
+    """
+    One-time conversion of every MSA in Step1_TotalOD into the columnar cache.
+
+    :param pathroot: root folder containing SVI/Data
+    :param cache_dir: cache folder
+    :param cities: MSA names (default: every *2019.csv in Step1_TotalOD)
+    """
+    from data_process.SSI_batch import discover_cities
+
+    svi_file = os.path.join(pathroot, ssi.SVI_FILE)
+    svi = None
+    for city in cities or discover_cities(pathroot):
+        od_file = os.path.join(pathroot, ssi.OD_DIR, f'{city}2019.csv')
+        if is_cache_fresh(cache_dir, city, od_file, svi_file):
+            print(f"{city} cache is up to date")
+            continue
+        if svi is None:
+            svi = ssi.load_svi(svi_file)
+        build_od_cache(od_file, svi_file, cache_dir, city, svi=svi, chunksize=chunksize)
+        print(f"Successfully converted {city} to {cache_dir}")
+
+
+if __name__ == "__main__":
+    Pathroot = "/soge-home/users/cenv0925/"
+    cache_folder = os.path.join(Pathroot, "SVI", "Data", "OD_cache")
+    convert_all(Pathroot, cache_folder)
@@ -0,0 +1,483 @@
+"""
+Vectorized Python port of ``SSI_Calculation.R``.
+
+The R script computes the social distance of every OD pair by re-scanning the
+whole rank vector once per row and once per theme.  Here the reference rank
+vector is sorted once and ``A`` / ``count0`` are obtained for all OD rows at
+once with ``np.searchsorted``, which reproduces DIS/SSIM exactly.
+
+Large MSAs can be processed in streaming mode (``chunksize``): the OD file is
+read in chunks, O/D tracts are mapped to ranks through a dense lookup array
+and the global/local weighted sums are accumulated chunk by chunk, so peak
+memory is bounded by the chunk size plus the tract table.
+
+Outputs are written with the same names and columns as the R script:
+``<City>_ODSS.csv``, ``<City>_GlobalSSI.csv`` and ``<City>_LocalSSI.csv``.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+THEMES = ['THEME1', 'THEME2', 'THEME3', 'THEME4', 'THEMES']
+SPL_COLUMNS = [f'SPL_{t}' for t in THEMES]
+RANK_COLUMNS = [f'Rank_{t}' for t in THEMES]
+# DIS/SSIM 列名与 R 脚本一致：DIS1..DIS4, DISS
+THEME_SUFFIXES = ['1', '2', '3', '4', 'S']
+SSIM_COLUMNS = [f'SSIM{s}' for s in THEME_SUFFIXES]
+ODSS_COLUMNS = (['O', 'D', 'Total'] + [f'O_{t}' for t in THEMES] + [f'D_{t}' for t in THEMES]
+                + [f'DIFF_{t}' for t in THEMES]
+                + [c for s in THEME_SUFFIXES for c in (f'DIS{s}', f'SSIM{s}')])
+
+SVI_MISSING = -999.0
+
+LOCAL_SSI_SIDES = ('origin', 'destination', 'symmetric')
+DEFAULT_CHUNKSIZE = 1_000_000
+
+# 与 R 脚本中 Pathroot 下的目录结构保持一致
+SVI_FILE = os.path.join('SVI', 'Data', 'SVI2018_US.csv')
+OD_DIR = os.path.join('SVI', 'Data', 'Step1_TotalOD')
+ODSS_DIR = os.path.join('SVI', 'Result', 'OD_SS')
+GLOBAL_SSI_DIR = os.path.join('SVI', 'Result', 'GlobalSSI')
+LOCAL_SSI_DIR = os.path.join('SVI', 'Result', 'LocalSSI')
+
+
+def load_svi(svi_file):
+    """
+    Load the national SVI table, keeping FIPS and the five SPL_THEME columns.
+
+    :param svi_file: path to SVI2018_US.csv
+    :return: DataFrame with columns FIPS, SPL_THEME1..SPL_THEMES
+    """
+    return pd.read_csv(svi_file, usecols=['FIPS'] + SPL_COLUMNS)
+
+
+def _od_usecols(od_file):
+    """Names of the O, D and Total columns of an OD file (O/D are the first two)."""
+    columns = pd.read_csv(od_file, nrows=0).columns
+    return {columns[0]: 'O', columns[1]: 'D', 'Total': 'Total'}
+
+
+def read_od(od_file):
+    """
+    Read a Step1_TotalOD file; the first two columns are renamed to O and D.
+
+    :param od_file: path to <City>2019.csv
+    :return: DataFrame with columns O, D, Total
+    """
+    names = _od_usecols(od_file)
+    od = pd.read_csv(od_file, usecols=list(names)).rename(columns=names)
+    return od[['O', 'D', 'Total']]
+
+
+def iter_od_chunks(od_file, chunksize=DEFAULT_CHUNKSIZE, columns=('O', 'D', 'Total')):
+    """
+    Stream a Step1_TotalOD file in chunks of O/D/Total rows.
+
+    :param od_file: path to <City>2019.csv
+    :param chunksize: rows per chunk
+    :param columns: subset of 'O', 'D', 'Total' to read
+    :return: iterator of DataFrames
+    """
+    names = {k: v for k, v in _od_usecols(od_file).items() if v in columns}
+    for chunk in pd.read_csv(od_file, usecols=list(names), chunksize=chunksize):
+        yield chunk.rename(columns=names)[list(columns)]
+
+
+def scan_od_tracts(od_file, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    First streaming pass: unique origin and destination tracts in order of appearance.
+
+    :return: (unique O array, unique D array)
+    """
+    o_ids = np.empty(0, dtype=np.int64)
+    d_ids = np.empty(0, dtype=np.int64)
+    for chunk in iter_od_chunks(od_file, chunksize, columns=('O', 'D')):
+        o_ids = pd.unique(np.concatenate([o_ids, chunk['O'].to_numpy()]))
+        d_ids = pd.unique(np.concatenate([d_ids, chunk['D'].to_numpy()]))
+    return o_ids, d_ids
+
+
+def build_tract_table(od, svi):
+    """
+    Build the MSA tract table: unique O/D tracts joined with SVI and ranked.
+
+    :param od: DataFrame with columns O, D
+    :param svi: DataFrame from load_svi or an SVIStore
+    :return: DataFrame TractID, SPL_THEME1..SPL_THEMES, Rank_THEME1..Rank_THEMES
+    """
+    return build_tract_table_from_ids(pd.unique(od['O']), pd.unique(od['D']), svi)
+
+
+def build_tract_table_from_ids(o_ids, d_ids, svi):
+    """
+    Build the MSA tract table from unique origin and destination tract IDs.
+
+    Tracts without SVI values (no match or the -999 sentinel in THEME1/THEME4)
+    are dropped, then every theme is ranked with average ties like R's rank().
+
+    :param o_ids: unique origin tract IDs in order of appearance
+    :param d_ids: unique destination tract IDs in order of appearance
+    :param svi: DataFrame from load_svi, or an SVIStore (see SVI_store.py)
+    :return: DataFrame TractID, SPL_THEME1..SPL_THEMES, Rank_THEME1..Rank_THEMES
+    """
+    # unique(c(Ovector, Dvector))：先 O 后 D，保持首次出现顺序
+    tract_id = pd.unique(np.concatenate([o_ids, d_ids]))
+    if not isinstance(svi, pd.DataFrame):
+        # SVIStore：只取本 MSA 的 tract
+        svi = svi.select_tracts(tract_id)
+    tract_df = pd.DataFrame({'TractID': tract_id})
+    tract_df = tract_df.merge(svi, how='left', left_on='TractID', right_on='FIPS').drop(columns='FIPS')
+    valid = (tract_df['SPL_THEME1'] != SVI_MISSING) & (tract_df['SPL_THEME4'] != SVI_MISSING)
+    valid &= tract_df['SPL_THEME1'].notna() & tract_df['SPL_THEME4'].notna()
+    tract_df = tract_df[valid].reset_index(drop=True)
+    for spl_col, rank_col in zip(SPL_COLUMNS, RANK_COLUMNS):
+        tract_df[rank_col] = tract_df[spl_col].rank(method='average')
+    return tract_df
+
+
+def social_distance(origin_rank, diff, sorted_reference):
+    """
+    Social distance of OD pairs against a sorted reference rank vector.
+
+    For each row, A is the number of reference tracts with
+    ``|rank - origin_rank| < diff`` and count0 the number with
+    ``rank == origin_rank``; both are counted with binary search.
+
+    :param origin_rank: origin tract ranks, shape (n_od,)
+    :param diff: |origin rank - destination rank|, shape (n_od,)
+    :param sorted_reference: ascending reference rank vector, shape (N,)
+    :return: (DIS, SSIM) arrays
+    """
+    n = len(sorted_reference)
+    # 秩为 0.5 的整数倍，上下界可精确表示，开区间计数与 R 的 < 比较一致
+    a = (np.searchsorted(sorted_reference, origin_rank + diff, side='left')
+         - np.searchsorted(sorted_reference, origin_rank - diff, side='right'))
+    # diff == 0 时开区间为空，差值会变成 -count0
+    a = np.maximum(a, 0)
+    count0 = (np.searchsorted(sorted_reference, origin_rank, side='right')
+              - np.searchsorted(sorted_reference, origin_rank, side='left'))
+    dis = (a + np.where(count0 > 1, 0.5, 0.0)) / (n - 1)
+    return dis, 1 - dis
+
+
+def odss_context(tract_df):
+    """
+    Precompute what every OD chunk needs: tract lookup, rank matrix, sorted reference.
+
+    :param tract_df: DataFrame from build_tract_table
+    :return: (lookup, ranks (n_tracts, 5), sorted_reference)
+    """
+    # 与 R 脚本保持一致：所有主题都以 Rank_THEMES 作为参考序列
+    return (tract_index(tract_df), tract_df[RANK_COLUMNS].to_numpy(),
+            np.sort(tract_df['Rank_THEMES'].to_numpy()))
+
+
+def compute_odss(od, tract_df, context=None, o_idx=None, d_idx=None):
+    """
+    Attach O/D ranks to every OD pair and compute DIS/SSIM for all five themes.
+
+    OD pairs whose origin or destination has no SVI rank (or without a flow)
+    are dropped, like ``drop_na`` in the R script.
+
+    :param od: DataFrame with columns O, D, Total (whole file or one chunk)
+    :param tract_df: DataFrame from build_tract_table
+    :param context: result of odss_context, reused across chunks (optional)
+    :param o_idx: precomputed tract_df positions of O (-1 if unranked), optional
+    :param d_idx: precomputed tract_df positions of D (-1 if unranked), optional
+    :return: DataFrame with the same columns as the R DF_clean
+    """
+    if context is None:
+        context = odss_context(tract_df)
+    lookup, ranks, sorted_reference = context
+    if o_idx is None:
+        o_idx = lookup(od['O'].to_numpy())
+    if d_idx is None:
+        d_idx = lookup(od['D'].to_numpy())
+    valid = (o_idx >= 0) & (d_idx >= 0) & od['Total'].notna().to_numpy()
+    o_rank = ranks[o_idx[valid]]
+    d_rank = ranks[d_idx[valid]]
+    diff = np.abs(o_rank - d_rank)
+
+    columns = {}
+    for k, t in enumerate(THEMES):
+        columns[f'O_{t}'] = o_rank[:, k]
+    for k, t in enumerate(THEMES):
+        columns[f'D_{t}'] = d_rank[:, k]
+    for k, t in enumerate(THEMES):
+        columns[f'DIFF_{t}'] = diff[:, k]
+    for k, s in enumerate(THEME_SUFFIXES):
+        dis, ssim = social_distance(o_rank[:, k], diff[:, k], sorted_reference)
+        columns[f'DIS{s}'] = dis
+        columns[f'SSIM{s}'] = ssim
+    df = od.loc[valid, ['O', 'D', 'Total']].reset_index(drop=True)
+    return pd.concat([df, pd.DataFrame(columns)], axis=1)
+
+
+def global_ssi(odss, city):
+    """
+    Flow-weighted global SSI of one MSA.
+
+    :param odss: DataFrame from compute_odss
+    :param city: MSA name
+    :return: one-row DataFrame City, TotalOD, Theme1..Theme4, Themes
+    """
+    total = odss['Total'].to_numpy(dtype=float)
+    return global_ssi_from_sums(city, odss['Total'].sum(), odss[SSIM_COLUMNS].to_numpy().T @ total)
+
+
+def global_ssi_from_sums(city, flow_total, weighted_total):
+    """
+    Global SSI row from the accumulated total flow and flow-weighted SSIM sums.
+
+    :param city: MSA name
+    :param flow_total: sum of Total over all OD pairs
+    :param weighted_total: sum of SSIM * Total per theme, shape (5,)
+    :return: one-row DataFrame City, TotalOD, Theme1..Theme4, Themes
+    """
+    row = {'City': city, 'TotalOD': flow_total}
+    for k, t in enumerate(THEMES):
+        row[t.capitalize()] = weighted_total[k] / flow_total
+    return pd.DataFrame([row])
+
+
+def tract_index(tract_df):
+    """
+    Dense lookup from tract ID to row position in the tract table.
+
+    :param tract_df: DataFrame from build_tract_table
+    :return: function mapping an array of tract IDs to int positions (-1 if absent)
+    """
+    tract_id = tract_df['TractID'].to_numpy()
+    order = np.argsort(tract_id, kind='stable')
+    sorted_id = tract_id[order]
+
+    def lookup(ids):
+        ids = np.asarray(ids)
+        pos = np.clip(np.searchsorted(sorted_id, ids), 0, len(sorted_id) - 1)
+        return np.where(sorted_id[pos] == ids, order[pos], -1)
+
+    return lookup
+
+
+def aggregate_local_sums(o_idx, d_idx, total, ssim, n_tracts, side='origin'):
+    """
+    Single-pass flow-weighted group-by of SSIM over tract indices.
+
+    :param o_idx: origin tract positions, shape (n_od,)
+    :param d_idx: destination tract positions, shape (n_od,)
+    :param total: OD flows, shape (n_od,)
+    :param ssim: SSIM matrix, shape (n_od, n_themes)
+    :param n_tracts: number of tracts in the tract table
+    :param side: 'origin', 'destination' or 'symmetric' (O∪D, self-flows counted once)
+    :return: (flow_sum (n_tracts,), weighted_ssim_sum (n_tracts, n_themes))
+    """
+    if side not in LOCAL_SSI_SIDES:
+        raise ValueError(f"side must be one of: {', '.join(LOCAL_SSI_SIDES)}")
+    total = np.asarray(total, dtype=float)
+    ssim = np.asarray(ssim, dtype=float)
+    if side == 'origin':
+        keys = o_idx
+    elif side == 'destination':
+        keys = d_idx
+    else:
+        cross = o_idx != d_idx
+        keys = np.concatenate([o_idx, d_idx[cross]])
+        total = np.concatenate([total, total[cross]])
+        ssim = np.concatenate([ssim, ssim[cross]])
+
+    flow_sum = np.bincount(keys, weights=total, minlength=n_tracts)
+    weighted = ssim * total[:, None]
+    weighted_sum = np.column_stack([np.bincount(keys, weights=weighted[:, k], minlength=n_tracts)
+                                    for k in range(weighted.shape[1])])
+    return flow_sum, weighted_sum
+
+
+def local_ssi_from_sums(tract_df, flow_sum, weighted_sum):
+    """
+    Divide accumulated weighted sums into local SSI columns THEME1..THEMES.
+
+    Tracts without flows get NaN, as the 0/0 in the R script.
+    """
+    tract_df = tract_df.copy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        local = weighted_sum / flow_sum[:, None]
+    for k, t in enumerate(THEMES):
+        tract_df[t] = local[:, k]
+    return tract_df
+
+
+def local_ssi(odss, tract_df, side='origin'):
+    """
+    Flow-weighted local SSI of every tract in one group-by sweep.
+
+    ``side='origin'`` reproduces the R script (outgoing OD pairs of each
+    tract); 'destination' uses incoming pairs and 'symmetric' both.
+
+    :param odss: DataFrame from compute_odss
+    :param tract_df: DataFrame from build_tract_table
+    :param side: 'origin', 'destination' or 'symmetric'
+    :return: tract_df with THEME1..THEMES columns appended
+    """
+    lookup = tract_index(tract_df)
+    ssim = odss[SSIM_COLUMNS].to_numpy()
+    flow_sum, weighted_sum = aggregate_local_sums(lookup(odss['O'].to_numpy()), lookup(odss['D'].to_numpy()),
+                                                  odss['Total'].to_numpy(), ssim, len(tract_df), side=side)
+    return local_ssi_from_sums(tract_df, flow_sum, weighted_sum)
+
+
+def calculate_ssi(od_file, svi, city, local_side='origin'):
+    """
+    Run the full SSI computation for one MSA in memory.
+
+    :param od_file: path to the Step1_TotalOD file of the MSA
+    :param svi: DataFrame from load_svi or an SVIStore
+    :param city: MSA name
+    :param local_side: side of the local SSI aggregation, see local_ssi
+    :return: (odss, global_df, local_df)
+    """
+    od = read_od(od_file)
+    tract_df = build_tract_table(od, svi)
+    odss = compute_odss(od, tract_df)
+    return odss, global_ssi(odss, city), local_ssi(odss, tract_df, side=local_side)
+
+
+def calculate_ssi_streaming(od_file, svi, city, chunksize=DEFAULT_CHUNKSIZE, odss_file=None,
+                            local_side='origin'):
+    """
+    Run the SSI computation for one MSA with bounded memory.
+
+    A first pass collects the unique O/D tracts; the second pass computes
+    DIS/SSIM chunk by chunk, optionally appends each chunk to the ODSS file,
+    and accumulates the global and local weighted sums.
+
+    :param od_file: path to the Step1_TotalOD file of the MSA
+    :param svi: DataFrame from load_svi or an SVIStore
+    :param city: MSA name
+    :param chunksize: OD rows per chunk
+    :param odss_file: path to write the OD pair table to (optional)
+    :param local_side: side of the local SSI aggregation, see local_ssi
+    :return: (global_df, local_df)
+    """
+    tract_df = build_tract_table_from_ids(*scan_od_tracts(od_file, chunksize), svi)
+    chunks = ((chunk, None, None) for chunk in iter_od_chunks(od_file, chunksize))
+    return accumulate_ssi(chunks, tract_df, city, odss_file=odss_file, local_side=local_side)
+
+
+def accumulate_ssi(chunks, tract_df, city, odss_file=None, local_side='origin'):
+    """
+    Compute DIS/SSIM chunk by chunk and accumulate global and local weighted sums.
+
+    :param chunks: iterable of (od_chunk, o_idx, d_idx); the index arrays are
+        optional precomputed tract_df positions (None to look them up)
+    :param tract_df: DataFrame from build_tract_table
+    :param city: MSA name
+    :param odss_file: path to write the OD pair table to (optional)
+    :param local_side: side of the local SSI aggregation, see local_ssi
+    :return: (global_df, local_df)
+    """
+    context = odss_context(tract_df)
+    lookup = context[0]
+    n_tracts = len(tract_df)
+
+    flow_total = 0
+    weighted_total = np.zeros(len(THEMES))
+    flow_sum = np.zeros(n_tracts)
+    weighted_sum = np.zeros((n_tracts, len(THEMES)))
+    header = True
+    for chunk, o_idx, d_idx in chunks:
+        odss = compute_odss(chunk, tract_df, context, o_idx=o_idx, d_idx=d_idx)
+        if odss_file is not None:
+            odss.to_csv(odss_file, mode='w' if header else 'a', header=header, index=False, na_rep='NaN')
+            header = False
+        total = odss['Total'].to_numpy(dtype=float)
+        ssim = odss[SSIM_COLUMNS].to_numpy()
+        flow_total += odss['Total'].sum()
+        weighted_total += ssim.T @ total
+        chunk_flow, chunk_weighted = aggregate_local_sums(lookup(odss['O'].to_numpy()), lookup(odss['D'].to_numpy()),
+                                                          total, ssim, n_tracts, side=local_side)
+        flow_sum += chunk_flow
+        weighted_sum += chunk_weighted
+    if odss_file is not None and header:
+        pd.DataFrame(columns=ODSS_COLUMNS).to_csv(odss_file, index=False)
+
+    return global_ssi_from_sums(city, flow_total, weighted_total), \
+        local_ssi_from_sums(tract_df, flow_sum, weighted_sum)
+
+
+def local_ssi_file_name(city, local_side='origin'):
+    """Local SSI file name; non-origin variants get a side suffix."""
+    if local_side == 'origin':
+        return f'{city}_LocalSSI.csv'
+    return f'{city}_LocalSSI_{local_side}.csv'
+
+
+def save_ssi_results(pathroot, city, odss, global_df, local_df, local_side='origin'):
+    """
+    Write the three SSI outputs under Pathroot with the R script's file names.
+
+    ``odss`` may be None when the OD pair table was already streamed to disk.
+
+    :return: (odss_path, global_path, local_path)
+    """
+    paths = (os.path.join(pathroot, ODSS_DIR, f'{city}_ODSS.csv'),
+             os.path.join(pathroot, GLOBAL_SSI_DIR, f'{city}_GlobalSSI.csv'),
+             os.path.join(pathroot, LOCAL_SSI_DIR, local_ssi_file_name(city, local_side)))
+    # GlobalSSI 最后写入，作为该城市已完成的标记（批处理断点续跑依赖它）
+    for path, df in ((paths[0], odss), (paths[2], local_df), (paths[1], global_df)):
+        if df is None:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        # R 的 write.csv 将 0/0 写为 NaN，data_reader_census_tract 可直接 float() 解析
+        df.to_csv(tmp_path, index=False, na_rep='NaN')
+        os.replace(tmp_path, path)
+    return paths
+
+
+def run_city(pathroot, city, svi=None, local_side='origin', chunksize=None, cache_dir=None):
+    """
+    Compute and save the SSI outputs of one MSA, like one run of the R script.
+
+    :param pathroot: root folder containing SVI/Data and SVI/Result
+    :param city: MSA name, e.g. 'StLouis'
+    :param svi: preloaded SVI table (optional, loaded from Pathroot if needed)
+    :param local_side: 'origin' (default, as in R), 'destination' or 'symmetric'
+    :param chunksize: if given, stream the OD file in chunks of this many rows
+    :param cache_dir: if given, read the MSA from the columnar OD cache
+        (see OD_cache.py), building or refreshing it first when stale
+    :return: one-row global SSI DataFrame
+    """
+    svi_file = os.path.join(pathroot, SVI_FILE)
+    od_file = os.path.join(pathroot, OD_DIR, f'{city}2019.csv')
+    odss_path = os.path.join(pathroot, ODSS_DIR, f'{city}_ODSS.csv')
+    odss = None
+    if cache_dir:
+        from data_process import OD_cache
+
+        OD_cache.ensure_od_cache(cache_dir, city, od_file, svi_file, svi=svi,
+                                 chunksize=chunksize or DEFAULT_CHUNKSIZE)
+        os.makedirs(os.path.dirname(odss_path), exist_ok=True)
+        global_df, local_df = OD_cache.calculate_ssi_cached(cache_dir, city, odss_file=odss_path + '.tmp',
+                                                            local_side=local_side)
+        os.replace(odss_path + '.tmp', odss_path)
+    elif chunksize:
+        if svi is None:
+            svi = load_svi(svi_file)
+        os.makedirs(os.path.dirname(odss_path), exist_ok=True)
+        global_df, local_df = calculate_ssi_streaming(od_file, svi, city, chunksize=chunksize,
+                                                      odss_file=odss_path + '.tmp', local_side=local_side)
+        os.replace(odss_path + '.tmp', odss_path)
+    else:
+        if svi is None:
+            svi = load_svi(svi_file)
+        odss, global_df, local_df = calculate_ssi(od_file, svi, city, local_side=local_side)
+    save_ssi_results(pathroot, city, odss, global_df, local_df, local_side=local_side)
+    print(f"{city} SSI is calculated and saved")
+    return global_df
+
+
+if __name__ == '__main__':
+    Pathroot = "/soge-home/users/cenv0925/"
+    City = "StLouis"
+    run_city(Pathroot, City)
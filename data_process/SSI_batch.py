@@ -0,0 +1,190 @@
+"""
+Multi-MSA batch driver for the Python SSI engine.
+
+Runs ``SSI_Calculation.run_city`` for a list of MSAs (or every
+``Step1_TotalOD/*2019.csv``) in a process pool sized by available memory,
+skips MSAs whose outputs already exist, and merges the per-city GlobalSSI
+files into the ``SSI_golbal_data.csv`` read by ``data_reader``.
+"""
+import os
+import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from data_process import SSI_Calculation as ssi
+
+OD_SUFFIX = '2019.csv'
+# 单个城市峰值内存约为 OD 文件大小的倍数（ODSS 表约 25 列 float64 + 两次 merge）
+MEMORY_PER_OD_BYTE = 12
+# 流式模式下每个 chunk 行的内存（ODSS 列 + 临时数组）
+MEMORY_PER_CHUNK_ROW = 600
+GLOBAL_SSI_COLUMNS = ['City', 'Theme1', 'Theme2', 'Theme3', 'Theme4', 'Themes']
+
+_worker_svi = None
+
+
+def discover_cities(pathroot):
+    """
+    List the MSAs that have an OD file in Step1_TotalOD.
+
+    :param pathroot: root folder containing SVI/Data
+    :return: sorted list of MSA names
+    """
+    pattern = os.path.join(pathroot, ssi.OD_DIR, f'*{OD_SUFFIX}')
+    return sorted(os.path.basename(f)[:-len(OD_SUFFIX)] for f in glob.glob(pattern))
+
+
+def available_memory():
+    """Available physical memory in bytes, or None if it cannot be determined."""
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def estimate_city_memory(pathroot, city, chunksize=None):
+    """Rough peak memory in bytes of one SSI run (in memory or streamed)."""
+    od_file = os.path.join(pathroot, ssi.OD_DIR, f'{city}{OD_SUFFIX}')
+    in_memory = os.path.getsize(od_file) * MEMORY_PER_OD_BYTE
+    if chunksize:
+        return min(in_memory, chunksize * MEMORY_PER_CHUNK_ROW)
+    return in_memory
+
+
+def plan_workers(pathroot, cities, max_workers=None, chunksize=None):
+    """
+    Number of pool workers so that the largest MSAs running together fit in memory.
+
+    :param pathroot: root folder containing SVI/Data
+    :param cities: MSAs to run
+    :param max_workers: upper bound (default: CPU count)
+    :param chunksize: OD rows per chunk if the runs are streamed
+    :return: int >= 1
+    """
+    workers = max_workers or os.cpu_count() or 1
+    workers = max(1, min(workers, len(cities)))
+    memory = available_memory()
+    if memory is None or not cities:
+        return workers
+    largest = sorted((estimate_city_memory(pathroot, c, chunksize) for c in cities), reverse=True)
+    # 最坏情况：最大的几个城市同时在不同进程中运行
+    fit = 0
+    used = 0
+    for need in largest[:workers]:
+        if used + need > memory:
+            break
+        used += need
+        fit += 1
+    return max(1, fit)
+
+
+def is_done(pathroot, city):
+    """True if the MSA's GlobalSSI (written last) already exists."""
+    return os.path.exists(os.path.join(pathroot, ssi.GLOBAL_SSI_DIR, f'{city}_GlobalSSI.csv'))
+
+
+def _init_worker(svi_file, svi_store_dir):
+    global _worker_svi
+    if svi_store_dir is not None:
+        from data_process.SVI_store import SVIStore
+
+        _worker_svi = SVIStore.open(svi_store_dir)
+    elif svi_file is not None:
+        _worker_svi = ssi.load_svi(svi_file)
+
+
+def _run_city(pathroot, city, local_side, chunksize, cache_dir):
+    ssi.run_city(pathroot, city, svi=_worker_svi, local_side=local_side, chunksize=chunksize,
+                 cache_dir=cache_dir)
+    return city
+
+
+def merge_global_ssi(pathroot, cities, output_file):
+    """
+    Combine per-city GlobalSSI files into SSI_golbal_data.csv.
+
+    :param pathroot: root folder containing SVI/Result
+    :param cities: MSAs to include (missing ones are skipped)
+    :param output_file: path of the combined CSV
+    :return: combined DataFrame (City, Theme1..Theme4, Themes)
+    """
+    frames = []
+    for city in cities:
+        path = os.path.join(pathroot, ssi.GLOBAL_SSI_DIR, f'{city}_GlobalSSI.csv')
+        if os.path.exists(path):
+            frames.append(pd.read_csv(path))
+    combined = pd.concat(frames, ignore_index=True)[GLOBAL_SSI_COLUMNS] if frames \
+        else pd.DataFrame(columns=GLOBAL_SSI_COLUMNS)
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    combined.to_csv(output_file, index=False)
+    return combined
+
+
+def run_batch(pathroot, output_file, cities=None, max_workers=None, resume=True, local_side='origin',
+              chunksize=None, cache_dir=None, svi_store_dir=None):
+    """
+    Run the SSI computation for many MSAs in a process pool.
+
+    :param pathroot: root folder containing SVI/Data and SVI/Result
+    :param output_file: path of the combined SSI_golbal_data.csv
+    :param cities: MSA names; if None, every Step1_TotalOD/*2019.csv is used
+    :param max_workers: upper bound on pool size (default: CPU count)
+    :param resume: skip MSAs whose outputs already exist
+    :param local_side: side of the local SSI aggregation
+    :param chunksize: stream OD files in chunks of this many rows (for large MSAs)
+    :param cache_dir: read MSAs from the columnar OD cache in this folder (see OD_cache.py)
+    :param svi_store_dir: memory-mapped SVI store folder (see SVI_store.py), built if stale
+    :return: (combined DataFrame, dict of failed MSA -> error message)
+    """
+    if cities is None:
+        cities = discover_cities(pathroot)
+    todo = [c for c in cities if not (resume and is_done(pathroot, c))]
+    print(f"{len(cities)} MSAs, {len(cities) - len(todo)} already done, {len(todo)} to run")
+
+    failures = {}
+    if todo:
+        workers = plan_workers(pathroot, todo, max_workers, chunksize)
+        print(f"Running with {workers} worker(s)")
+        svi_file = os.path.join(pathroot, ssi.SVI_FILE)
+        if svi_store_dir is not None:
+            from data_process.SVI_store import open_svi_store
+
+            open_svi_store(svi_store_dir, svi_file)
+        elif cache_dir:
+            # 使用缓存时仅在重建缓存时才需要 SVI，由 run_city 按需加载
+            svi_file = None
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(svi_file, svi_store_dir)) as pool:
+            futures = {pool.submit(_run_city, pathroot, c, local_side, chunksize, cache_dir): c for c in todo}
+            for future in as_completed(futures):
+                city = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    failures[city] = str(e)
+                    print(f"Error processing {city}: {str(e)}")
+
+    combined = merge_global_ssi(pathroot, cities, output_file)
+    if failures:
+        print(f"{len(failures)} MSA(s) failed, re-run with resume=True to retry: {sorted(failures)}")
+    print(f"Combined global SSI saved to {output_file}")
+    return combined, failures
+
+
+if __name__ == '__main__':
+    Pathroot = "/soge-home/users/cenv0925/"
+    output_file = os.path.join(Pathroot, "SVI", "Result", "SSI_golbal_data.csv")
+    run_batch(Pathroot, output_file)
@@ -0,0 +1,130 @@
+"""
+Prebuilt, memory-mapped SVI lookup store.
+
+``SVI2018_US.csv`` has about 72k tracts and 100+ columns, but the SSI
+computation only needs FIPS and the five SPL_THEME columns.  The store keeps
+them as FIPS-sorted NumPy arrays (``svi_fips.npy`` and ``svi_spl.npy``) that are
+opened with ``mmap_mode='r'`` and searched with binary search, so pulling the
+tracts of one MSA costs microseconds instead of re-parsing the CSV.
+
+Tracts carrying the -999 sentinel in SPL_THEME1 or SPL_THEME4 are dropped once
+at build time, which is the same filter ``build_tract_table`` applies.
+"""
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+from data_process import SSI_Calculation as ssi
+from data_process.OD_cache import file_checksum
+
+STORE_VERSION = 1
+FIPS_FILE = 'svi_fips.npy'
+SPL_FILE = 'svi_spl.npy'
+MANIFEST_FILE = 'svi_manifest.json'
+
+
+class SVIStore:
+    def __init__(self, fips, spl):
+        self.fips = fips  # 升序排列的 FIPS, int64
+        self.spl = spl  # (n, 5) SPL_THEME1..SPL_THEMES, float64
+
+    @classmethod
+    def open(cls, store_dir):
+        """Memory-map a store built by build_svi_store."""
+        return cls(np.load(os.path.join(store_dir, FIPS_FILE), mmap_mode='r'),
+                   np.load(os.path.join(store_dir, SPL_FILE), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.fips)
+
+    def locate(self, tract_ids):
+        """
+        Binary-search tract IDs in the store.
+
+        :param tract_ids: array of FIPS codes
+        :return: int array of store rows, -1 for tracts not in the store
+        """
+        tract_ids = np.asarray(tract_ids)
+        if len(self.fips) == 0:
+            return np.full(len(tract_ids), -1)
+        pos = np.clip(np.searchsorted(self.fips, tract_ids), 0, len(self.fips) - 1)
+        return np.where(self.fips[pos] == tract_ids, pos, -1)
+
+    def select_tracts(self, tract_ids):
+        """
+        SVI rows of the requested tracts, in the layout of load_svi.
+
+        :param tract_ids: array of FIPS codes
+        :return: DataFrame FIPS, SPL_THEME1..SPL_THEMES for the tracts found
+        """
+        tract_ids = np.asarray(tract_ids)
+        rows = self.locate(tract_ids)
+        found = rows >= 0
+        df = pd.DataFrame(np.asarray(self.spl[rows[found]]), columns=ssi.SPL_COLUMNS)
+        df.insert(0, 'FIPS', tract_ids[found])
+        return df
+
+
+def build_svi_store(svi_file, store_dir):
+    """
+    Build the store from SVI2018_US.csv.
+
+    :param svi_file: path to SVI2018_US.csv
+    :param store_dir: output folder
+    :return: SVIStore opened on the new files
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    svi = ssi.load_svi(svi_file)
+    valid = (svi['SPL_THEME1'] != ssi.SVI_MISSING) & (svi['SPL_THEME4'] != ssi.SVI_MISSING)
+    svi = svi[valid].sort_values('FIPS', kind='stable')
+    for name, values in ((FIPS_FILE, svi['FIPS'].to_numpy(dtype=np.int64)),
+                         (SPL_FILE, svi[ssi.SPL_COLUMNS].to_numpy(dtype=np.float64))):
+        path = os.path.join(store_dir, name)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, values)
+        os.replace(path + '.tmp', path)
+
+    stat = os.stat(svi_file)
+    manifest = {'version': STORE_VERSION, 'source': os.path.abspath(svi_file), 'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns, 'sha1': file_checksum(svi_file), 'n_tracts': int(len(svi))}
+    with open(os.path.join(store_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    return SVIStore.open(store_dir)
+
+
+def is_store_fresh(store_dir, svi_file):
+    """True if the store exists and was built from the current SVI file."""
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    if not all(os.path.exists(os.path.join(store_dir, f)) for f in (FIPS_FILE, SPL_FILE, MANIFEST_FILE)):
+        return False
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != STORE_VERSION:
+        return False
+    stat = os.stat(svi_file)
+    if stat.st_size == manifest['size'] and stat.st_mtime_ns == manifest['mtime_ns']:
+        return True
+    return file_checksum(svi_file) == manifest['sha1']
+
+
+def open_svi_store(store_dir, svi_file=None):
+    """
+    Open the store, building or rebuilding it first if svi_file is newer.
+
+    :param store_dir: store folder
+    :param svi_file: path to SVI2018_US.csv (optional; without it the store is opened as is)
+    :return: SVIStore
+    """
+    if svi_file is not None and not is_store_fresh(store_dir, svi_file):
+        print(f"Building SVI store in {store_dir}")
+        return build_svi_store(svi_file, store_dir)
+    return SVIStore.open(store_dir)
+
+
+if __name__ == "__main__":
+    Pathroot = "/soge-home/users/cenv0925/"
+    store_folder = os.path.join(Pathroot, "SVI", "Data", "SVI_store")
+    store = build_svi_store(os.path.join(Pathroot, ssi.SVI_FILE), store_folder)
+    print(f"SVI store with {len(store)} tracts saved to {store_folder}")
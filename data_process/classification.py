@@ -0,0 +1,123 @@
+"""
+Vectorized classification of SSI values into segregation classes.
+
+The strategies are the ones ``data_reader`` has always offered:
+
+- ``quartiles``: 3 classes split at the 25th and 75th percentiles
+- ``tertiles``: 3 classes split at the 33.33th and 66.66th percentiles
+- ``median`` / ``binary``: 2 classes split at the median
+- ``quartiles_4``: 4 classes split at the quartiles
+- ``jenks``: ``n_classes`` Jenks natural breaks (requires jenkspy)
+
+Each strategy produces an increasing array of internal breaks and the classes
+come from one ``np.digitize`` (a value equal to a break goes to the upper
+class).  With ``groups`` (e.g. the MSA of every tract) the breaks are computed
+per group, so tract tables of all MSAs are classified in one call.
+"""
+import numpy as np
+import pandas as pd
+
+PERCENTILE_STRATEGIES = {
+    'quartiles': [25, 75],
+    'tertiles': [33.33, 66.66],
+    'median': [50],
+    'binary': [50],
+    'quartiles_4': [25, 50, 75],
+}
+STRATEGIES = list(PERCENTILE_STRATEGIES) + ['jenks']
+
+
+def _check_strategy(strategy):
+    if strategy not in STRATEGIES:
+        raise ValueError("classification_strategy must be one of: 'quartiles', 'tertiles', 'median'/'binary', 'quartiles_4', or 'jenks'")
+
+
+def class_breaks(values, strategy='quartiles', n_classes=None):
+    """
+    Internal class breaks of one set of values.
+
+    :param values: 1-D array of values
+    :param strategy: one of STRATEGIES
+    :param n_classes: number of classes (jenks only)
+    :return: increasing array of len(classes) - 1 breaks
+    """
+    _check_strategy(strategy)
+    values = np.asarray(values, dtype=float)
+    if strategy == 'jenks':
+        try:
+            import jenkspy
+        except ImportError:
+            raise ImportError("jenkspy library is required for Jenks natural breaks. Install it with: pip install jenkspy")
+        # 去掉首尾（最小值、最大值），只保留内部分界点
+        return np.asarray(jenkspy.jenks_breaks(values, n_classes=n_classes), dtype=float)[1:-1]
+    return np.percentile(values, PERCENTILE_STRATEGIES[strategy])
+
+
+def digitize(values, breaks):
+    """
+    Class of every value for increasing breaks; NaN values and NaN breaks give the last class.
+
+    :param values: array of values
+    :param breaks: increasing array of internal breaks
+    :return: int array of classes 0..len(breaks)
+    """
+    values = np.asarray(values, dtype=float)
+    breaks = np.asarray(breaks, dtype=float)
+    if np.isnan(breaks).any():
+        # 与逐个比较一致：与 NaN 比较恒为 False，全部落入最后一类
+        return np.full(values.shape, len(breaks), dtype=np.int64)
+    return np.digitize(values, breaks).astype(np.int64)
+
+
+def classify(values, strategy='quartiles', n_classes=None, groups=None):
+    """
+    Classify values with a strategy, optionally with separate breaks per group.
+
+    :param values: 1-D array of values (e.g. the themes column)
+    :param strategy: one of STRATEGIES
+    :param n_classes: number of classes (jenks only)
+    :param groups: optional 1-D array of group labels (e.g. MSA names)
+    :return: int array of classes
+    """
+    _check_strategy(strategy)
+    values = np.asarray(values, dtype=float)
+    if groups is None:
+        return digitize(values, class_breaks(values, strategy, n_classes))
+
+    codes, uniques = pd.factorize(np.asarray(groups))
+    if strategy == 'jenks':
+        classes = np.empty(len(values), dtype=np.int64)
+        for g in range(len(uniques)):
+            members = codes == g
+            classes[members] = digitize(values[members], class_breaks(values[members], strategy, n_classes))
+        return classes
+
+    # 每组分位数一次算出，再按行取本组的分界点：类别 = 不大于该值的分界点个数
+    q = np.asarray(PERCENTILE_STRATEGIES[strategy]) / 100.0
+    grouped = pd.Series(values).groupby(codes)
+    breaks = grouped.quantile(q).unstack().reindex(range(len(uniques))).to_numpy(dtype=float, copy=True)
+    # np.percentile 遇到 NaN 返回 NaN，pandas 会跳过 NaN：恢复前者的行为
+    has_nan = np.bincount(codes, weights=np.isnan(values), minlength=len(uniques)) > 0
+    breaks[has_nan] = np.nan
+    row_breaks = breaks[codes]
+    classes = (values[:, None] >= row_breaks).sum(axis=1)
+    classes[np.isnan(row_breaks).any(axis=1)] = breaks.shape[1]
+    return classes.astype(np.int64)
+
+
+def classify_table(table, column='themes', strategy='quartiles', n_classes=None, groups=None, target='init_class'):
+    """
+    Classify a column of a CityTable/TractTable and store the classes in another column.
+
+    :param table: CityTable or TractTable
+    :param column: column to classify (any theme column)
+    :param strategy: one of STRATEGIES
+    :param n_classes: number of classes (jenks only)
+    :param groups: optional group labels, or the name of a table column holding them
+    :param target: column receiving the classes
+    :return: the table
+    """
+    if isinstance(groups, str):
+        groups = table[groups]
+    table.set_column(target, classify(table[column], strategy, n_classes, groups))
+    return table
@@ -1,17 +1,18 @@
 #读取SSI_golbal_data.csv文件
 import csv
-from data_process.data_struct import  city,census_tract
+from data_process.data_struct import CityTable, TractTable, normalize_city_name
+from data_process.classification import classify_table
+import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import geopandas as gpd
-from shapely.geometry import mapping
 import json
-from shapely.geometry import Point
 
 
 def data_reader(file_path, init_classes, cluster_file=None, classification_strategy='quartiles'):
     '''
-    读取合并以后的CSV，返回list[data_process]
+    读取合并以后的CSV，返回 CityTable（列式存储，可按行以属性方式访问；
+    city_list.record(name) / city_list.registry() 按城市名查找）
     :param file_path: CSV文件路径
     :param init_classes: 初始类别数
     :param cluster_file: 聚类结果文件路径（可选）
@@ -22,112 +23,26 @@ def data_reader(file_path, init_classes, cluster_file=None, classification_strat
     with open(city_location_file, 'r') as f:
         city_location_data = json.load(f)
 
-    city_list = []
+    names, themes, cluster_classes = [], [], []
     with open(file_path, 'r', encoding='utf-8') as f:
         reader = csv.reader(f)
         for row in reader:
             #跳过第一行
             if reader.line_num == 1:
                 continue
-            cur_city=city(row[0])
-            cur_city.latitude=city_location_data[row[0]]['lat']
-            cur_city.longitude=city_location_data[row[0]]['lng']
-            cur_city.theme1=float(row[1])
-            cur_city.theme2=float(row[2])
-            cur_city.theme3=float(row[3])
-            cur_city.theme4=float(row[4])
-            cur_city.themes=float(row[5])
-            if len(row)>6:
-                cur_city.cluster_class = float(row[7])
-
-            city_list.append(cur_city)
+            names.append(row[0])
+            themes.append([float(v) for v in row[1:6]])
+            cluster_classes.append(float(row[7]) if len(row)>6 else None)
+
+        # 列式存储，行访问（cur_city.theme1 等）保持不变
+        city_list = CityTable(names, np.asarray(themes, dtype=float).reshape(-1, 5),
+                              cluster_class=np.array(cluster_classes, dtype=object),
+                              latitude=np.array([city_location_data[name]['lat'] for name in names], dtype=float),
+                              longitude=np.array([city_location_data[name]['lng'] for name in names], dtype=float))
         # 按 themes 进行排序
-        city_list.sort(key=lambda x: x.themes)
-        themes_list = [city.themes for city in city_list]
-
-        if classification_strategy == 'quartiles':
-            # 四分位数分类
-            q1 = np.percentile(themes_list, 25)  # 25% 分位数
-            q2 = np.percentile(themes_list, 50)  # 50% 分位数（中位数）
-            q3 = np.percentile(themes_list, 75)  # 75% 分位数
-
-            # 赋值类别
-            for cur_city in city_list:
-                if cur_city.themes < q1:
-                    cur_city.init_class = 0  # 低隔离
-                elif cur_city.themes < q3:
-                    cur_city.init_class = 1  # 中等隔离
-                else:
-                    cur_city.init_class = 2  # 高隔离
-        elif classification_strategy == 'tertiles':
-            # 三分位数分类
-            t1 = np.percentile(themes_list, 33.33)  # 33.33% 分位数
-            t2 = np.percentile(themes_list, 66.66)  # 66.66% 分位数
-
-            # 赋值类别
-            for cur_city in city_list:
-                if cur_city.themes < t1:
-                    cur_city.init_class = 0  # 低隔离
-                elif cur_city.themes < t2:
-                    cur_city.init_class = 1  # 中等隔离
-                else:
-                    cur_city.init_class = 2  # 高隔离
-        elif classification_strategy == 'median' or classification_strategy == 'binary':
-            # 二分类：使用中位数分割
-            median = np.percentile(themes_list, 50)  # 50% 分位数（中位数）
-
-            # 赋值类别
-            for cur_city in city_list:
-                if cur_city.themes < median:
-                    cur_city.init_class = 0  # 低隔离度
-                else:
-                    cur_city.init_class = 1  # 高隔离度
-        elif classification_strategy == 'quartiles_4':
-            # 真正的四分类：使用四分位数分成4类
-            q1 = np.percentile(themes_list, 25)  # 25% 分位数
-            q2 = np.percentile(themes_list, 50)  # 50% 分位数（中位数）
-            q3 = np.percentile(themes_list, 75)  # 75% 分位数
-
-            # 赋值类别
-            for cur_city in city_list:
-                if cur_city.themes < q1:
-                    cur_city.init_class = 0  # 低隔离
-                elif cur_city.themes < q2:
-                    cur_city.init_class = 1  # 中低隔离
-                elif cur_city.themes < q3:
-                    cur_city.init_class = 2  # 中高隔离
-                else:
-                    cur_city.init_class = 3  # 高隔离
-        elif classification_strategy == 'jenks':
-            # Jenks natural breaks 分类
-            try:
-                import jenkspy
-            except ImportError:
-                raise ImportError("jenkspy library is required for Jenks natural breaks. Install it with: pip install jenkspy")
-            
-            # 使用 Jenks natural breaks 计算分界点
-            breaks = jenkspy.jenks_breaks(themes_list, n_classes=init_classes)
-            
-            # 赋值类别
-            for cur_city in city_list:
-                assigned = False
-                # 遍历所有分界点区间
-                for i in range(len(breaks) - 1):
-                    if i == len(breaks) - 2:  # 最后一个区间，包含右边界
-                        if breaks[i] <= cur_city.themes <= breaks[i + 1]:
-                            cur_city.init_class = i
-                            assigned = True
-                            break
-                    else:  # 其他区间，左闭右开
-                        if breaks[i] <= cur_city.themes < breaks[i + 1]:
-                            cur_city.init_class = i
-                            assigned = True
-                            break
-                # 如果还没有分配（理论上不应该发生），分配到最后一类
-                if not assigned:
-                    cur_city.init_class = init_classes - 1
-        else:
-            raise ValueError("classification_strategy must be one of: 'quartiles', 'tertiles', 'median'/'binary', 'quartiles_4', or 'jenks'")
+        city_list = city_list.sort_by('themes')
+        # 按分类策略一次性给所有城市赋类别（见 classification.py）
+        classify_table(city_list, 'themes', classification_strategy, n_classes=init_classes)
 
         if cluster_file is not None:
             with open(cluster_file, 'r', encoding='utf-8') as f:
@@ -139,129 +54,104 @@ def data_reader(file_path, init_classes, cluster_file=None, classification_strat
 
         return city_list
 
+def join_city_results(city_list, results, columns=None, name_column=0):
+    '''
+    按城市名一次性合并任意逐城市结果文件（Moran、聚类、Gi* 汇总等）
+    :param city_list: CityTable 或 list[City]
+    :param results: 结果CSV路径或 DataFrame
+    :param columns: 结果列 -> 城市属性的字典，或同名保留的列名列表（默认除城市名外全部列）
+    :param name_column: 城市名所在列（列名或列号），如 'Boston_census_tract' 会规范为 'Boston'
+    :return: 合并后的 CityTable
+    '''
+    table = CityTable.coerce(city_list)
+    # round_trip 与 float() 解析结果逐位一致
+    df = pd.read_csv(results, float_precision='round_trip') if isinstance(results, str) else results
+    on = df.columns[name_column] if isinstance(name_column, int) else name_column
+    return table.join(df, columns, on=on, normalize=normalize_city_name)
+
 def read_moran_results(file_path,city_list):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            if reader.line_num == 1:
-                continue
-            city_name=row[0].split('_')[0]
-            for cur_city in city_list:
-                if cur_city.name == city_name:
-                    cur_city.theme1_moran = float(row[1])
-                    cur_city.theme2_moran = float(row[2])
-                    cur_city.theme3_moran = float(row[3])
-                    cur_city.theme4_moran = float(row[4])
-                    cur_city.themes_moran=float(row[5])
-    return  city_list
+    # 第 1-5 列依次为 theme1..themes 的 Moran's I
+    df = pd.read_csv(file_path, float_precision='round_trip')
+    moran_columns = ['theme1_moran', 'theme2_moran', 'theme3_moran', 'theme4_moran', 'themes_moran']
+    return join_city_results(city_list, df, dict(zip(df.columns[1:6], moran_columns)))
 
 
 def data_reader_census_tract(file_path):
     '''
-    读取合并以后的CSV，返回list[data_process]
+    读取合并以后的CSV，返回 TractTable（列式存储，可按行以属性方式访问）
     :param file_path:
     :return:
     '''
-    city_list = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            #跳过第一行
-            if reader.line_num == 1:
-                continue
-            cur_city = census_tract(int(row[0]))
-            cur_city.theme1 = float(row[11])
-            cur_city.theme2 = float(row[12])
-            cur_city.theme3 = float(row[13])
-            cur_city.theme4 = float(row[14])
-            cur_city.themes = float(row[15])
-            city_list.append(cur_city)
-        # 按 themes 进行排序
-        city_list.sort(key=lambda x: x.themes)
-
-        themes_list = [city.themes for city in city_list]
-        q1 = np.percentile(themes_list, 25)  # 25% 分位数
-        q2 = np.percentile(themes_list, 50)  # 50% 分位数（中位数）
-        q3 = np.percentile(themes_list, 75)  # 75% 分位数
-
-        # 赋值类别
-        for cur_city in city_list:
-            if cur_city.themes < q1:
-                cur_city.init_class = 0  # 低隔离
-            elif cur_city.themes < q3:
-                cur_city.init_class = 1  # 中等隔离
-            else:
-                cur_city.init_class = 2  # 高隔离
-        return city_list
+    # 第 0 列为 TractID，第 11-15 列为 THEME1..THEMES（NaN 按浮点读入）
+    df = pd.read_csv(file_path, usecols=[0, 11, 12, 13, 14, 15])
+    city_list = TractTable(df.iloc[:, 0].to_numpy(dtype=np.int64), df.iloc[:, 1:6].to_numpy(dtype=float))
+    # 按 themes 进行排序
+    city_list = city_list.sort_by('themes')
+    # 四分位数分类：低 / 中等 / 高隔离
+    classify_table(city_list, 'themes', 'quartiles')
+    return city_list
 
 
 def save_results_to_csv(city_list, output_file):
     '''
     保存城市数据到CSV文件
-    :param city_list: list[City] 城市数据
+    :param city_list: CityTable 或 list[City] 城市数据
     :param output_file: 输出CSV文件路径
     '''
+    table = CityTable.coerce(city_list)
     with open(output_file, 'w', newline='', encoding='utf-8') as f:
         writer = csv.writer(f)
         writer.writerow(["City", "Theme1", "Theme2", "Theme3", "Theme4", "Themes", "Init_Class", "Cluster_Class"])
-        for city in city_list:
-            writer.writerow([city.name, city.theme1, city.theme2, city.theme3, city.theme4, city.themes, city.init_class, city.cluster_class])
+        writer.writerows(zip(*(table[c] for c in ['name', 'theme1', 'theme2', 'theme3', 'theme4', 'themes', 'init_class', 'cluster_class'])))
 
 def save_results_to_csv_census_track(census_tract_list , output_file):
     '''
     保存城市数据到CSV文件
-    :param city_list: list[City] 城市数据
+    :param city_list: TractTable 或 list[census_tract] 数据
     :param output_file: 输出CSV文件路径
     '''
+    table = TractTable.coerce(census_tract_list)
     with open(output_file, 'w', newline='', encoding='utf-8') as f:
         writer = csv.writer(f)
         writer.writerow(["ID", "Theme1", "Theme2", "Theme3", "Theme4", "Themes", "Init_Class", "Cluster_Class"])
-        for cur_cencus_tract in census_tract_list:
-            writer.writerow([cur_cencus_tract.id, cur_cencus_tract.theme1, cur_cencus_tract.theme2, cur_cencus_tract.theme3, cur_cencus_tract.theme4, cur_cencus_tract.themes, cur_cencus_tract.init_class, cur_cencus_tract.cluster_class])
+        writer.writerows(zip(*(table[c] for c in ['id', 'theme1', 'theme2', 'theme3', 'theme4', 'themes', 'init_class', 'cluster_class'])))
 
 def associate_shapes(census_tract_list, shapefile_path):
     '''
     读取 shapefile 并将 shape 数据关联到 census_tract_list
-    :param census_tract_list: Census Tract 对象列表
+    :param census_tract_list: TractTable 或 Census Tract 对象列表
     :param shapefile_path: Shapefile 文件路径
-    :return: 关联后的 census_tract_list
+    :return: 关联后的 TractTable
     '''
+    table = TractTable.coerce(census_tract_list)
     # 读取 shapefile
     gdf = gpd.read_file(shapefile_path)
 
-    # 将 shapefile 数据转换为字典（key: geoid, value: geometry）
-    shape_dict = {int(row['GEOID']): row['geometry'] for _, row in gdf.iterrows()}
-
-    # 关联 shape 数据
-    for tract in census_tract_list:
-        if tract.id in shape_dict:
-            tract.shape = shape_dict[tract.id]
-    return census_tract_list
+    # 按 GEOID 一次性对齐几何（GEOID 重复时保留最后一条，与逐行建字典一致）
+    shapes = pd.Series(gdf.geometry.to_numpy(), index=gdf['GEOID'].astype(np.int64))
+    shapes = shapes[~shapes.index.duplicated(keep='last')]
+    ids = table['id'].astype(np.int64)
+    found = shapes.index.get_indexer(ids)
+    shape_column = table['shape'].astype(object)
+    shape_column[found >= 0] = shapes.to_numpy()[found[found >= 0]]
+    table.set_column('shape', shape_column)
+    return table
 
 def save_census_tracts_to_geojson(census_tract_list, output_file):
     '''
     将 census_tract_list 保存为 GeoJSON 文件
-    :param census_tract_list: census_tract 对象列表
+    :param census_tract_list: TractTable 或 census_tract 对象列表
     :param output_file: 输出的 GeoJSON 文件路径
     '''
-    # 构建 GeoDataFrame 所需的数据
-    data = []
-    for tract in census_tract_list:
-        if tract.shape:  # 确保 shape 存在
-            data.append({
-                "id": tract.id,
-                "theme1": tract.theme1,
-                "theme2": tract.theme2,
-                "theme3": tract.theme3,
-                "theme4": tract.theme4,
-                "themes": tract.themes,
-                "init_class": tract.init_class,
-                "cluster_class": tract.cluster_class,
-                "geometry": tract.shape  # 这里 shape 仍然是 Shapely Polygon
-            })
+    table = TractTable.coerce(census_tract_list)
+    df = table.to_dataframe()
+    # 确保 shape 存在
+    has_shape = np.array([shape is not None and not shape.is_empty for shape in table['shape']], dtype=bool)
+    df = df[has_shape]
+    columns = ["id", "theme1", "theme2", "theme3", "theme4", "themes", "init_class", "cluster_class"]
 
     # 创建 GeoDataFrame（geometry 直接使用 Shapely Polygon）
-    gdf = gpd.GeoDataFrame(data, geometry=[d["geometry"] for d in data])
+    gdf = gpd.GeoDataFrame(df[columns].reset_index(drop=True), geometry=list(df['shape']))
 
     # 保存为 GeoJSON
     gdf.to_file(output_file, driver="GeoJSON")
@@ -277,22 +167,16 @@ def save_city_location(city_list, output_file,init_class=None,cluster_class=None
     :return:
     """
     #读取城市列表，根据init_class 和cluster_class , 保存结果到Geojson
-    data = []
-    for city in city_list:
-        if (init_class is None or city.init_class == init_class) and \
-                (cluster_class is None or city.cluster_class == cluster_class):
-            data.append({
-                "name": city.name,
-                "theme1": city.theme1,
-                "theme2": city.theme2,
-                "theme3": city.theme3,
-                "theme4": city.theme4,
-                "themes": city.themes,
-                "init_class": city.init_class,
-                "cluster_class": city.cluster_class,
-                "geometry": Point(city.longitude, city.latitude)
-            })
-    gdf = gpd.GeoDataFrame(data, crs="EPSG:4326")
+    table = CityTable.coerce(city_list)
+    selected = np.ones(len(table), dtype=bool)
+    if init_class is not None:
+        selected &= table['init_class'] == init_class
+    if cluster_class is not None:
+        selected &= table['cluster_class'] == cluster_class
+    df = table.to_dataframe()[selected]
+    columns = ["name", "theme1", "theme2", "theme3", "theme4", "themes", "init_class", "cluster_class"]
+    gdf = gpd.GeoDataFrame(df[columns].reset_index(drop=True),
+                           geometry=gpd.points_from_xy(df['longitude'], df['latitude']), crs="EPSG:4326")
 
     # 保存为GeoJSON
     gdf.to_file(output_file, driver="GeoJSON")
@@ -1,4 +1,10 @@
 # 定义数据结构
+import os
+
+import numpy as np
+import pandas as pd
+
+
 class city:
     def __init__(self, name ):
         self.name = name
@@ -30,4 +36,282 @@ class census_tract:
         self.init_class=None #这里是预设值的分类主题，一共三十个城市，预设成三类（高，中，低）
         self.cluster_class=None
 
-        self.shape=None
\ No newline at end of file
+        self.shape=None
+
+# 列式存储：所有城市 / Census Tract 的属性各存为一个 NumPy 数组，
+# 五个主题值共用一个 (n, 5) 矩阵，逐行访问通过 _Row 代理保持 city.theme1 这样的写法
+THEME_COLUMNS = ['theme1', 'theme2', 'theme3', 'theme4', 'themes']
+# 结果文件中城市名可能带的文件扩展名
+RESULT_EXTENSIONS = ('.csv', '.geojson', '.json', '.shp')
+
+
+class _Row:
+    """Attribute-style view of one row of a _RecordTable (reads and writes go to the table)."""
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        object.__setattr__(self, '_table', table)
+        object.__setattr__(self, '_index', index)
+
+    def __getattr__(self, name):
+        return self._table._get(name, self._index)
+
+    def __setattr__(self, name, value):
+        self._table._set(name, self._index, value)
+
+    def __repr__(self):
+        return f"<{type(self._table).__name__} row {self._table._get(self._table.key, self._index)!r}>"
+
+
+class _RecordTable:
+    """
+    Column-oriented table of cities or census tracts.
+
+    Iterating (or indexing with an int) yields row proxies with the same
+    attributes as the ``city``/``census_tract`` objects; ``table[column]``
+    returns the whole column as an array, ``theme_matrix()`` the (n, 5) theme
+    values without copying and ``to_dataframe()`` a DataFrame whose theme
+    columns share that memory.
+    """
+    key = None
+    attributes = []
+
+    def __init__(self, keys, theme_matrix=None, **columns):
+        keys = np.asarray(keys)
+        if keys.dtype.kind == 'U':
+            keys = keys.astype(object)
+        n = len(keys)
+        self._themes = np.full((n, len(THEME_COLUMNS)), np.nan) if theme_matrix is None \
+            else np.ascontiguousarray(theme_matrix, dtype=float)
+        if self._themes.shape != (n, len(THEME_COLUMNS)):
+            raise ValueError(f"theme_matrix must have shape ({n}, {len(THEME_COLUMNS)})")
+        self._columns = {self.key: keys}
+        for name in self.attributes:
+            self._columns[name] = np.full(n, None, dtype=object)
+        for name, values in columns.items():
+            self.set_column(name, values)
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """Build a table from a DataFrame with the key column, theme columns and any attributes."""
+        themes = df.reindex(columns=THEME_COLUMNS).to_numpy(dtype=float)
+        others = {c: df[c].to_numpy() for c in df.columns if c not in THEME_COLUMNS and c != cls.key}
+        return cls(df[cls.key].to_numpy(), themes, **others)
+
+    @classmethod
+    def from_objects(cls, objects):
+        """Build a table from a list of city/census_tract objects."""
+        objects = list(objects)
+        names = [cls.key] + THEME_COLUMNS + [a for a in cls.attributes if a != cls.key]
+        return cls.from_dataframe(pd.DataFrame({name: [getattr(o, name, None) for o in objects] for name in names}))
+
+    @classmethod
+    def coerce(cls, records):
+        """Return records as a table of this type (tables are returned unchanged)."""
+        return records if isinstance(records, cls) else cls.from_objects(records)
+
+    def __len__(self):
+        return len(self._themes)
+
+    def __iter__(self):
+        return (_Row(self, i) for i in range(len(self)))
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            return self.column(item)
+        if isinstance(item, (int, np.integer)):
+            if not -len(self) <= item < len(self):
+                raise IndexError("row index out of range")
+            return _Row(self, int(item) % len(self))
+        # 切片 / 布尔掩码 / 索引数组：返回子表
+        return self.take(np.arange(len(self))[item])
+
+    def column(self, name):
+        """Whole column as an array (theme columns are views into the theme matrix)."""
+        if name in THEME_COLUMNS:
+            return self._themes[:, THEME_COLUMNS.index(name)]
+        return self._columns[name]
+
+    def set_column(self, name, values):
+        """Set a whole column from a scalar or an array of length n."""
+        values = np.asarray(values)
+        if values.ndim == 0:
+            values = np.full(len(self), values.item(), dtype=values.dtype)
+        if values.dtype.kind == 'U':
+            # 定长字符串会截断更长的新值，统一存为 object
+            values = values.astype(object)
+        if name in THEME_COLUMNS:
+            self._themes[:, THEME_COLUMNS.index(name)] = values
+        else:
+            self._columns[name] = values
+
+    @property
+    def columns(self):
+        return [self.key] + THEME_COLUMNS + [c for c in self._columns if c != self.key]
+
+    def _get(self, name, i):
+        if name in THEME_COLUMNS:
+            return self._themes[i, THEME_COLUMNS.index(name)]
+        try:
+            return self._columns[name][i]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def _set(self, name, i, value):
+        if name in THEME_COLUMNS:
+            self._themes[i, THEME_COLUMNS.index(name)] = np.nan if value is None else value
+            return
+        column = self._columns.get(name)
+        if column is None:
+            column = self._columns[name] = np.full(len(self), None, dtype=object)
+        if column.dtype != object and not np.can_cast(np.asarray(value).dtype, column.dtype, casting='same_kind'):
+            # 类型不兼容（如向数值列写入 None 或小数）时改为 object 列
+            column = self._columns[name] = column.astype(object)
+        column[i] = value
+        if name == self.key:
+            self._index_cache = None
+
+    def _key_index(self):
+        # 键 -> 行号的哈希索引（键重复时取第一行，与线性查找一致）；
+        # 键列未变时复用（按数组对象判断，set_column 会换新数组）
+        keys = self._columns[self.key]
+        cached = getattr(self, '_index_cache', None)
+        if cached is None or cached[0] is not keys:
+            first = ~pd.Index(keys).duplicated(keep='first')
+            cached = self._index_cache = (keys, pd.Index(keys[first]), np.flatnonzero(first))
+        return cached[1], cached[2]
+
+    def index_of(self, keys):
+        """
+        Row positions of keys through a hash index (-1 for missing keys).
+
+        :param keys: one key or an array of keys
+        :return: int, or int array
+        """
+        index, positions = self._key_index()
+        scalar = np.ndim(keys) == 0
+        found = index.get_indexer(np.atleast_1d(np.asarray(keys, dtype=object)))
+        if len(positions):
+            found = np.where(found >= 0, positions[found], -1)
+        return int(found[0]) if scalar else found
+
+    def record(self, key):
+        """Row proxy of a key (KeyError if it is not in the table)."""
+        i = self.index_of(key)
+        if i < 0:
+            raise KeyError(key)
+        return _Row(self, i)
+
+    def registry(self):
+        """Dict key -> row proxy (first row for a duplicated key)."""
+        registry = {}
+        for i, key in enumerate(self._columns[self.key]):
+            registry.setdefault(key, _Row(self, i))
+        return registry
+
+    def join(self, results, columns=None, on=None, normalize=None):
+        """
+        Copy columns of a per-row result table into this table in one merge.
+
+        Every table row takes the values of the result row with the same key
+        (the last one if a key repeats); rows without a result keep their values.
+
+        :param results: DataFrame of results
+        :param columns: dict result column -> table column, or a list of
+            columns kept under the same name (default: all but ``on``)
+        :param on: key column of ``results`` (default: the first column)
+        :param normalize: optional function applied to the result keys
+            (e.g. normalize_city_name)
+        :return: the table
+        """
+        on = results.columns[0] if on is None else on
+        if columns is None:
+            columns = [c for c in results.columns if c != on]
+        if not isinstance(columns, dict):
+            columns = {c: c for c in columns}
+        keys = results[on].to_numpy()
+        if normalize is not None:
+            keys = np.asarray(normalize(keys), dtype=object)
+        # 结果键去重（保留最后一条，与逐行覆盖一致），再为表中每行找到对应结果行
+        keep = ~pd.Index(keys).duplicated(keep='last')
+        found = pd.Index(keys[keep]).get_indexer(self._columns[self.key])
+        hit = found >= 0
+        for source, target in columns.items():
+            values = results[source].to_numpy()[keep][found[hit]]
+            if hit.all():
+                self.set_column(target, values)
+                continue
+            column = self.column(target).copy() if target in self.columns else np.full(len(self), None, dtype=object)
+            if column.dtype != object and not np.can_cast(values.dtype, column.dtype, casting='same_kind'):
+                column = column.astype(object)
+            column[hit] = values
+            self.set_column(target, column)
+        return self
+
+    def take(self, indices):
+        """New table with the given rows (copies)."""
+        indices = np.asarray(indices)
+        table = type(self).__new__(type(self))
+        table._themes = self._themes[indices]
+        table._columns = {name: values[indices] for name, values in self._columns.items()}
+        return table
+
+    def sort_by(self, name, kind='stable'):
+        """
+        New table sorted by a column (stable, like sorted()).
+
+        Row proxies, registry() mappings and index_of positions are positional,
+        so the table itself is left unchanged: those already handed out keep
+        pointing at the same rows, as the objects of a list did after sorting.
+        """
+        return self.take(np.argsort(self.column(name), kind=kind))
+
+    def theme_matrix(self, themes=None):
+        """
+        Theme values as an (n, k) array.
+
+        Without ``themes`` this is the table's own storage (no copy, writes go
+        to the table); with a subset of THEME_COLUMNS a copy is returned.
+        """
+        if themes is None:
+            return self._themes
+        return self._themes[:, [THEME_COLUMNS.index(t) for t in themes]]
+
+    def to_dataframe(self):
+        """DataFrame of all columns; the theme columns share memory with the table."""
+        df = pd.DataFrame(self._themes, columns=THEME_COLUMNS, copy=False)
+        df.insert(0, self.key, self._columns[self.key])
+        for name, values in self._columns.items():
+            if name != self.key:
+                # object 列（默认 None 的属性）按实际取值推断类型
+                df[name] = pd.Series(values, copy=False).infer_objects() if values.dtype == object else values
+        return df
+
+
+class CityTable(_RecordTable):
+    """Columnar version of a list of ``city`` objects."""
+    key = 'name'
+    attributes = ['theme1_moran', 'theme2_moran', 'theme3_moran', 'theme4_moran', 'themes_moran',
+                  'init_class', 'cluster_class', 'longitude', 'latitude']
+
+
+class TractTable(_RecordTable):
+    """Columnar version of a list of ``census_tract`` objects."""
+    key = 'id'
+    attributes = ['init_class', 'cluster_class', 'shape']
+
+
+def normalize_city_name(name):
+    """
+    City name of a per-city result key such as 'Boston_census_tract' or
+    'Boston_census_tract.geojson' -> 'Boston' (text before the first '_',
+    as the Moran results have always been parsed).
+
+    Accepts a single name or an array of names.
+    """
+    if isinstance(name, str):
+        name = os.path.basename(name)
+        if name.lower().endswith(RESULT_EXTENSIONS):
+            name = os.path.splitext(name)[0]
+        return name.split('_')[0]
+    return np.array([normalize_city_name(str(n)) for n in name], dtype=object)
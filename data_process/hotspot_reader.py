@@ -0,0 +1,55 @@
+"""
+Attribute-only reader for the OHSA hotspot shapefiles.
+
+Most hotspot scripts only need ``SOURCE_ID`` and ``Gi_Bin``, yet
+``gpd.read_file`` decodes every polygon of every theme file.  The functions
+here read the DBF attribute table alone (pyogrio with ``read_geometry=False``,
+or fiona through ``ignore_geometry=True``) and, where geometry is needed, read
+it once per city and share it across the theme tables.
+"""
+import geopandas as gpd
+import pandas as pd
+
+HOTSPOT_COLUMNS = ['SOURCE_ID', 'Gi_Bin']
+
+
+def read_attributes(path, columns=None):
+    """
+    Read the attribute table of a shapefile (or GeoJSON) without decoding geometry.
+
+    :param path: shapefile or GeoJSON path
+    :param columns: columns to read (default: all)
+    :return: pandas DataFrame
+    """
+    try:
+        import pyogrio
+    except ImportError:
+        return gpd.read_file(path, columns=columns, ignore_geometry=True)
+    return pyogrio.read_dataframe(path, columns=columns, read_geometry=False)
+
+
+def read_hotspots(path, columns=HOTSPOT_COLUMNS):
+    """SOURCE_ID and Gi_Bin of one OHSA result shapefile."""
+    return read_attributes(path, columns)
+
+
+def read_city_hotspots(paths, columns=HOTSPOT_COLUMNS, with_geometry=False):
+    """
+    Read the hotspot attributes of all theme files of one city.
+
+    :param paths: theme shapefile paths of the city
+    :param columns: attribute columns to read
+    :param with_geometry: also return SOURCE_ID and geometry of the first file,
+        the only geometry decoded for the city
+    :return: list of DataFrames, or (list of DataFrames, GeoDataFrame)
+    """
+    if not with_geometry:
+        return [read_attributes(path, columns) for path in paths]
+    # 第一个主题文件只打开一次：几何与属性一起读取
+    read_columns = None if columns is None else list(dict.fromkeys(['SOURCE_ID'] + list(columns)))
+    first = gpd.read_file(paths[0], columns=read_columns)
+    first_table = pd.DataFrame(first.drop(columns=first.geometry.name))
+    if columns is not None:
+        first_table = first_table[list(columns)]
+    tables = [first_table] + [read_attributes(path, columns) for path in paths[1:]]
+    return tables, first[['SOURCE_ID', first.geometry.name]]
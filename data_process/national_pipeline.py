@@ -0,0 +1,540 @@
+"""
+National (all-MSA) pipeline driven by a sharded run manifest.
+
+``build_manifest`` splits the MSAs into shards of similar total OD size and
+writes ``manifest.json`` into a work folder.  ``run_pipeline`` runs the shards
+on a process pool; inside a worker the stages of a shard run in order
+
+    ssi -> tracts -> moran -> gi -> overlap
+
+(SSI, census-tract GeoJSON, Moran's I, Getis-Ord Gi*, hotspot overlap).  Every
+finished (shard, stage) writes a checkpoint with its wall time, throughput and
+peak memory, so an interrupted run resumes at the first unfinished stage and
+per-city outputs that already exist are not recomputed.  Tracts whose local
+SSI is not finite (e.g. tracts that only appear as OD destinations) are left
+out of the census-tract GeoJSON, like null features in OHSA, and their number
+per MSA is recorded in the tracts stage metrics.  ``merge_national``
+concatenates the per-shard tables into the national SSI, Moran and overlap
+tables and the stage metrics.
+"""
+import importlib.util
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from data_process import SSI_Calculation as ssi
+from data_process.SSI_batch import OD_SUFFIX, discover_cities, is_done, merge_global_ssi, plan_workers
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+STAGES = ['ssi', 'tracts', 'moran', 'gi', 'overlap']
+MANIFEST_FILE = 'manifest.json'
+DEFAULT_SHARD_SIZE = 40
+GI_THEMES = ['theme1', 'theme2', 'theme3', 'theme4']
+# 工作目录下各阶段的输出子目录
+TRACT_DIR = 'Census_tract'
+MORAN_DIR = 'Moran'
+GI_DIR = 'Getis_Ord'
+OVERLAP_DIR = 'Overlap'
+CHECKPOINT_DIR = 'checkpoints'
+DEFAULT_OPTIONS = {
+    'local_side': 'origin',
+    'chunksize': None,
+    'cache_dir': None,
+    'svi_store_dir': None,
+    # 相对 Pathroot 的 MSA census tract shapefile 路径
+    'shapefile_template': os.path.join('SVI', 'Data', 'Shapefiles', '{city}_MSA_CT.shp'),
+    'weights_cache_dir': None,
+    'permutations': 0,
+    'seed': None,
+    'gi_weights': 'distance_band',
+    'fdr': True,
+    # 'flow' 权重（Moran / Gi*）所需的 <City>_od.npz 目录（见 od_matrix.py）
+    'moran_weights': 'queen',
+    'od_dir': None,
+    'flow_symmetric': True,
+    'flow_threshold': None,
+    # Gi* 流量权重中 tract 自身的权重：'max' 为每行最大邻居流量，数值为固定的流量（人次）
+    'flow_self_weight': 'max',
+}
+
+_modules = {}
+
+
+# ---------------------------------------------------------------------------
+# manifest
+# ---------------------------------------------------------------------------
+def shard_cities(cities, sizes, n_shards):
+    """
+    Split MSAs into shards of similar total size (largest first onto the lightest shard).
+
+    :param cities: MSA names
+    :param sizes: dict MSA -> size (e.g. OD file bytes)
+    :param n_shards: number of shards
+    :return: list of sorted city lists
+    """
+    shards = [[] for _ in range(n_shards)]
+    loads = [0] * n_shards
+    for city in sorted(cities, key=lambda c: (-sizes.get(c, 0), c)):
+        i = min(range(n_shards), key=lambda k: (loads[k], len(shards[k])))
+        shards[i].append(city)
+        loads[i] += sizes.get(city, 0)
+    return [sorted(shard) for shard in shards if shard]
+
+
+def build_manifest(pathroot, workdir, cities=None, shard_size=DEFAULT_SHARD_SIZE, **options):
+    """
+    Write the run manifest of a national run.
+
+    :param pathroot: root folder containing SVI/Data and SVI/Result
+    :param workdir: folder of the manifest, checkpoints and per-stage outputs
+    :param cities: MSA names; if None, every Step1_TotalOD/*2019.csv is used
+    :param shard_size: MSAs per shard (shards are balanced by OD file size)
+    :param options: overrides of DEFAULT_OPTIONS
+    :return: manifest dict
+    """
+    unknown = set(options) - set(DEFAULT_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown pipeline options: {sorted(unknown)}")
+    if cities is None:
+        cities = discover_cities(pathroot)
+    sizes = {}
+    for city in cities:
+        od_file = os.path.join(pathroot, ssi.OD_DIR, f'{city}{OD_SUFFIX}')
+        sizes[city] = os.path.getsize(od_file) if os.path.exists(od_file) else 0
+    n_shards = max(1, math.ceil(len(cities) / shard_size))
+    manifest = {
+        'pathroot': pathroot,
+        'stages': STAGES,
+        'options': {**DEFAULT_OPTIONS, **options},
+        'shards': [{'id': i, 'cities': shard} for i, shard in enumerate(shard_cities(cities, sizes, n_shards))],
+    }
+    save_manifest(workdir, manifest)
+    print(f"{len(cities)} MSAs in {len(manifest['shards'])} shard(s), manifest saved to {workdir}")
+    return manifest
+
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def save_manifest(workdir, manifest):
+    _write_json(os.path.join(workdir, MANIFEST_FILE), manifest)
+
+
+def load_manifest(workdir):
+    with open(os.path.join(workdir, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    # 旧 manifest 中没有的选项取默认值
+    manifest['options'] = {**DEFAULT_OPTIONS, **manifest['options']}
+    return manifest
+
+
+def checkpoint_path(workdir, shard_id, stage):
+    return os.path.join(workdir, CHECKPOINT_DIR, f'shard_{shard_id:03d}_{stage}.json')
+
+
+def load_checkpoints(workdir):
+    """All stage checkpoints of a run as a DataFrame (one row per shard and stage)."""
+    folder = os.path.join(workdir, CHECKPOINT_DIR)
+    records = []
+    if os.path.isdir(folder):
+        for f in sorted(os.listdir(folder)):
+            if f.endswith('.json'):
+                with open(os.path.join(folder, f), 'r', encoding='utf-8') as fp:
+                    records.append(json.load(fp))
+    return pd.DataFrame(records)
+
+
+# ---------------------------------------------------------------------------
+# 内存统计
+# ---------------------------------------------------------------------------
+def _reset_peak_memory():
+    """Reset the process peak RSS (Linux only); elsewhere the peak is the process-wide maximum."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_memory():
+    """Peak resident memory of this process in bytes, or None if it cannot be determined."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    except ImportError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return None
+
+
+# ---------------------------------------------------------------------------
+# 各阶段（每个函数处理一个 shard 的城市，返回 (本次计算的城市, 失败城市 -> 错误信息)；
+# 输出已存在而跳过的城市不计入吞吐量）
+# ---------------------------------------------------------------------------
+def _analysis_module(name, relative_path):
+    # analysis/Getis-Ord 目录名含连字符，不能按包导入，按文件路径加载
+    if name not in _modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(project_root, relative_path))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _modules[name] = module
+    return _modules[name]
+
+
+def _for_each_city(cities, func):
+    done, failures = [], {}
+    for city in cities:
+        try:
+            # 返回 False 表示输出已存在、跳过
+            if func(city) is not False:
+                done.append(city)
+        except Exception as e:
+            failures[city] = str(e)
+            print(f"Error processing {city}: {str(e)}")
+    return done, failures
+
+
+def _tract_file(workdir, city):
+    return os.path.join(workdir, TRACT_DIR, f'{city}_census_tract.geojson')
+
+
+def _gi_files(workdir, city):
+    return [os.path.join(workdir, GI_DIR, f'{city}_census_tract_{theme}_OHSA_result.shp') for theme in GI_THEMES]
+
+
+def _shard_table(workdir, folder, shard_id):
+    return os.path.join(workdir, folder, f'shard_{shard_id:03d}.csv')
+
+
+def _save_table(df, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
+def stage_ssi(manifest, workdir, shard):
+    pathroot, options = manifest['pathroot'], manifest['options']
+    todo = [c for c in shard['cities'] if not is_done(pathroot, c)]
+    loaded = {}
+
+    def run(city):
+        # 每个 shard 只加载一次 SVI（使用 OD 缓存时由 run_city 按需加载）
+        if 'svi' not in loaded:
+            if options['cache_dir']:
+                loaded['svi'] = None
+            elif options['svi_store_dir']:
+                from data_process.SVI_store import SVIStore
+
+                loaded['svi'] = SVIStore.open(options['svi_store_dir'])
+            else:
+                loaded['svi'] = ssi.load_svi(os.path.join(pathroot, ssi.SVI_FILE))
+        ssi.run_city(pathroot, city, svi=loaded['svi'], local_side=options['local_side'],
+                     chunksize=options['chunksize'], cache_dir=options['cache_dir'])
+
+    return _for_each_city(todo, run)
+
+
+def stage_tracts(manifest, workdir, shard):
+    from data_process.data_reader import associate_shapes, data_reader_census_tract, save_census_tracts_to_geojson
+
+    pathroot, options = manifest['pathroot'], manifest['options']
+    dropped = {}
+
+    def run(city):
+        output_file = _tract_file(workdir, city)
+        if os.path.exists(output_file):
+            return False
+        local_file = os.path.join(pathroot, ssi.LOCAL_SSI_DIR, ssi.local_ssi_file_name(city, options['local_side']))
+        tracts = data_reader_census_tract(local_file)
+        # local SSI 非有限（如只作为终点出现的 tract）的 tract 不写入，否则 Moran / Gi* 整列为 NaN
+        finite = np.isfinite(tracts.theme_matrix()).all(axis=1)
+        dropped[city] = int((~finite).sum())
+        if dropped[city]:
+            print(f"{city}: {dropped[city]} tract(s) without finite local SSI dropped")
+        tracts = associate_shapes(tracts[finite],
+                                  os.path.join(pathroot, options['shapefile_template'].format(city=city)))
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        save_census_tracts_to_geojson(tracts, output_file)
+
+    done, failures = _for_each_city(shard['cities'], run)
+    return done, failures, dropped
+
+
+def stage_moran(manifest, workdir, shard):
+    from analysis.Moran import Morans
+
+    options = manifest['options']
+    output_file = _shard_table(workdir, MORAN_DIR, shard['id'])
+    columns = Morans.moran_result_columns(permutations=options['permutations'])
+    # 重跑时复用已有 shard 表中成功城市的结果行（列不同说明选项变了，全部重算）
+    previous = {}
+    if os.path.exists(output_file):
+        existing = pd.read_csv(output_file, float_precision='round_trip')
+        if list(existing.columns) == columns:
+            previous = {row['city_name']: row for row in existing.to_dict('records')}
+    rows = {}
+
+    def run(city):
+        tract_file = _tract_file(workdir, city)
+        city_name = os.path.basename(tract_file).split('.')[0]
+        if city_name in previous:
+            rows[city] = previous[city_name]
+            return False
+        rows[city] = Morans.analyze_city(
+            tract_file, weights_cache_dir=options['weights_cache_dir'], permutations=options['permutations'],
+            seed=options['seed'], weights=options['moran_weights'], od_dir=options['od_dir'],
+            flow_symmetric=options['flow_symmetric'], flow_threshold=options['flow_threshold'])
+
+    done, failures = _for_each_city(shard['cities'], run)
+    _save_table(pd.DataFrame([rows[c] for c in shard['cities'] if c in rows], columns=columns), output_file)
+    return done, failures
+
+
+def stage_gi(manifest, workdir, shard):
+    gi = _analysis_module('Gi_star', os.path.join('analysis', 'Getis-Ord', 'Gi_star.py'))
+    options = manifest['options']
+
+    def run(city):
+        if all(os.path.exists(f) for f in _gi_files(workdir, city)):
+            return False
+        gi.process_city(_tract_file(workdir, city), os.path.join(workdir, GI_DIR), themes=GI_THEMES,
+                        weights=options['gi_weights'], weights_cache_dir=options['weights_cache_dir'],
+                        fdr=options['fdr'], od_dir=options['od_dir'], flow_symmetric=options['flow_symmetric'],
+                        flow_threshold=options['flow_threshold'], flow_self_weight=options['flow_self_weight'])
+
+    return _for_each_city(shard['cities'], run)
+
+
+def stage_overlap(manifest, workdir, shard):
+    from data_process.hotspot_reader import read_attributes
+
+    overlap = _analysis_module('Over_lap_OHSA_result', os.path.join('analysis', 'Getis-Ord', 'Over_lap_OHSA_result.py'))
+    output_folder = os.path.join(workdir, OVERLAP_DIR)
+    rows = []
+
+    def run(city):
+        summary_file = os.path.join(output_folder, f'{city}_summary.shp')
+        skipped = os.path.exists(summary_file)
+        if skipped:
+            summary = read_attributes(summary_file)
+        else:
+            summary = overlap.summarize_city(city, _gi_files(workdir, city), output_folder)
+        # 每个城市一行：tract 数与各 Gi_Bin 的主题计数之和
+        row = {'City': city, 'n_tracts': len(summary)}
+        row.update({str(val): int(summary[str(val)].sum()) for val in overlap.GI_BINS})
+        rows.append(row)
+        return not skipped
+
+    done, failures = _for_each_city(shard['cities'], run)
+    columns = ['City', 'n_tracts'] + [str(val) for val in overlap.GI_BINS]
+    _save_table(pd.DataFrame(rows, columns=columns), _shard_table(workdir, OVERLAP_DIR, shard['id']))
+    return done, failures
+
+
+STAGE_RUNNERS = {
+    'ssi': stage_ssi,
+    'tracts': stage_tracts,
+    'moran': stage_moran,
+    'gi': stage_gi,
+    'overlap': stage_overlap,
+}
+
+
+# ---------------------------------------------------------------------------
+# 调度
+# ---------------------------------------------------------------------------
+def run_shard(workdir, shard_id, stages=None):
+    """
+    Run the stages of one shard in order, skipping checkpointed ones.
+
+    A stage is checkpointed only when all its MSAs succeeded and every earlier
+    stage is checkpointed, so a re-run retries failed MSAs and everything
+    downstream of them.
+
+    :return: list of stage metric dicts (shard, stage, n_cities, n_done,
+        n_skipped, n_failed, n_dropped_tracts, seconds, cities_per_second,
+        peak_memory_mb, failures, dropped_tracts); n_done counts the MSAs
+        computed in this run, n_skipped those whose outputs already existed,
+        dropped_tracts the tracts left out per MSA (tracts stage)
+    """
+    manifest = load_manifest(workdir)
+    shard = manifest['shards'][shard_id]
+    records = []
+    complete = True
+    for stage in stages or manifest['stages']:
+        path = checkpoint_path(workdir, shard_id, stage)
+        if complete and os.path.exists(path):
+            continue
+        _reset_peak_memory()
+        start = time.perf_counter()
+        # 各阶段返回 (done, failures)，tracts 阶段另返回各城市删去的 tract 数
+        outcome = STAGE_RUNNERS[stage](manifest, workdir, shard)
+        done, failures = outcome[:2]
+        dropped = outcome[2] if len(outcome) > 2 else {}
+        seconds = time.perf_counter() - start
+        peak = peak_memory()
+        record = {
+            'shard': shard_id,
+            'stage': stage,
+            'n_cities': len(shard['cities']),
+            'n_done': len(done),
+            'n_skipped': len(shard['cities']) - len(done) - len(failures),
+            'n_failed': len(failures),
+            'n_dropped_tracts': sum(dropped.values()),
+            'seconds': seconds,
+            'cities_per_second': len(done) / seconds if seconds > 0 else float('nan'),
+            'peak_memory_mb': peak / 2 ** 20 if peak is not None else float('nan'),
+            'failures': failures,
+            'dropped_tracts': dropped,
+        }
+        records.append(record)
+        complete = complete and not failures
+        if complete:
+            _write_json(path, record)
+        print(f"shard {shard_id} {stage}: {len(done)} MSA(s) computed, {record['n_skipped']} skipped, "
+              f"{len(failures)} failed in {seconds:.1f}s, "
+              f"peak memory {record['peak_memory_mb']:.0f} MB")
+    return records
+
+
+def run_pipeline(workdir, n_jobs=None, stages=None, merge=True):
+    """
+    Run all unfinished shards of a manifest on a process pool, then merge the national tables.
+
+    :param workdir: folder holding manifest.json (see build_manifest)
+    :param n_jobs: upper bound on pool size (default: CPU count); with the ssi
+        stage the pool is also sized by available memory (see SSI_batch.plan_workers)
+    :param stages: subset of STAGES to run (default: all stages of the manifest)
+    :param merge: write the national tables when all shards are done; skipped
+        if any MSA or shard failed
+    :return: (DataFrame of the stage metrics of this run, dict of failed MSA
+        or 'shard <id>' -> error message)
+    """
+    manifest = load_manifest(workdir)
+    stages = stages or manifest['stages']
+    pathroot, options = manifest['pathroot'], manifest['options']
+    pending = [shard for shard in manifest['shards']
+               if not all(os.path.exists(checkpoint_path(workdir, shard['id'], s)) for s in stages)]
+    print(f"{len(manifest['shards'])} shard(s), {len(pending)} to run")
+
+    records = []
+    # 失败的 MSA（及整体出错的 shard，键为 'shard <id>'）-> 错误信息
+    failures = {}
+
+    def shard_failed(shard_id, e):
+        print(f"Error in shard {shard_id}: {str(e)}")
+        failures[f'shard {shard_id}'] = str(e)
+
+    if pending:
+        workers = n_jobs or os.cpu_count() or 1
+        if 'ssi' in stages:
+            od_cities = [c for shard in pending for c in shard['cities']
+                         if os.path.exists(os.path.join(pathroot, ssi.OD_DIR, f'{c}{OD_SUFFIX}'))]
+            workers = plan_workers(pathroot, od_cities, workers, options['chunksize'])
+            if options['svi_store_dir']:
+                from data_process.SVI_store import open_svi_store
+
+                # 在父进程中建好（或复用）SVI 存储，worker 只做只读映射
+                open_svi_store(options['svi_store_dir'], os.path.join(pathroot, ssi.SVI_FILE))
+        workers = max(1, min(workers, len(pending)))
+        print(f"Running with {workers} worker(s)")
+        if workers == 1:
+            for shard in pending:
+                try:
+                    records += run_shard(workdir, shard['id'], stages)
+                except Exception as e:
+                    shard_failed(shard['id'], e)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(run_shard, workdir, shard['id'], stages): shard['id'] for shard in pending}
+                for future in as_completed(futures):
+                    try:
+                        records += future.result()
+                    except Exception as e:
+                        shard_failed(futures[future], e)
+
+    for record in records:
+        for city, error in record['failures'].items():
+            failures.setdefault(city, error)
+    if failures:
+        print(f"{len(failures)} MSA(s)/shard(s) failed, re-run to retry: {sorted(failures)}")
+    elif merge:
+        merge_national(workdir)
+    return pd.DataFrame(records), failures
+
+
+def _concat_shard_tables(folder, output_file):
+    frames = []
+    if os.path.isdir(folder):
+        frames = [pd.read_csv(os.path.join(folder, f)) for f in sorted(os.listdir(folder))
+                  if f.startswith('shard_') and f.endswith('.csv')]
+    combined = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    combined.to_csv(output_file, index=False)
+    return combined
+
+
+def stage_summary(metrics):
+    """Per-stage totals of the shard metrics: MSAs, seconds, throughput and the largest peak memory."""
+    summary = metrics.groupby('stage', sort=False).agg(
+        n_done=('n_done', 'sum'), seconds=('seconds', 'sum'), peak_memory_mb=('peak_memory_mb', 'max'))
+    summary['cities_per_second'] = (summary['n_done'] / summary['seconds']).where(summary['n_done'] > 0)
+    return summary.reindex([s for s in STAGES if s in summary.index])
+
+
+def merge_national(workdir):
+    """
+    Merge the per-shard outputs into the national tables in the work folder.
+
+    Writes SSI_golbal_data.csv, morans_i_results.csv, overlap_summary.csv and
+    pipeline_metrics.csv (checkpointed stage metrics).
+
+    :return: dict name -> DataFrame
+    """
+    manifest = load_manifest(workdir)
+    cities = [c for shard in manifest['shards'] for c in shard['cities']]
+    tables = {
+        'ssi': merge_global_ssi(manifest['pathroot'], cities, os.path.join(workdir, 'SSI_golbal_data.csv')),
+        'moran': _concat_shard_tables(os.path.join(workdir, MORAN_DIR), os.path.join(workdir, 'morans_i_results.csv')),
+        'overlap': _concat_shard_tables(os.path.join(workdir, OVERLAP_DIR),
+                                        os.path.join(workdir, 'overlap_summary.csv')),
+    }
+    metrics = load_checkpoints(workdir)
+    if len(metrics):
+        metrics = metrics.sort_values(['shard', 'stage'], key=lambda c: c.map(STAGES.index) if c.name == 'stage' else c,
+                                      ignore_index=True)
+    tables['metrics'] = metrics
+    if len(metrics):
+        metrics.drop(columns=['failures', 'dropped_tracts'], errors='ignore').to_csv(os.path.join(workdir, 'pipeline_metrics.csv'), index=False)
+        print(stage_summary(metrics).to_string(float_format=lambda v: f'{v:.2f}'))
+    print(f"National tables saved to {workdir}")
+    return tables
+
+
+if __name__ == '__main__':
+    Pathroot = "/soge-home/users/cenv0925/"
+    workdir = os.path.join(Pathroot, "SVI", "Result", "National")
+    if not os.path.exists(os.path.join(workdir, MANIFEST_FILE)):
+        build_manifest(Pathroot, workdir, weights_cache_dir=os.path.join(workdir, 'weights_cache'))
+    run_pipeline(workdir)
@@ -0,0 +1,217 @@
+"""
+Sparse OD flow matrix of one MSA.
+
+The Step1_TotalOD files are long O/D/Total edge lists, and every per-tract
+question (flows leaving a tract, flows entering it, flow-weighted averages)
+used to filter the whole list again.  ``ODMatrix`` stores the flows once as a
+``scipy.sparse`` CSR matrix over tract positions together with the tract ID of
+every position:
+
+- the flows leaving a tract are one CSR row slice and the flows entering it
+  one CSC column slice, both O(degree)
+- mobility-weighted exposure (the flow-weighted mean of a tract attribute over
+  the destinations of every origin) is one sparse matrix product
+- ``save``/``load`` write the arrays to a single ``.npz`` file that reloads
+  without parsing the CSV
+
+Duplicated O/D pairs are summed.  OD rows whose tract is not in the tract list
+(e.g. the -1 positions of the columnar OD cache) are dropped.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from data_process import SSI_Calculation as ssi
+
+OD_SIDES = ('origin', 'destination')
+
+
+class ODMatrix:
+    def __init__(self, tract_id, flows):
+        self.tract_id = np.asarray(tract_id)  # 第 i 行 / 列对应的 TractID
+        self.flows = sparse.csr_matrix(flows, dtype=float)  # flows[o, d] = O→D 总流量
+        if self.flows.shape != (len(self.tract_id), len(self.tract_id)):
+            raise ValueError(f"flows must have shape ({len(self.tract_id)}, {len(self.tract_id)})")
+        self.flows.sum_duplicates()
+        self._csc = None
+        self._lookup = None
+
+    @classmethod
+    def from_edges(cls, o, d, total, tract_id=None):
+        """
+        Build the matrix from an O/D/Total edge list of tract IDs.
+
+        :param o: origin tract IDs
+        :param d: destination tract IDs
+        :param total: flows
+        :param tract_id: tract IDs of the rows/columns; default: unique O then
+            D in order of appearance (the order of the SSI tract table)
+        :return: ODMatrix
+        """
+        o, d = np.asarray(o), np.asarray(d)
+        if tract_id is None:
+            tract_id = pd.unique(np.concatenate([pd.unique(o), pd.unique(d)]))
+        tract_id = np.asarray(tract_id)
+        lookup = _position_lookup(tract_id)
+        return cls.from_positions(tract_id, lookup(o), lookup(d), total)
+
+    @classmethod
+    def from_positions(cls, tract_id, o_idx, d_idx, total):
+        """Build the matrix from O/D positions in tract_id (-1 rows are dropped)."""
+        o_idx, d_idx = np.asarray(o_idx), np.asarray(d_idx)
+        total = np.asarray(total, dtype=float)
+        keep = (o_idx >= 0) & (d_idx >= 0)
+        n = len(tract_id)
+        flows = sparse.coo_matrix((total[keep], (o_idx[keep], d_idx[keep])), shape=(n, n)).tocsr()
+        return cls(tract_id, flows)
+
+    @classmethod
+    def from_od_file(cls, od_file, chunksize=None):
+        """
+        Read a Step1_TotalOD CSV; with a chunksize the file is streamed and
+        only the summed matrix, not the whole edge list, is kept in memory.
+        """
+        if not chunksize:
+            od = ssi.read_od(od_file)
+            return cls.from_edges(od['O'].to_numpy(), od['D'].to_numpy(), od['Total'].to_numpy())
+        o_ids, d_ids = ssi.scan_od_tracts(od_file, chunksize)
+        tract_id = pd.unique(np.concatenate([o_ids, d_ids]))
+        lookup = _position_lookup(tract_id)
+        n = len(tract_id)
+        flows = sparse.csr_matrix((n, n))
+        for chunk in ssi.iter_od_chunks(od_file, chunksize):
+            o_idx, d_idx = lookup(chunk['O'].to_numpy()), lookup(chunk['D'].to_numpy())
+            flows = flows + sparse.coo_matrix((chunk['Total'].to_numpy(dtype=float), (o_idx, d_idx)),
+                                              shape=(n, n)).tocsr()
+        return cls(tract_id, flows)
+
+    @classmethod
+    def from_od_cache(cls, cache_dir, city):
+        """Build the matrix from the columnar OD cache (see OD_cache.py), whose O/D are already positions."""
+        from data_process.OD_cache import load_cached_od, load_cached_tracts
+
+        tract_id = load_cached_tracts(cache_dir, city)['TractID'].to_numpy()
+        o, d, total = load_cached_od(cache_dir, city)
+        return cls.from_positions(tract_id, o, d, total)
+
+    def save(self, path):
+        """Write the matrix and the tract IDs to one .npz file."""
+        np.savez(path, tract_id=self.tract_id, indptr=self.flows.indptr, indices=self.flows.indices,
+                 data=self.flows.data)
+
+    @classmethod
+    def load(cls, path):
+        """Load a matrix written by save."""
+        with np.load(path, allow_pickle=False) as f:
+            n = len(f['tract_id'])
+            flows = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=(n, n))
+            return cls(f['tract_id'], flows)
+
+    def __len__(self):
+        return len(self.tract_id)
+
+    @property
+    def nnz(self):
+        return self.flows.nnz
+
+    def locate(self, tract_ids):
+        """
+        Positions of tract IDs in the matrix.
+
+        :param tract_ids: array of tract IDs
+        :return: int array, -1 for tracts not in the matrix
+        """
+        if self._lookup is None:
+            self._lookup = _position_lookup(self.tract_id)
+        return self._lookup(np.asarray(tract_ids))
+
+    def _position(self, tract):
+        i = int(self.locate([tract])[0])
+        if i < 0:
+            raise KeyError(tract)
+        return i
+
+    def origin(self, tract):
+        """
+        Flows leaving one tract, O(out-degree).
+
+        :param tract: tract ID
+        :return: (destination tract IDs, flows)
+        """
+        i = self._position(tract)
+        start, end = self.flows.indptr[i], self.flows.indptr[i + 1]
+        return self.tract_id[self.flows.indices[start:end]], self.flows.data[start:end]
+
+    def destination(self, tract):
+        """
+        Flows entering one tract, O(in-degree) on the column-compressed copy.
+
+        :param tract: tract ID
+        :return: (origin tract IDs, flows)
+        """
+        i = self._position(tract)
+        if self._csc is None:
+            self._csc = self.flows.tocsc()
+        start, end = self._csc.indptr[i], self._csc.indptr[i + 1]
+        return self.tract_id[self._csc.indices[start:end]], self._csc.data[start:end]
+
+    def out_flow(self):
+        """Total flow leaving every tract."""
+        return np.asarray(self.flows.sum(axis=1)).ravel()
+
+    def in_flow(self):
+        """Total flow entering every tract."""
+        return np.asarray(self.flows.sum(axis=0)).ravel()
+
+    def exposure(self, values, side='origin'):
+        """
+        Mobility-weighted exposure: flow-weighted mean of tract values over the
+        other end of every tract's flows.
+
+        With ``side='origin'`` row ``i`` is the mean of ``values`` over the
+        destinations of tract ``i`` weighted by the flows ``i → j``; with
+        'destination' the mean over the origins of the flows entering ``i``.
+        Tracts without flows get NaN.
+
+        :param values: (n,) or (n, k) array in matrix order, or a Series /
+            DataFrame indexed by tract ID (missing tracts count as NaN)
+        :param side: 'origin' or 'destination'
+        :return: array of the shape of values
+        """
+        if side not in OD_SIDES:
+            raise ValueError(f"side must be one of: {', '.join(OD_SIDES)}")
+        if isinstance(values, (pd.Series, pd.DataFrame)):
+            values = values.reindex(self.tract_id)
+        values = np.asarray(values, dtype=float)
+        flows = self.flows if side == 'origin' else self.flows.T.tocsr()
+        # 缺失值不参与加权：分子、分母都只计有值的一端
+        present = ~np.isnan(values)
+        weighted = flows @ np.where(present, values, 0.0)
+        weight = flows @ present.astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return weighted / weight
+
+    def to_edges(self):
+        """Edge list with columns O, D, Total (tract IDs), in row order."""
+        coo = self.flows.tocoo()
+        return pd.DataFrame({'O': self.tract_id[coo.row], 'D': self.tract_id[coo.col], 'Total': coo.data})
+
+
+def _position_lookup(tract_id):
+    # 复用 SSI 计算中的二分查找：TractID -> 行号，缺失为 -1
+    if len(tract_id) == 0:
+        return lambda ids: np.full(len(ids), -1)
+    return ssi.tract_index(pd.DataFrame({'TractID': tract_id}))
+
+
+if __name__ == '__main__':
+    Pathroot = "/soge-home/users/cenv0925/"
+    City = "StLouis"
+    od_matrix = ODMatrix.from_od_file(os.path.join(Pathroot, ssi.OD_DIR, f'{City}2019.csv'),
+                                      chunksize=ssi.DEFAULT_CHUNKSIZE)
+    output_folder = os.path.join(Pathroot, "SVI", "Data", "OD_matrix")
+    os.makedirs(output_folder, exist_ok=True)
+    od_matrix.save(os.path.join(output_folder, f'{City}_od.npz'))
+    print(f"{City}: {len(od_matrix)} tracts, {od_matrix.nnz} OD pairs")
@@ -0,0 +1,288 @@
+"""
+Persistent cache of spatial weights for the census-tract analyses.
+
+Contiguity is rebuilt from the same census-tract files by Moran's I,
+Getis-Ord and the hotspot scripts.  This module stores the sparse CSR weights
+of each city as ``<city>_<kind>.npz`` together with the tract IDs and a SHA-1
+of the tract IDs and geometries (WKB), so any analysis module can fetch them
+in milliseconds.  A cache whose key no longer matches the census tract data
+is rebuilt.
+
+Besides the binary contiguity / distance-band weights, ``build_flow_weights``
+turns the OD flows of an MSA (an ``ODMatrix``, see od_matrix.py) into mobility
+weights between its tracts; they stay sparse, are cached the same way and are
+row-standardized by the analyses like the contiguity weights.
+"""
+import os
+import hashlib
+
+import numpy as np
+from scipy import sparse
+
+CACHE_VERSION = 1
+
+
+def geometry_key(gdf, id_col='id'):
+    """
+    SHA-1 of the tract IDs and geometries of a GeoDataFrame.
+
+    :param gdf: GeoDataFrame of census tracts
+    :param id_col: tract ID column (the row order is used if absent)
+    :return: hex digest
+    """
+    sha1 = hashlib.sha1()
+    ids = gdf[id_col].to_numpy() if id_col in gdf.columns else np.arange(len(gdf))
+    sha1.update(np.asarray(ids).astype(str).astype('S').tobytes())
+    for wkb in gdf.geometry.to_wkb():
+        sha1.update(wkb or b'')
+    return sha1.hexdigest()
+
+
+def weights_cache_path(cache_dir, name, kind='queen'):
+    return os.path.join(cache_dir, f'{name}_{kind}.npz')
+
+
+def build_queen(gdf):
+    """Binary Queen contiguity of a GeoDataFrame as a CSR matrix in row order."""
+    from libpysal.weights import Queen
+
+    w = Queen.from_dataframe(gdf)
+    W = w.sparse.tocsr()
+    W.data[:] = 1.0
+    return W
+
+
+def default_distance_band(points):
+    """
+    Default distance band in the spirit of ArcGIS Optimized Hot Spot Analysis:
+    mean distance to the k-th nearest neighbour, k = 5% of the features clipped to [3, 30].
+
+    :param points: (n, 2) array of projected centroids
+    :return: distance in CRS units
+    """
+    from scipy.spatial import cKDTree
+
+    n = len(points)
+    k = min(int(np.clip(round(0.05 * n), 3, 30)), n - 1)
+    distances, _ = cKDTree(points).query(points, k=k + 1)
+    return float(distances[:, k].mean())
+
+
+def build_distance_band(gdf, threshold=None):
+    """
+    Binary fixed-distance-band weights between tract centroids, without self-neighbours.
+
+    :param gdf: GeoDataFrame in a projected CRS
+    :param threshold: distance band in CRS units (default_distance_band if None)
+    :return: CSR matrix in row order
+    """
+    from scipy.spatial import cKDTree
+
+    centroids = gdf.geometry.centroid
+    points = np.column_stack([centroids.x, centroids.y])
+    if threshold is None:
+        threshold = default_distance_band(points)
+    pairs = cKDTree(points).query_pairs(threshold, output_type='ndarray')
+    n = len(points)
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+
+
+WEIGHT_BUILDERS = {'queen': build_queen, 'distance_band': build_distance_band}
+OD_MATRIX_SUFFIX = '_od.npz'
+
+
+def build_flow_weights(gdf, od_matrix, id_col='id', symmetric=True, threshold=None):
+    """
+    Mobility weights between the tracts of a GeoDataFrame from their OD flows.
+
+    ``w_ij`` is the flow i -> j (plus j -> i if symmetric), self-flows are
+    dropped and, with a threshold, so are the weights below it.  Tracts without
+    flows in the OD matrix get empty rows (islands).  The flows are gathered
+    with sparse selection products, so no n x n matrix is ever densified.
+
+    :param gdf: GeoDataFrame of census tracts
+    :param od_matrix: ODMatrix of the MSA
+    :param id_col: tract ID column (tract IDs of the OD matrix)
+    :param symmetric: use the total interaction i <-> j instead of the directed flow
+    :param threshold: minimum weight kept (in flow units)
+    :return: CSR matrix in row order
+    """
+    ids = np.asarray(gdf[id_col].to_numpy()).astype(od_matrix.tract_id.dtype)
+    pos = od_matrix.locate(ids)
+    found = np.flatnonzero(pos >= 0)
+    # S 把 GeoDataFrame 的行映射到 OD 矩阵的行，W = S F S^T
+    S = sparse.csr_matrix((np.ones(len(found)), (found, pos[found])), shape=(len(ids), len(od_matrix)))
+    W = (S @ od_matrix.flows @ S.T).tocsr()
+    if symmetric:
+        W = (W + W.T).tocsr()
+    W = (W - sparse.diags(W.diagonal())).tocsr()
+    if threshold is not None:
+        W.data[W.data < threshold] = 0.0
+    W.eliminate_zeros()
+    return W
+
+
+def flow_weights_kind(symmetric=True, threshold=None):
+    """Cache kind of flow weights, e.g. 'flow', 'flow_directed' or 'flow_10'."""
+    kind = 'flow' if symmetric else 'flow_directed'
+    return kind if threshold is None else f'{kind}_{threshold:g}'
+
+
+def od_matrix_path(od_dir, name):
+    """OD matrix file of a city (``<City>_od.npz``); name may be e.g. 'Boston_census_tract'."""
+    from data_process.data_struct import normalize_city_name
+
+    return os.path.join(od_dir, f'{normalize_city_name(name)}{OD_MATRIX_SUFFIX}')
+
+
+def save_weights(path, W, ids, key, source=None):
+    """Write a CSR weights matrix, its tract IDs and cache key to .npz."""
+    W = W.tocsr()
+    source_state = {}
+    if source is not None:
+        stat = os.stat(source)
+        source_state = {'source': os.path.abspath(source), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, data=W.data, indices=W.indices, indptr=W.indptr, shape=np.array(W.shape),
+             ids=np.asarray(ids), key=key, version=CACHE_VERSION, **source_state)
+    os.replace(tmp_path, path)
+
+
+def load_weights(path):
+    """
+    Load a cached weights file.
+
+    :return: (W csr_matrix, ids array, dict of metadata) or None if absent/outdated
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as f:
+        if int(f['version']) != CACHE_VERSION:
+            return None
+        W = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+        meta = {k: f[k].item() for k in ('key', 'source', 'size', 'mtime_ns') if k in f.files}
+        return W, f['ids'], meta
+
+
+def load_or_build_weights(gdf, cache_dir, name, kind='queen', id_col='id', source=None, builder=None,
+                          key_extra=None):
+    """
+    Weights of a city, from the cache if the geometry key matches.
+
+    :param gdf: GeoDataFrame of census tracts
+    :param cache_dir: cache folder
+    :param name: city name used in the cache file name
+    :param kind: weights type, a key of WEIGHT_BUILDERS unless builder is given
+    :param id_col: tract ID column
+    :param source: census tract file the gdf was read from (recorded for fetch_weights)
+    :param builder: function gdf -> CSR matrix, overrides WEIGHT_BUILDERS[kind]
+    :param key_extra: state of other inputs of the builder (e.g. the OD matrix
+        file), appended to the cache key
+    :return: (W csr_matrix, ids array)
+    """
+    path = weights_cache_path(cache_dir, name, kind)
+    key = geometry_key(gdf, id_col)
+    if key_extra is not None:
+        key = f'{key}|{key_extra}'
+    cached = load_weights(path)
+    if cached is not None and cached[2].get('key') == key:
+        W, ids, meta = cached
+        if source is not None and meta.get('mtime_ns') != os.stat(source).st_mtime_ns:
+            # 文件被重写但几何未变：只更新记录的文件状态
+            save_weights(path, W, ids, key, source)
+        return W, ids
+
+    W = (builder or WEIGHT_BUILDERS[kind])(gdf)
+    ids = gdf[id_col].to_numpy() if id_col in gdf.columns else np.arange(len(gdf))
+    os.makedirs(cache_dir, exist_ok=True)
+    save_weights(path, W, ids, key, source)
+    return W, ids
+
+
+def load_or_build_flow_weights(gdf, od_path, cache_dir=None, name=None, symmetric=True, threshold=None,
+                               id_col='id'):
+    """
+    Flow weights of a city from its saved OD matrix, cached like the contiguity weights.
+
+    The cache is keyed on the tracts and on the path, size and mtime of the
+    OD matrix file, so a rebuilt OD matrix rebuilds the weights.
+
+    :param gdf: GeoDataFrame of census tracts
+    :param od_path: ``.npz`` written by ODMatrix.save (see od_matrix_path)
+    :param cache_dir: cache folder (no caching if None)
+    :param name: city name used in the cache file name
+    :param symmetric: see build_flow_weights
+    :param threshold: see build_flow_weights
+    :param id_col: tract ID column
+    :return: (W csr_matrix, ids array)
+    """
+    from data_process.od_matrix import ODMatrix
+
+    def builder(g):
+        return build_flow_weights(g, ODMatrix.load(od_path), id_col, symmetric, threshold)
+
+    if cache_dir is None:
+        return builder(gdf), gdf[id_col].to_numpy()
+    stat = os.stat(od_path)
+    return load_or_build_weights(gdf, cache_dir, name, kind=flow_weights_kind(symmetric, threshold),
+                                 id_col=id_col, builder=builder,
+                                 key_extra=f'{os.path.abspath(od_path)}:{stat.st_size}:{stat.st_mtime_ns}')
+
+
+def fetch_weights(file_path, cache_dir, kind='queen', id_col='id', name=None):
+    """
+    Weights of a census tract file without reading it when the cache is current.
+
+    The file's size and mtime recorded in the cache are checked first; only
+    when they differ is the file read and its geometry key compared.
+    Distance-band weights depend on the projection, so for them the tracts are
+    projected to EPSG:5070 and cached under ``<city>_EPSG5070``, as in
+    Gi_star.process_city.
+
+    :param file_path: census tract GeoJSON/shapefile
+    :param cache_dir: cache folder
+    :param kind: weights type
+    :param id_col: tract ID column
+    :param name: cache name (default: file name without extension, plus
+        ``_EPSG5070`` for distance-band weights)
+    :return: (W csr_matrix, ids array)
+    """
+    projected = kind == 'distance_band'
+    if name is None:
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        if projected:
+            # 距离带依赖投影：与 Gi_star.city_weights 使用同一缓存名
+            name = f'{name}_EPSG5070'
+    cached = load_weights(weights_cache_path(cache_dir, name, kind))
+    if cached is not None:
+        stat = os.stat(file_path)
+        meta = cached[2]
+        if meta.get('source') == os.path.abspath(file_path) and meta.get('size') == stat.st_size \
+                and meta.get('mtime_ns') == stat.st_mtime_ns:
+            return cached[0], cached[1]
+
+    import geopandas as gpd
+
+    gdf = gpd.read_file(file_path)
+    if projected:
+        if gdf.crs is None:
+            gdf = gdf.set_crs(epsg=4326)
+        gdf = gdf.to_crs(epsg=5070)
+    return load_or_build_weights(gdf, cache_dir, name, kind=kind, id_col=id_col, source=file_path)
+
+
+def row_standardize(W):
+    """Row-standardize a sparse weights matrix (libpysal transform 'r'); island rows stay zero."""
+    W = W.tocsr().astype(float)
+    row_sum = np.asarray(W.sum(axis=1)).ravel()
+    scale = np.divide(1.0, row_sum, out=np.zeros_like(row_sum), where=row_sum != 0)
+    return (sparse.diags(scale) @ W).tocsr()
+
+
+def to_pysal(W, ids=None):
+    """Wrap a sparse weights matrix as a libpysal W (e.g. for esda)."""
+    from libpysal.weights import WSP
+
+    return WSP(W.tocsr(), id_order=None if ids is None else list(ids)).to_W()
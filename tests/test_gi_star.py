@@ -0,0 +1,53 @@
+import importlib.util
+import os
+
+import numpy as np
+from scipy import sparse
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+spec = importlib.util.spec_from_file_location(
+    'Gi_star', os.path.join(project_root, 'analysis', 'Getis-Ord', 'Gi_star.py'))
+Gi_star = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(Gi_star)
+
+
+def grid_weights(rows, cols):
+    """Binary queen contiguity of a rows x cols grid."""
+    n = rows * cols
+    r, c = np.divmod(np.arange(n), cols)
+    i, j = [], []
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            if dr == dc == 0:
+                continue
+            keep = (r + dr >= 0) & (r + dr < rows) & (c + dc >= 0) & (c + dc < cols)
+            i.append(np.flatnonzero(keep))
+            j.append((r[keep] + dr) * cols + c[keep] + dc)
+    i, j = np.concatenate(i), np.concatenate(j)
+    return sparse.csr_matrix((np.ones(len(i)), (i, j)), shape=(n, n))
+
+
+def test_gi_star_leaves_out_nan_tract():
+    W = grid_weights(10, 5)
+    rng = np.random.default_rng(0)
+    Y = rng.normal(size=(50, 2))
+    Y[:10, 1] += 3
+    Y[17, 0] = np.nan
+
+    z, p, n_neighbors = Gi_star.gi_star(Y, W)
+
+    # 只有 NaN 的 tract 缺失，其余按去掉它后的子矩阵计算
+    keep = np.arange(50) != 17
+    z_keep, p_keep, n_keep = Gi_star.gi_star(Y[keep][:, :1], W[keep][:, keep])
+    assert np.isnan(z[17, 0]) and np.isnan(p[17, 0]) and n_neighbors[17, 0] == 0
+    np.testing.assert_allclose(z[keep, 0], z_keep[:, 0])
+    np.testing.assert_array_equal(n_neighbors[keep, 0], n_keep[:, 0])
+
+    # 完整的列不受影响
+    z_full, _, n_full = Gi_star.gi_star(Y[:, 1:], W)
+    np.testing.assert_allclose(z[:, 1], z_full[:, 0])
+    np.testing.assert_array_equal(n_neighbors[:, 1], n_full[:, 0])
+
+    bins = Gi_star.gi_bin(z, p)
+    assert bins[17, 0] == 0
+    assert (bins[:, 1] > 0).any()
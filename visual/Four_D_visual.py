@@ -61,8 +61,11 @@ for city in ranked_data["City"].unique():
 # 标签与标题
 plt.gca().invert_yaxis()
 ax = plt.gca()
-ax.set_ylim(30.5, 0.5)
-ax.yaxis.set_major_locator(plt.MultipleLocator(1))
+n_cities = len(data)
+ax.set_ylim(n_cities + 0.5, 0.5)
+# 城市较多（如全国约 380 个 MSA）时每隔 rank_step 名标注一次，保持约 30 个刻度
+rank_step = max(1, int(np.ceil(n_cities / 30)))
+ax.yaxis.set_major_locator(plt.MultipleLocator(rank_step))
 
 # 减小主题间距
 plt.xticks(range(len(theme_columns)), theme_columns_name, fontsize=10)
@@ -73,12 +76,12 @@ plt.ylabel("Segregation Rank", fontsize=12)
 ax2 = ax.twinx()
 ax2.set_ylim(ax.get_ylim())
 city_ranks = sorted_data["City_Rank"].tolist()
-ax2.set_yticks(range(1, len(city_ranks) + 1))
-ax2.set_yticklabels(city_ranks, fontsize=8)
+ax2.set_yticks(range(1, len(city_ranks) + 1, rank_step))
+ax2.set_yticklabels(city_ranks[::rank_step], fontsize=8)
 
 # 为城市名称设置颜色
-for i, tick in enumerate(ax2.get_yticklabels()):
-    city = city_ranks[i].split(". ")[1]
+for tick in ax2.get_yticklabels():
+    city = tick.get_text().split(". ", 1)[1]
     if city in highlighted_cities:
         tick.set_color(highlighted_cities[city])
     else:
@@ -1,5 +1,5 @@
 import os
-import geopandas as gpd
+import sys
 import re
 import numpy as np
 import seaborn as sns
@@ -7,6 +7,12 @@ import matplotlib.pyplot as plt
 from collections import defaultdict
 from sklearn.metrics import jaccard_score
 
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(current_dir, ".."))
+sys.path.append(project_root)
+
+from data_process.hotspot_reader import read_hotspots
+
 
 def create_similarity_heatmap(similarity_matrix, themes, city_name, output_folder, show_city_name=True, 
                             annotation_color='auto', city_name_color='black'):
@@ -105,7 +111,8 @@ def process_city_shapefiles(folder_path, output_folder, show_city_names=True,
             theme_num = m.group(2)
             theme = theme_names[theme_num]
             themes.append(theme)
-            gdf = gpd.read_file(os.path.join(folder_path, shp))
+            # 只需 SOURCE_ID 和 Gi_Bin，跳过几何解码
+            gdf = read_hotspots(os.path.join(folder_path, shp))
             tracts_gi3 = set(gdf[gdf['Gi_Bin'] == 3]['SOURCE_ID'])
             theme_sets.append(tracts_gi3)
         # 计算全集